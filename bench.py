@@ -0,0 +1,534 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+import ciklus_bot as cb
+from fake_botapi import BOT_USER, FakeBotAPI
+from telegram import Update
+
+# Benchmark: mikro merenja renderovanja, replay webhook update-a kroz pravi Application
+# (protiv lokalnog fake Bot API servera) i simulacija vecernjeg broadcast-a za N korisnika.
+#   python bench.py                      # sve, poredi sa bench_baseline.json ako postoji
+#   python bench.py --only micro --save-baseline
+
+BASELINE_PATH = os.getenv("BENCH_BASELINE", "bench_baseline.json")
+REGRESSION_FACTOR = 1.25
+BENCH_CITIES = ("Beograd", "Novi Sad", "Niš", "Kragujevac", "Beč", "-")
+BENCH_TIMEZONES = ("Europe/Belgrade", "Europe/London", "America/New_York", "Asia/Tokyo", "Australia/Sydney")
+
+def percentile(samples: list, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def summarize(samples_ns: list, wall: float) -> dict:
+    return {
+        "p50_us": percentile(samples_ns, 50) / 1000,
+        "p99_us": percentile(samples_ns, 99) / 1000,
+        "ops_s": len(samples_ns) / wall if wall > 0 else 0.0,
+    }
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def sample_user(i: int) -> dict:
+    today = cb.datetime.now(cb.TZ).date()
+    return {
+        "cycle_length": 24 + i % 12,
+        "period_length": 3 + i % 5,
+        "last_start": today - timedelta(days=i % 40),
+        "star_sign": cb.HOROSCOPE_SIGNS[i % 12] if i % 13 else None,
+        "seen_start": True,
+        "bad_mood_streak": i % 4,
+        "last_mood_date": today - timedelta(days=1),
+        "city": cb.normalize_city(BENCH_CITIES[i % len(BENCH_CITIES)]),
+    }
+
+# --- MIKRO ---
+def bench_micro(iterations: int) -> dict:
+    users = [sample_user(i) for i in range(1000)]
+    moods = ["sjajan", "onako", "tezak", "stresan"]
+    cases = {
+        "build_today_overview": lambda i: cb.build_today_overview(users[i % 1000], i),
+        "build_mood_message": lambda i: cb.build_mood_message(users[i % 1000], moods[i % 4], i),
+        "daily_horoscope": lambda i: cb.daily_horoscope(cb.HOROSCOPE_SIGNS[i % 12]),
+        "update_streak": lambda i: cb.update_streak(dict(users[i % 1000]), moods[i % 4]),
+        "calc_next_dates": lambda i: cb.calc_next_dates(users[i % 1000]),
+    }
+    results = {}
+    for name, fn in cases.items():
+        samples = []
+        started = time.perf_counter()
+        for i in range(iterations):
+            t = time.perf_counter_ns()
+            fn(i)
+            samples.append(time.perf_counter_ns() - t)
+        results[f"micro.{name}"] = summarize(samples, time.perf_counter() - started)
+    return results
+
+# --- LOGOVANJE ---
+def bench_logging(iterations: int, workdir: str) -> dict:
+    # Koliko petlju kosta jedno upozorenje: sinhroni StreamHandler u fajl naspram reda
+    # (LogQueueHandler) sa listener niti koja formatira i pise isti fajl.
+    results = {}
+    for name in ("sync", "queue"):
+        stream = open(os.path.join(workdir, f"log_{name}.txt"), "w")
+        output = logging.StreamHandler(stream)
+        output.setFormatter(cb.TextFormatter(cb.LOG_TEXT_FORMAT))
+        listener = None
+        if name == "queue":
+            handler = cb.LogQueueHandler(cb.SimpleQueue())
+            listener = cb.QueueListener(handler.queue, output)
+            listener.start()
+        else:
+            handler = output
+        log = logging.getLogger(f"bench.log.{name}")
+        log.propagate = False
+        log.addHandler(handler)
+        samples = []
+        started = time.perf_counter()
+        for i in range(iterations):
+            t = time.perf_counter_ns()
+            log.warning("Greska pri citanju vremena za %s: %r (breaker %s)", BENCH_CITIES[i % len(BENCH_CITIES)], TimeoutError(i), "closed")
+            samples.append(time.perf_counter_ns() - t)
+        wall = time.perf_counter() - started
+        if listener is not None:
+            listener.stop()
+        log.removeHandler(handler)
+        stream.close()
+        results[f"log.warning_{name}"] = summarize(samples, wall)
+    return results
+
+# --- ALOKACIJE PO PORUCI ---
+def bench_render(iterations: int) -> dict:
+    # Vrh alociranih bajtova (tracemalloc) i vreme po poruci: dnevna poruka sa tastaturom
+    # i outbox payload-om (broadcast), mood poruka iz kesa i telo poruke bez kesa.
+    import random
+
+    users = [sample_user(i) for i in range(1000)]
+    states = [cb.get_cycle_state_for_today(u) for u in users]
+    moods = ["sjajan", "onako", "tezak", "stresan"]
+
+    def daily(i):
+        text, markup = cb.render_daily_message(users[i % 1000], i, states[i % 1000])
+        return cb.Outbox.encode(text, "HTML", markup)
+
+    cases = {
+        "daily_payload": daily,
+        "mood_message": lambda i: cb.build_mood_message(users[i % 1000], moods[i % 4], i),
+        "mood_body_cold": lambda i: cb.render_mood_body(
+            states[i % 1000][1], users[i % 1000]["star_sign"], None, moods[i % 4], random.Random(i)
+        ),
+        "today_body_cold": lambda i: cb.render_today_body(
+            states[i % 1000][1], users[i % 1000]["star_sign"], None, random.Random(i)
+        ),
+        "mood_keyboard": lambda i: cb.mood_keyboard(),
+    }
+    results = {}
+    for name, fn in cases.items():
+        for i in range(200):
+            fn(i)  # zagrevanje kesa fragmenata
+        tracemalloc.start()
+        peaks = 0
+        for i in range(iterations):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            fn(i)
+            peaks += tracemalloc.get_traced_memory()[1] - current
+        tracemalloc.stop()
+        samples = []
+        started = time.perf_counter()
+        for i in range(iterations):
+            t = time.perf_counter_ns()
+            fn(i)
+            samples.append(time.perf_counter_ns() - t)
+        results[f"render.{name}"] = {
+            **summarize(samples, time.perf_counter() - started),
+            "alloc_bytes": peaks / iterations,
+        }
+    return results
+
+# --- REPLAY WEBHOOK UPDATE-A ---
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "...",
+            },
+        },
+    }
+
+def user_session(chat_id: int, today) -> list:
+    last_start = (today - timedelta(days=chat_id % 30)).strftime("%d.%m.%Y")
+    return [
+        ("message", "/start"),
+        ("callback", "setup"),
+        ("message", "28"),
+        ("message", "5"),
+        ("message", last_start),
+        ("callback", f"sign_{cb.HOROSCOPE_SIGNS[chat_id % 12]}"),
+        ("message", BENCH_CITIES[chat_id % len(BENCH_CITIES)]),
+        ("callback", "today"),
+        ("callback", "mood_tezak"),
+        ("callback", "mood_sjajan"),
+        ("callback", "status"),
+    ]
+
+def synthetic_updates(users: int) -> list:
+    today = cb.datetime.now(cb.TZ).date()
+    sessions = [user_session(10_000 + u, today) for u in range(users)]
+    updates = []
+    update_id = 1
+    # Korisnici se smenjuju (round-robin), kao u stvarnom saobracaju.
+    for step in range(len(sessions[0])):
+        for u, session in enumerate(sessions):
+            kind, payload = session[step]
+            chat_id = 10_000 + u
+            make = message_update if kind == "message" else callback_update
+            updates.append(make(update_id, chat_id, payload))
+            update_id += 1
+    return updates
+
+async def started_application(api: FakeBotAPI, db_path: str):
+    app = cb.build_application(cb.SQLitePersistence(db_path), bot_api_url=api.url)
+    await app.initialize()
+    await app.start()
+    return app
+
+async def stop_application(app):
+    await app.stop()
+    await app.shutdown()
+
+async def bench_replay(users: int, workdir: str) -> dict:
+    payloads = synthetic_updates(users)
+    with FakeBotAPI() as api:
+        app = await started_application(api, os.path.join(workdir, "replay.sqlite3"))
+        samples = []
+        started = time.perf_counter()
+        for payload in payloads:
+            update = Update.de_json(payload, app.bot)
+            t = time.perf_counter_ns()
+            await app.process_update(update)
+            samples.append(time.perf_counter_ns() - t)
+        wall = time.perf_counter() - started
+        await stop_application(app)
+        bot_api_calls = dict(api.calls)
+    result = summarize(samples, wall)
+    result["updates"] = len(payloads)
+    result["bot_api_calls"] = bot_api_calls
+    return {"replay.updates": result}
+
+async def bench_replay_concurrent(users: int, workdir: str) -> dict:
+    # Isti update-i, ali kroz update_queue i PerChatUpdateProcessor, kao u produkciji.
+    payloads = synthetic_updates(users)
+    with FakeBotAPI() as api:
+        app = await started_application(api, os.path.join(workdir, "replay_concurrent.sqlite3"))
+        started = time.perf_counter()
+        for payload in payloads:
+            await app.update_queue.put(Update.de_json(payload, app.bot))
+        await app.update_queue.join()
+        if isinstance(app.update_processor, cb.PerChatUpdateProcessor):
+            await app.update_processor.wait_idle()
+        wall = time.perf_counter() - started
+        await stop_application(app)
+    return {"replay.concurrent": {"updates": len(payloads), "seconds": wall, "ops_s": len(payloads) / wall}}
+
+# --- VECERNJI BROADCAST ---
+async def bench_fanout(users: int, workdir: str) -> dict:
+    results = {}
+    today = datetime.now(cb.TZ).date()  # sample_user je u podrazumevanoj zoni
+    for name, staged in (("fanout.daily22", False), ("fanout.prerendered", True)):
+        db_path = os.path.join(workdir, f"{name}.sqlite3")
+        persistence = cb.SQLitePersistence(db_path)
+        persistence.write_rows({
+            chat_id: cb.SQLitePersistence.row_from_chat_data(sample_user(chat_id))
+            for chat_id in range(1, users + 1)
+        })
+        with FakeBotAPI() as api:
+            app = await started_application(api, db_path)
+            prerender_wall = 0.0
+            if staged:
+                # pre-render je van merenja slanja, kao u produkciji (pola sata ranije)
+                started = time.perf_counter()
+                chat_ids = [chat_id for batch in app.persistence.iter_subscribed_chat_ids() for chat_id in batch]
+                await cb.prerender(app, chat_ids, today)
+                prerender_wall = time.perf_counter() - started
+            started = time.perf_counter()
+            stats = await cb.broadcast_daily(app, today, limiter=cb.TokenBucket(rate=1e9))
+            wall = time.perf_counter() - started
+            await stop_application(app)
+        results[name] = {
+            "users": users,
+            "sent": stats.sent,
+            "failed": stats.failed,
+            "seconds": wall,
+            "prerender_seconds": prerender_wall,
+            "ops_s": stats.sent / wall if wall > 0 else 0.0,
+        }
+    return results
+
+# --- RASPORED PO MINUTU ---
+def bench_scheduler(sizes: list, workdir: str, ticks: int = 200) -> dict:
+    # Cena jednog tika (svi primaoci za jedan minut, sve zone) pri rastu broja korisnika.
+    results = {}
+    for n in sizes:
+        persistence = cb.SQLitePersistence(os.path.join(workdir, f"scheduler_{n}.sqlite3"))
+        rows = {}
+        for chat_id in range(1, n + 1):
+            user = sample_user(chat_id)
+            user["timezone"] = BENCH_TIMEZONES[chat_id % len(BENCH_TIMEZONES)]
+            user["delivery_minute"] = 18 * 60 + chat_id % 360  # rasporedjeno izmedju 18:00 i 24:00
+            rows[chat_id] = cb.SQLitePersistence.row_from_chat_data(user)
+        persistence.write_rows(rows)
+        scheduler = cb.DeliveryScheduler(SimpleNamespace(persistence=persistence, chat_data={}))
+        first = int(cb.datetime(2026, 3, 2, 19, 0, tzinfo=cb.TZ).timestamp() // 60)
+        samples, recipients = [], 0
+        started = time.perf_counter()
+        for minute in range(first, first + ticks):
+            t = time.perf_counter_ns()
+            recipients += sum(len(ids) for ids in scheduler.due(minute).values())
+            samples.append(time.perf_counter_ns() - t)
+        results[f"scheduler.tick_{n}"] = {
+            **summarize(samples, time.perf_counter() - started),
+            "per_tick": recipients / ticks,
+        }
+        persistence.conn.close()
+    return results
+
+# --- ISTORIJA CIKLUSA ---
+def bench_history(sizes: list, iterations: int) -> dict:
+    # Novi pocetak + predikcija posle N zabelezenih ciklusa: CycleHistory (tekuce sume)
+    # naspram ponovnog racunanja nad celom istorijom.
+    results = {}
+    for n in sizes:
+        history = cb.CycleHistory()
+        lengths = [26 + i % 6 for i in range(n)]
+        for length in lengths:
+            history.add(length)
+        samples = []
+        started = time.perf_counter()
+        for i in range(iterations):
+            t = time.perf_counter_ns()
+            history.add(26 + i % 6)
+            history.predict()
+            samples.append(time.perf_counter_ns() - t)
+        results[f"history.ring_{n}"] = summarize(samples, time.perf_counter() - started)
+        samples = []
+        started = time.perf_counter()
+        for i in range(min(iterations, 2000)):
+            t = time.perf_counter_ns()
+            lengths[i % n] = 26 + i % 6
+            statistics.fmean(lengths), statistics.variance(lengths), statistics.linear_regression(range(len(lengths)), lengths)
+            samples.append(time.perf_counter_ns() - t)
+        results[f"history.recompute_{n}"] = summarize(samples, time.perf_counter() - started)
+    return results
+
+# --- WRITE-BEHIND PERSISTENCIJA ---
+async def bench_persistence(chats: int, rounds: int, workdir: str) -> dict:
+    # Svaka runda: PTB preda sve chatove, a samo ~10% se stvarno promenilo (mood dugmad).
+    persistence = cb.SQLitePersistence(os.path.join(workdir, "persist.sqlite3"), flush_delay=3600, flush_rows=10**9)
+    profiles = {chat_id: cb.UserProfile(sample_user(chat_id)) for chat_id in range(chats)}
+    counter = lambda name: cb.metrics.counters.get(cb.metrics._key(name, {}), 0)
+    rows_before, bytes_before = counter("persistence_rows_written_total"), counter("persistence_bytes_written_total")
+    samples = []
+    started = time.perf_counter()
+    for r in range(rounds):
+        for chat_id, profile in profiles.items():
+            if r and chat_id % 10 == r % 10:
+                profile["bad_mood_streak"] = r
+            await persistence.update_chat_data(chat_id, profile)
+        t = time.perf_counter_ns()
+        persistence.flush_dirty()
+        samples.append(time.perf_counter_ns() - t)
+    wall = time.perf_counter() - started
+    persistence.conn.close()
+    return {
+        "persist.write_behind": {
+            "updates": chats * rounds,
+            "rows_written": counter("persistence_rows_written_total") - rows_before,
+            "bytes_written": counter("persistence_bytes_written_total") - bytes_before,
+            "flush_p50_us": percentile(samples, 50) / 1000,
+            "seconds": wall,
+        }
+    }
+
+# --- DNEVNIK RASPOLOŽENJA ---
+def bench_journal(events: int, workdir: str, chats: int = 50_000) -> dict:
+    persistence = cb.SQLitePersistence(os.path.join(workdir, "journal.sqlite3"))
+    journal = persistence.journal
+    today = cb.datetime.now(cb.TZ).date()
+    started = time.perf_counter()
+    for i in range(events):
+        day = today - timedelta(days=i % 365)
+        journal.append(i % chats, day, cb.MOOD_KEYS[i % 4], cb.PHASE_NAMES[(i // 4) % 4], 1 + i % 28)
+        if len(journal.pending) >= 50_000:
+            journal.flush()
+    journal.flush()
+    insert_wall = time.perf_counter() - started
+    since = cb.months_back(today, 12)
+    queries = {
+        "all_rollup": lambda i: journal.distribution(since),
+        "one_chat": lambda i: journal.distribution(since, i % chats),
+        "all_scan": lambda i: persistence.conn.execute(
+            "SELECT month, phase, mood, COUNT(*) FROM mood_events WHERE month >= ? GROUP BY month, phase, mood", (since,)
+        ).fetchall(),
+    }
+    results = {"journal.insert": {"updates": events, "seconds": insert_wall, "ops_s": events / insert_wall}}
+    for name, fn in queries.items():
+        runs = 3 if name == "all_scan" else 200
+        samples = []
+        t0 = time.perf_counter()
+        for i in range(runs):
+            t = time.perf_counter_ns()
+            fn(i)
+            samples.append(time.perf_counter_ns() - t)
+        results[f"journal.{name}"] = summarize(samples, time.perf_counter() - t0)
+    persistence.conn.close()
+    return results
+
+# --- MEMORIJA PO KORISNIKU ---
+def measure_profiles(n: int, factory) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    profiles = {chat_id: factory(sample_user(chat_id)) for chat_id in range(n)}
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del profiles
+    return used / n
+
+def bench_memory(sizes: list) -> dict:
+    results = {}
+    for n in sizes:
+        results[f"memory.user_profile_{n}"] = {"bytes_per_user": measure_profiles(n, cb.UserProfile)}
+    results[f"memory.dict_{sizes[0]}"] = {"bytes_per_user": measure_profiles(sizes[0], dict)}
+    return results
+
+# --- IZVESTAJ ---
+def compare(results: dict, baseline: dict) -> list:
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if "p50_us" in current and base.get("p50_us") and current["p50_us"] > base["p50_us"] * REGRESSION_FACTOR:
+            regressions.append(f"{name}: p50 {base['p50_us']:.1f}us -> {current['p50_us']:.1f}us")
+        if base.get("ops_s") and current.get("ops_s", 0) < base["ops_s"] / REGRESSION_FACTOR:
+            regressions.append(f"{name}: {base['ops_s']:.0f}/s -> {current['ops_s']:.0f}/s")
+    return regressions
+
+def print_report(results: dict):
+    for name, r in results.items():
+        parts = []
+        if "p50_us" in r:
+            parts.append(f"p50 {r['p50_us']:9.1f}us  p99 {r['p99_us']:9.1f}us")
+        if "ops_s" in r:
+            parts.append(f"{r['ops_s']:10.0f}/s")
+        if "rows_written" in r:
+            parts.append(f"{r['rows_written']}/{r['updates']} redova, {r['bytes_written'] / 1024:.0f} KiB, flush p50 {r['flush_p50_us']:.0f}us")
+        elif "alloc_bytes" in r:
+            parts.append(f"{r['alloc_bytes']:8.0f} B alocirano/poruka")
+        elif "per_tick" in r:
+            parts.append(f"{r['per_tick']:.0f} primalaca/tik")
+        elif "bytes_per_user" in r:
+            parts.append(f"{r['bytes_per_user']:.0f} B/korisnik")
+        if "sent" in r:
+            parts.append(f"{r['sent']}/{r['users']} u {r['seconds']:.2f}s")
+            if r.get("prerender_seconds"):
+                parts.append(f"(pre-render {r['prerender_seconds']:.2f}s)")
+        elif "seconds" in r and "updates" in r and "rows_written" not in r:
+            parts.append(f"{r['updates']} update-a u {r['seconds']:.2f}s")
+        print(f"{name:32} " + "  ".join(parts))
+    print(f"{'peak RSS':32} {peak_rss_mb():.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark za ciklus bota")
+    parser.add_argument("--only", choices=["micro", "replay", "fanout", "persist", "history", "journal", "memory", "scheduler", "render", "logging"])
+    parser.add_argument("--iterations", type=int, default=20_000)
+    parser.add_argument("--replay-users", type=int, default=200)
+    parser.add_argument("--fanout-users", type=int, default=5_000)
+    parser.add_argument("--persist-chats", type=int, default=10_000)
+    parser.add_argument("--history-sizes", default="10,100,1000,10000")
+    parser.add_argument("--journal-events", type=int, default=1_000_000)
+    parser.add_argument("--memory-sizes", default="100000,1000000")
+    parser.add_argument("--scheduler-sizes", default="10000,100000")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.only in (None, "micro"):
+            results.update(bench_micro(args.iterations))
+        if args.only in (None, "render"):
+            results.update(bench_render(min(args.iterations, 5_000)))
+        if args.only in (None, "logging"):
+            results.update(bench_logging(args.iterations, workdir))
+        if args.only in (None, "replay"):
+            results.update(asyncio.run(bench_replay(args.replay_users, workdir)))
+            results.update(asyncio.run(bench_replay_concurrent(args.replay_users, workdir)))
+        if args.only in (None, "fanout"):
+            results.update(asyncio.run(bench_fanout(args.fanout_users, workdir)))
+        if args.only in (None, "persist"):
+            results.update(asyncio.run(bench_persistence(args.persist_chats, 10, workdir)))
+        if args.only in (None, "history"):
+            results.update(bench_history([int(n) for n in args.history_sizes.split(",")], args.iterations))
+        if args.only in (None, "journal"):
+            results.update(bench_journal(args.journal_events, workdir))
+        if args.only in (None, "memory"):
+            results.update(bench_memory([int(n) for n in args.memory_sizes.split(",")]))
+        if args.only in (None, "scheduler"):
+            results.update(bench_scheduler([int(n) for n in args.scheduler_sizes.split(",")], workdir))
+    results["peak_rss_mb"] = {"value": peak_rss_mb()}
+
+    print_report({k: v for k, v in results.items() if k != "peak_rss_mb"})
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline sacuvan u {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f))
+        if regressions:
+            print("\nREGRESIJE:")
+            for line in regressions:
+                print(f"  {line}")
+            raise SystemExit(1)
+        print("\nNema regresija u odnosu na baseline.")
+
+if __name__ == "__main__":
+    main()
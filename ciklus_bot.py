@@ -1,11 +1,42 @@
+import argparse
+import asyncio
+import atexit
+import bisect
+import csv
+import functools
+import json
 import logging
+import math
 import os
-from datetime import datetime, timedelta, time as dtime
-from zoneinfo import ZoneInfo
+import pickle
+import socket
+import sqlite3
+import string
+import struct
+import sys
+import threading
+import time
+from array import array
+from copy import deepcopy
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from typing import Optional
 import random
-import requests
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import httpx
+import numpy as np
+import tornado.web
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, __version__ as TG_VER
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+# python-telegram-bot je zakucan na ==21.6 (requirements.txt): ClusterUpdateProcessor pre svakog
+# update-a ucitava stanje razgovora iz baze preko internih Application._conversation_handler_conversations
+# i TrackingDict.update_no_track, jer PTB nema javni API za osvezavanje tog stanja. Pre podizanja
+# verzije proveriti taj deo (check_cluster_support pada na startu ako ih vise nema).
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -13,32 +44,173 @@ from telegram.ext import (
     MessageHandler,
     ConversationHandler,
     ContextTypes,
-    PicklePersistence,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     filters,
 )
 
 TZ = ZoneInfo("Europe/Belgrade")
-
-logging.basicConfig(
-    format="%(asctime)s %(name)s %(levelname)s %(message)s",
-    level=logging.INFO,
-)
+DEFAULT_TIMEZONE = TZ.key
+DEFAULT_DELIVERY_MINUTE = 22 * 60  # dnevna poruka u 22:00 po lokalnom vremenu korisnika
+
+# --- LOGOVANJE ---
+# Event loop samo stavi zapis u red (LogQueueHandler); formatiranje i pisanje radi
+# pozadinska nit (QueueListener). Isto upozorenje ponovljeno u LOG_DUPLICATE_WINDOW
+# sekundi se ne ispisuje, vec se broji i prijavi uz sledece ispisano. LOG_FORMAT=json
+# daje jedan JSON objekat po liniji; LOG_QUEUE=0 vraca sinhrono pisanje iz petlje.
+LOG_QUEUE = os.getenv("LOG_QUEUE", "1") == "1"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+LOG_DUPLICATE_WINDOW = float(os.getenv("LOG_DUPLICATE_WINDOW", "60"))
+LOG_TEXT_FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+
+class LogQueueHandler(QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.records = 0
+        self.seconds = 0.0  # vreme provedeno u emit, tj. trosak logovanja za petlju
+
+    def prepare(self, record):
+        # Bez formatiranja ovde (osnovni QueueHandler formatira u pozivaocu); argumenti
+        # poruke se formatiraju tek u niti listener-a, pa ne smeju posle da se menjaju.
+        return record
+
+    def emit(self, record):
+        started = time.perf_counter()
+        super().emit(record)
+        self.records += 1
+        self.seconds += time.perf_counter() - started
+
+class DuplicateFilter(logging.Filter):
+    def __init__(self, window: float = LOG_DUPLICATE_WINDOW, kept: int = 1000):
+        super().__init__()
+        self.window = window
+        self.kept = kept
+        self.suppressed = 0
+        self._seen: OrderedDict = OrderedDict()  # (logger, nivo, poruka) -> [kada ispisana, preskoceno]
+
+    def filter(self, record) -> bool:
+        if record.levelno < logging.WARNING or self.window <= 0:
+            return True
+        key = (record.name, record.levelno, record.getMessage())
+        if record.exc_info and record.exc_info[2] is not None:
+            # ista poruka sa razlicitim izuzecima (npr. "Unhandled error") nije duplikat
+            tb = record.exc_info[2]
+            while tb.tb_next is not None:
+                tb = tb.tb_next
+            key += (record.exc_info[0], tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+        seen = self._seen.get(key)
+        if seen is not None and record.created - seen[0] < self.window:
+            seen[1] += 1
+            self.suppressed += 1
+            return False
+        if seen is not None and seen[1]:
+            record.repeated = seen[1]
+        self._seen[key] = [record.created, 0]
+        self._seen.move_to_end(key)
+        if len(self._seen) > self.kept:
+            self._seen.popitem(last=False)
+        return True
+
+class TextFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        text = super().format(record)
+        repeated = getattr(record, "repeated", 0)
+        return f"{text} (ponovljeno jos {repeated}x)" if repeated else text
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "repeated", 0):
+            entry["repeated"] = record.repeated
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def configure_logging():
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(LOG_TEXT_FORMAT))
+    duplicates = DuplicateFilter()
+    output.addFilter(duplicates)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    # httpx na INFO loguje ceo URL svakog zahteva, a u njemu su WEATHER_API_KEY (appid) i BOT_TOKEN.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if not LOG_QUEUE:
+        root.addHandler(output)
+        return None, duplicates
+    handler = LogQueueHandler(SimpleQueue())
+    listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # na izlazu ispise sve sto je ostalo u redu
+    root.addHandler(handler)
+    return handler, duplicates
+
+log_handler, log_duplicates = configure_logging()
 logger = logging.getLogger(__name__)
 
-TOKEN = os.getenv("BOT_TOKEN")
-if not TOKEN:
-    raise RuntimeError("BOT_TOKEN env variable nije podesena")
+TOKEN = os.getenv("BOT_TOKEN")  # proverava se u build_application; export/import rade i bez njega
 
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
 DEFAULT_CITY = os.getenv("DEFAULT_CITY", "Belgrade,RS")
+WEATHER_URL = os.getenv("WEATHER_URL", "https://api.openweathermap.org/data/2.5/weather")
+WEATHER_TTL = int(os.getenv("WEATHER_TTL", "900"))
+WEATHER_TIMEOUT = float(os.getenv("WEATHER_TIMEOUT", "4"))
+WEATHER_UNKNOWN_TTL = 6 * 3600  # posle toga grad sa 404 probamo ponovo (404 moze biti i privremen)
+WEATHER_UNKNOWN_KEPT = 1000  # grad je slobodan unos korisnika, pa je skup ogranicen
 PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "bot_data.pkl")
+DB_PATH = os.getenv("DB_PATH", "bot_data.sqlite3")
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", "60"))  # koliko cesto PTB predaje izmenjene chatove
+PERSIST_FLUSH_DELAY = float(os.getenv("PERSIST_FLUSH_DELAY", "1"))  # prozor u kome se izmene skupljaju u jedan upis
+PERSIST_FLUSH_ROWS = int(os.getenv("PERSIST_FLUSH_ROWS", "1000"))  # ili ranije, kad se skupi toliko redova
+BOT_API_URL = os.getenv("BOT_API_URL")  # npr. http://127.0.0.1:8081/bot za lokalni fake server
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # ako je podesen, /metrics trazi ?token=...
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+MAX_QUEUED_UPDATES = int(os.getenv("MAX_QUEUED_UPDATES", "256"))  # u redovima + u obradi, vidi PerChatUpdateProcessor
+MAX_QUEUED_PER_CHAT = int(os.getenv("MAX_QUEUED_PER_CHAT", "16"))
+CLUSTER_MODE = os.getenv("CLUSTER_MODE") == "1"  # vise procesa deli DB_PATH, vidi ClusterCoordinator
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}  # chat id-jevi admina
 
 HOROSCOPE_SIGNS = [
     "Ovan", "Bik", "Blizanac", "Rak", "Lav", "Devica",
     "Vaga", "Škorpija", "Strelac", "Jarac", "Vodolija", "Ribe"
 ]
 
-SET_CYCLE_LENGTH, SET_PERIOD_LENGTH, SET_LAST_START, SET_STAR_SIGN = range(4)
+SET_CYCLE_LENGTH, SET_PERIOD_LENGTH, SET_LAST_START, SET_STAR_SIGN, SET_CITY = range(5)
+
+# --- ŠABLONI ---
+# Statican tekst poruka se pri importu jednom razbije na internovane delove; poruka se
+# posle sklapa jednim "".join, bez lanca + i f-stringova koji prave medjurezultate.
+class Template:
+    __slots__ = ("parts", "fields")
+
+    def __init__(self, text: str):
+        parts, fields = [], []
+        for literal, field, _, _ in string.Formatter().parse(text):
+            if literal:
+                parts.append(sys.intern(literal))
+            if field is not None:
+                fields.append((len(parts), field))
+                parts.append("")
+        self.parts = tuple(parts)
+        self.fields = tuple(fields)
+
+    def render(self, **values) -> str:
+        parts = list(self.parts)
+        for i, field in self.fields:
+            parts[i] = values[field]
+        return "".join(parts)
+
+DAY_TEXT = tuple(sys.intern(str(i)) for i in range(100))
+
+def day_text(n: int) -> str:
+    return DAY_TEXT[n] if 0 <= n < len(DAY_TEXT) else str(n)
 
 # === FAZA-SPECIFIČNE MOTIVACIONE PORUKE ===
 LUTEAL_BAD_MOOD_MSGS = [
@@ -104,11 +276,13 @@ HL_PHASE_NUTRITION = {
     ],
 }
 
-def hl_tip_for_phase(phase: str) -> str:
-    tips = HL_PHASE_NUTRITION.get(phase, [])
+HL_PHASE_FALLBACK = "F1 sejk + PDM za protein, Herbalife caj za energiju, vlakna u sejk za stabilnu glad, Omega 3 i vitamini dnevno."
+
+def hl_tip_for_phase(phase: str, rng=random) -> str:
+    tips = HL_PHASE_NUTRITION.get(phase)
     if not tips:
-        return "F1 sejk + PDM za protein, Herbalife caj za energiju, vlakna u sejk za stabilnu glad, Omega 3 i vitamini dnevno."
-    return random.choice(tips)
+        return HL_PHASE_FALLBACK
+    return rng.choice(tips)
 
 # === HERBALIFE SAVETI PO MOOD-U (2–3 proizvoda) ===
 HL_MOOD_TIPS = {
@@ -142,112 +316,106 @@ HL_MOOD_TIPS = {
     ],
 }
 
-def hl_mood_block(mood_key: str, phase: str) -> str:
-    mood_tips = HL_MOOD_TIPS.get(mood_key, [])
-    picks = random.sample(mood_tips, k=min(3, len(mood_tips))) if mood_tips else []
-    phase_tip = hl_tip_for_phase(phase)
-    extra = ""
+HL_MOOD_BULLETS = {mood: tuple(sys.intern(f"• {tip}") for tip in tips) for mood, tips in HL_MOOD_TIPS.items()}
+HL_BLOCK = Template("🥤 <b>Herbalife fokus po raspoloženju:</b>\n{picks}\n\n🧠 <b>Herbalife fokus po fazi:</b> {phase_tip}")
+HL_PHASE_BLOCK = Template("🧠 <b>Herbalife fokus po fazi:</b> {phase_tip}")
+
+def hl_mood_block(mood_key: str, phase: str, rng=random) -> str:
+    bullets = HL_MOOD_BULLETS.get(mood_key)
+    picks = rng.sample(bullets, k=min(3, len(bullets))) if bullets else None
+    phase_tip = hl_tip_for_phase(phase, rng)
     if picks:
-        extra = "🥤 <b>Herbalife fokus po raspoloženju:</b>\n" + "\n".join([f"• {p}" for p in picks])
-    if phase_tip:
-        extra = (extra + "\n\n" if extra else "") + f"🧠 <b>Herbalife fokus po fazi:</b> {phase_tip}"
-    return extra
-
-def hormone_hack_block() -> str:
-    return (
-        "🤬 Nisi bas raspolozena\n\n"
-        "📉 Osecas pad energije i motivacije\n\n"
-        "Da li znas da mozes da hakujes svoj organizam i podignes raspolozenje na visi nivo na kvalitetan nacin 🚀🔥\n\n"
-        "Nase telo je neverovatan sistem koji proizvodi pozitivne hormone, prirodne boostere srece, zadovoljstva i uzivanja.\n\n"
-        "Evo kako mozes da ih aktiviras i preuzmes kontrolu nad svojim osecanjima.\n\n"
-        "Izaberi po jednu stavku uz svaku sekciju hormona i imas najbolji dan ikada 💪😊\n\n"
-        "🔋 DOPAMIN, hormon zadovoljstva\n"
-        "Kvalitetan san 😴 Omiljenu muziku 🎧 Fizicku aktivnost 🏃‍♂️\n\n"
-        "😊 SEROTONIN, hormon srece\n"
-        "Zahvalnost 🙏 Promeni okruzenja 🌿 Ostvarivanju ciljeva 🎯\n\n"
-        "💖 OKSITOCIN, hormon blazenstva\n"
-        "Molitvu ili meditaciju 🧘‍♀️ Velikodusnost 🎁 Grljenje 🤗\n\n"
-        "🎉 ENDORFIN, hormon uzivanja\n"
-        "Smeh 😂 Seks ❤️ Druzenje i ples 💃🕺\n\n"
-        "Nemoj cekati da se osecas bolje, preuzmi stvar u svoje ruke 💥"
-    )
+        return HL_BLOCK.render(picks="\n".join(picks), phase_tip=phase_tip)
+    return HL_PHASE_BLOCK.render(phase_tip=phase_tip)
+
+HORMONE_HACK_BLOCK = sys.intern(
+    "🤬 Nisi bas raspolozena\n\n"
+    "📉 Osecas pad energije i motivacije\n\n"
+    "Da li znas da mozes da hakujes svoj organizam i podignes raspolozenje na visi nivo na kvalitetan nacin 🚀🔥\n\n"
+    "Nase telo je neverovatan sistem koji proizvodi pozitivne hormone, prirodne boostere srece, zadovoljstva i uzivanja.\n\n"
+    "Evo kako mozes da ih aktiviras i preuzmes kontrolu nad svojim osecanjima.\n\n"
+    "Izaberi po jednu stavku uz svaku sekciju hormona i imas najbolji dan ikada 💪😊\n\n"
+    "🔋 DOPAMIN, hormon zadovoljstva\n"
+    "Kvalitetan san 😴 Omiljenu muziku 🎧 Fizicku aktivnost 🏃‍♂️\n\n"
+    "😊 SEROTONIN, hormon srece\n"
+    "Zahvalnost 🙏 Promeni okruzenja 🌿 Ostvarivanju ciljeva 🎯\n\n"
+    "💖 OKSITOCIN, hormon blazenstva\n"
+    "Molitvu ili meditaciju 🧘‍♀️ Velikodusnost 🎁 Grljenje 🤗\n\n"
+    "🎉 ENDORFIN, hormon uzivanja\n"
+    "Smeh 😂 Seks ❤️ Druzenje i ples 💃🕺\n\n"
+    "Nemoj cekati da se osecas bolje, preuzmi stvar u svoje ruke 💥"
+)
 
 # === DNEVNI HOROSKOP ZA KARIJERU I FINANSIJE (30 poruka) ===
-def daily_horoscope(star_sign: Optional[str]) -> str:
-    if not star_sign:
-        return "🔮 Horoskop za karijeru i finansije\nAko želiš dnevni horoskop za posao i novac, podesi znak u Podesi ciklus."
-
-    messages = [
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, danas je dan za pametne poslovne poteze. Fokusiraj se na sistem – jedna dosledna akcija na poslu donosi više nego 10 haotičnih. Drži ritam, rezultati dolaze.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, prilika za napredak ili dodatni prihod je blizu. Ne čekaj savršen trenutak – uradi jedan korak ka boljoj poziciji. Sistem pobeđuje sreću.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, pregledaj budžet i troškove. Mali uštedni potez danas gradi finansijsku slobodu sutra. Bez impulsivnih kupovina – disciplina je tvoja snaga.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, posao zahteva fokus na detalje. Završi obaveze bez odlaganja – jedna stvar manje u glavi znači više energije za velike karijerne ciljeve.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, vreme je za planiranje karijernog napretka. Investiraj u sebe (znanje, veštine) – to donosi najveći finansijski povrat.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, stabilnost je ključ. Izbegavaj rizik, čuvaj rezervu – neočekivane poslovne prilike dolaze onima koji su spremni.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, timski rad ili kontakt sa kolegama donosi korist. Jedan dobar razgovor može otvoriti vrata ka boljoj poziciji ili bonusu.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, novac dolazi kroz doslednost. Drži budžet, ulaži pametno – danas gradiš sigurnu finansijsku budućnost.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, prilika za promenu posla ili dodatni projekat je blizu. Pripremi se – sistem i disciplina pobeđuju konkurenciju.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, fokus na dugoročne ciljeve. Mali korak danas na poslu ili u finansijama vodi ka velikoj promeni za godinu dana.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, danas je dan za pregled prioriteta. Manje buke na poslu, više akcije – završeni zadaci donose mir i bolju zaradu.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, finansijska disciplina je tvoja najveća snaga. Ne troši na nepotrebno – svaki ušteđeni dinar je ulaganje u slobodu.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, posao teče bolje kad imaš jasan plan. Danas napravi listu prioriteta – sistemski pristup donosi brže rezultate.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, prilika za bonus ili povišicu je u detaljima. Obrati pažnju na kvalitet rada – to se uvek isplati.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, danas je dobar dan za štednju. Odloži impulsivnu kupovinu – sutra ćeš biti zahvalna sebi.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, karijerni rast dolazi kroz učenje. Danas uloži vreme u novu veštinu – to je najbolja investicija.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, finansije su stabilnije kad imaš rezervu. Danas dodaj nešto na štedni račun – mali korak, veliki mir.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, poslovni kontakt ili mreža danas može doneti korist. Ne zatvaraj vrata – jedna poruka može promeniti sve.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, danas je dan za završavanje obaveza. Čista glava = više prostora za nove poslovne prilike.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, novac ne dolazi preko noći – dolazi kroz sistem. Drži ritam, rezultati su neizbežni.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, pregledaj stare troškove. Gde curi novac? Danas zatvori tu rupu – to je najbrži način za veću zaradu.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, posao je maraton, ne sprint. Danas održi tempo – doslednost je ono što te izdvaja od drugih.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, finansijska sloboda počinje malim navikama. Danas preskoči kafu van kuće – mali potez, veliki efekat.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, danas je dan za poslovni plan. Zapiši ciljeve za naredni mesec – jasan put vodi do veće zarade.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, prilika za dodatni prihod je u tvom znanju. Danas ponudi uslugu ili ideju – ne čekaj da te neko pita.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, izbegavaj dugove i kredite ako možeš. Danas plati gotovinom – osećaj kontrole je neprocenjiv.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, karijera raste kad ulažeš u sebe. Danas pročitaj članak ili gledaj video o veštini koja ti treba.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, finansije su ogledalo navika. Danas promeni jednu lošu naviku – rezultati dolaze brže nego što misliš.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, posao danas zahteva strpljenje. Ne žuri sa odlukama – pametan potez je bolji od brzog.",
-        f"🔮 Horoskop za karijeru i finansije\nZa {star_sign}, novac koji uštediš danas je novac koji radi za tebe sutra. Drži disciplinu – sloboda je na domaku.",
-    ]
+HOROSCOPE_TEMPLATES = [
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, danas je dan za pametne poslovne poteze. Fokusiraj se na sistem – jedna dosledna akcija na poslu donosi više nego 10 haotičnih. Drži ritam, rezultati dolaze.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, prilika za napredak ili dodatni prihod je blizu. Ne čekaj savršen trenutak – uradi jedan korak ka boljoj poziciji. Sistem pobeđuje sreću.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, pregledaj budžet i troškove. Mali uštedni potez danas gradi finansijsku slobodu sutra. Bez impulsivnih kupovina – disciplina je tvoja snaga.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, posao zahteva fokus na detalje. Završi obaveze bez odlaganja – jedna stvar manje u glavi znači više energije za velike karijerne ciljeve.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, vreme je za planiranje karijernog napretka. Investiraj u sebe (znanje, veštine) – to donosi najveći finansijski povrat.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, stabilnost je ključ. Izbegavaj rizik, čuvaj rezervu – neočekivane poslovne prilike dolaze onima koji su spremni.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, timski rad ili kontakt sa kolegama donosi korist. Jedan dobar razgovor može otvoriti vrata ka boljoj poziciji ili bonusu.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, novac dolazi kroz doslednost. Drži budžet, ulaži pametno – danas gradiš sigurnu finansijsku budućnost.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, prilika za promenu posla ili dodatni projekat je blizu. Pripremi se – sistem i disciplina pobeđuju konkurenciju.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, fokus na dugoročne ciljeve. Mali korak danas na poslu ili u finansijama vodi ka velikoj promeni za godinu dana.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, danas je dan za pregled prioriteta. Manje buke na poslu, više akcije – završeni zadaci donose mir i bolju zaradu.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, finansijska disciplina je tvoja najveća snaga. Ne troši na nepotrebno – svaki ušteđeni dinar je ulaganje u slobodu.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, posao teče bolje kad imaš jasan plan. Danas napravi listu prioriteta – sistemski pristup donosi brže rezultate.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, prilika za bonus ili povišicu je u detaljima. Obrati pažnju na kvalitet rada – to se uvek isplati.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, danas je dobar dan za štednju. Odloži impulsivnu kupovinu – sutra ćeš biti zahvalna sebi.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, karijerni rast dolazi kroz učenje. Danas uloži vreme u novu veštinu – to je najbolja investicija.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, finansije su stabilnije kad imaš rezervu. Danas dodaj nešto na štedni račun – mali korak, veliki mir.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, poslovni kontakt ili mreža danas može doneti korist. Ne zatvaraj vrata – jedna poruka može promeniti sve.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, danas je dan za završavanje obaveza. Čista glava = više prostora za nove poslovne prilike.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, novac ne dolazi preko noći – dolazi kroz sistem. Drži ritam, rezultati su neizbežni.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, pregledaj stare troškove. Gde curi novac? Danas zatvori tu rupu – to je najbrži način za veću zaradu.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, posao je maraton, ne sprint. Danas održi tempo – doslednost je ono što te izdvaja od drugih.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, finansijska sloboda počinje malim navikama. Danas preskoči kafu van kuće – mali potez, veliki efekat.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, danas je dan za poslovni plan. Zapiši ciljeve za naredni mesec – jasan put vodi do veće zarade.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, prilika za dodatni prihod je u tvom znanju. Danas ponudi uslugu ili ideju – ne čekaj da te neko pita.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, izbegavaj dugove i kredite ako možeš. Danas plati gotovinom – osećaj kontrole je neprocenjiv.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, karijera raste kad ulažeš u sebe. Danas pročitaj članak ili gledaj video o veštini koja ti treba.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, finansije su ogledalo navika. Danas promeni jednu lošu naviku – rezultati dolaze brže nego što misliš.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, posao danas zahteva strpljenje. Ne žuri sa odlukama – pametan potez je bolji od brzog.",
+    "🔮 Horoskop za karijeru i finansije\nZa {star_sign}, novac koji uštediš danas je novac koji radi za tebe sutra. Drži disciplinu – sloboda je na domaku.",
+]
+
+HOROSCOPES = tuple(Template(text) for text in HOROSCOPE_TEMPLATES)
+NO_SIGN_HOROSCOPE = "🔮 Horoskop za karijeru i finansije\nAko želiš dnevni horoskop za posao i novac, podesi znak u Podesi ciklus."
 
-    return random.choice(messages)
+def daily_horoscope(star_sign: Optional[str], rng=random) -> str:
+    if not star_sign:
+        return NO_SIGN_HOROSCOPE
+    return rng.choice(HOROSCOPES).render(star_sign=star_sign)
 
 # === Akcioni blokovi po fazama (HTML bold) ===
-def action_block_menstrual() -> str:
-    return (
+ACTION_BLOCKS = {
+    "menstrualna faza": (
         "🛌 <b>Recovery faza – Oporavak</b>\n\n"
         "🏋️ <b>Trening:</b> Šetnja, istezanje ili joga.\n"
         "🥗 <b>Ishrana:</b> Topli obroci /slatki sejkovi, gvožđe, magnezijum, zdrav kofein.\n"
         "🎯 <b>Danas zadatak:</b> Odmor bez griže savesti.\n"
-    )
-
-def action_block_follicular() -> str:
-    return (
+    ),
+    "folikularna faza": (
         "🚀 <b>Build faza – Energija raste</b>\n\n"
         "🏋️ <b>Trening:</b> Snaga ili intenzivan kardio. Guraj malo jače ovih dana.\n"
         "🥗 <b>Ishrana:</b> Protein + UH pre treninga. Jako gorivo = jak rezultat.\n"
         "🎯 <b>Danas zadatak:</b> Uradi trening koji si odlagala.\n"
-    )
-
-def action_block_ovulation() -> str:
-    return (
+    ),
+    "ovulacija": (
         "🔥 <b>Peak faza – Maksimum</b>\n\n"
         "🏋️ <b>Trening:</b> Najjači trening, Snaga ili HIIT.\n"
         "🥗 <b>Ishrana:</b> Dovoljno kalorija i UH posle treninga.\n"
         "🎯 <b>Danas zadatak:</b> Iskoristi energiju, bez odlaganja. AKCIJA!\n"
-    )
-
-def action_block_luteal() -> str:
-    return (
+    ),
+    "luteinska faza": (
         "⚖️ <b>Maintain faza – Održavanje uz pametan pristup</b>\n\n"
         "🏋️ <b>Trening:</b> Lakša snaga, fokus na tehniku. 30–45 min + lagana šetnja.\n"
         "🥗 <b>Ishrana:</b> Protein u svakom obroku, dodaj zdrave masti. Manje brzih UH, Puno vlakana, zdrav kofein.\n"
         "💊 <b>Bonus:</b> Magnezijum uveče, voda češće.\n"
         "🎯 <b>Danas zadatak:</b> Bez grickanja.\n"
-    )
-
-def job_name_daily(chat_id: int) -> str:
-    return f"daily22_{chat_id}"
+    ),
+}
 
 def ensure_user_defaults(context: ContextTypes.DEFAULT_TYPE) -> dict:
     data = context.chat_data
@@ -258,33 +426,276 @@ def ensure_user_defaults(context: ContextTypes.DEFAULT_TYPE) -> dict:
     data.setdefault("seen_start", False)
     data.setdefault("bad_mood_streak", 0)
     data.setdefault("last_mood_date", None)
+    data.setdefault("city", None)
+    data.setdefault("cycle_history", None)
+    data.setdefault("delivery_minute", DEFAULT_DELIVERY_MINUTE)
+    data.setdefault("timezone", DEFAULT_TIMEZONE)
     return data
 
-# --- TASTATURE ---
-def main_menu_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        [
-            [InlineKeyboardButton("📅 Podesi ciklus", callback_data="setup")],
-            [InlineKeyboardButton("📊 Moj ciklus", callback_data="status")],
-            [InlineKeyboardButton("📍 Trenutni dan", callback_data="today")],
-        ]
+# --- PROFIL KORISNIKA ---
+# chat_data svakog chata je UserProfile umesto dict-a: polja su u __slots__, datumi kao
+# ordinali (0 = nema), znak kao indeks u HOROSCOPE_SIGNS (-1 = nema). Spolja se ponasa
+# kao dict, pa handleri i dalje rade user["last_start"], setdefault, get...
+SIGN_INDEX = {sign: i for i, sign in enumerate(HOROSCOPE_SIGNS)}
+
+class UserProfile(MutableMapping):
+    __slots__ = (
+        "cycle_length", "period_length", "last_start_ord", "star_sign_idx",
+        "seen_start", "bad_mood_streak", "last_mood_ord", "city", "history",
+        "delivery_minute", "tz_name", "extra",
+    )
+    FIELDS = (
+        "cycle_length", "period_length", "last_start", "star_sign",
+        "seen_start", "bad_mood_streak", "last_mood_date", "city", "cycle_history",
+        "delivery_minute", "timezone",
     )
 
-def mood_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
+    def __init__(self, data=None):
+        self.cycle_length = 28
+        self.period_length = 5
+        self.last_start_ord = 0
+        self.star_sign_idx = -1
+        self.seen_start = False
+        self.bad_mood_streak = 0
+        self.last_mood_ord = 0
+        self.city = None  # interned, isti grad deli jedan string
+        self.history = None  # CycleHistory, pravi se kod prvog novog pocetka
+        self.delivery_minute = DEFAULT_DELIVERY_MINUTE
+        self.tz_name = DEFAULT_TIMEZONE
+        self.extra = None  # ostali kljucevi, pravi se tek kad zatreba
+        if data:
+            self.update(data)
+
+    def __getitem__(self, key):
+        if key == "last_start":
+            return date.fromordinal(self.last_start_ord) if self.last_start_ord else None
+        if key == "last_mood_date":
+            return date.fromordinal(self.last_mood_ord) if self.last_mood_ord else None
+        if key == "star_sign":
+            return HOROSCOPE_SIGNS[self.star_sign_idx] if self.star_sign_idx >= 0 else None
+        if key == "cycle_history":
+            return self.history
+        if key == "timezone":
+            return self.tz_name
+        if key in ("cycle_length", "period_length", "seen_start", "bad_mood_streak", "city", "delivery_minute"):
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "last_start":
+            self.last_start_ord = value.toordinal() if value else 0
+        elif key == "last_mood_date":
+            self.last_mood_ord = value.toordinal() if value else 0
+        elif key == "star_sign":
+            self.star_sign_idx = SIGN_INDEX.get(value, -1)
+        elif key == "seen_start":
+            self.seen_start = bool(value)
+        elif key == "city":
+            self.city = sys.intern(value) if value else None
+        elif key == "cycle_history":
+            self.history = value
+        elif key == "timezone":
+            self.tz_name = sys.intern(value) if value else DEFAULT_TIMEZONE
+        elif key in ("cycle_length", "period_length", "bad_mood_streak", "delivery_minute"):
+            setattr(self, key, int(value))
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            self[key] = UserProfile()[key]
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        yield from self.FIELDS
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return len(self.FIELDS) + (len(self.extra) if self.extra else 0)
+
+    def __repr__(self) -> str:
+        return f"UserProfile({dict(self)!r})"
+
+    def clear(self):
+        # MutableMapping.clear bi se vrteo u krug, jer polja iz FIELDS nikad ne nestaju.
+        self.__init__()
+
+    def copy(self) -> "UserProfile":
+        clone = UserProfile.__new__(UserProfile)
+        for slot in self.__slots__:
+            setattr(clone, slot, getattr(self, slot))
+        if self.extra is not None:
+            clone.extra = dict(self.extra)
+        if self.history is not None:
+            clone.history = self.history.copy()
+        return clone
+
+    def __deepcopy__(self, memo) -> "UserProfile":
+        # PTB pravi deepcopy pre svakog upisa u persistence; slot polja su nepromenljiva.
+        clone = self.copy()
+        if self.extra is not None:
+            clone.extra = deepcopy(self.extra, memo)
+        return clone
+
+# --- ISTORIJA CIKLUSA ---
+# Poslednjih CYCLE_HISTORY_SIZE duzina ciklusa u prstenastom baferu, uz tekuce sume
+# (Σx, Σx², Σk·x) za prozor. Novi pocetak je O(1): dodaje se nova duzina, najstarija
+# izlazi iz suma, a prosek, varijansa i trend (nagib po ciklusu) se citaju iz suma.
+CYCLE_HISTORY_SIZE = int(os.getenv("CYCLE_HISTORY_SIZE", "12"))
+# Iste granice kao kod podesavanja; duzi razmak je verovatno propusten mesec, ne jedan ciklus.
+CYCLE_MIN_LENGTH, CYCLE_MAX_LENGTH = 20, 45
+PERIOD_MIN_LENGTH, PERIOD_MAX_LENGTH = 2, 10
+MIN_CYCLES_FOR_PREDICTION = 2
+
+class CycleHistory:
+    __slots__ = ("lengths", "count", "n", "s1", "s2", "skx")
+    HEADER = struct.Struct("<IH")
+
+    def __init__(self, size: int = CYCLE_HISTORY_SIZE):
+        self.lengths = array("H", bytes(2 * size))
+        self.count = 0  # ukupno dodatih duzina; indeks k sledece
+        self.n = 0  # koliko ih je trenutno u prozoru
+        self.s1 = 0.0
+        self.s2 = 0.0
+        self.skx = 0.0
+
+    def add(self, length: int) -> bool:
+        if not CYCLE_MIN_LENGTH <= length <= CYCLE_MAX_LENGTH:
+            return False
+        size = len(self.lengths)
+        slot = self.count % size
+        if self.n == size:
+            old = self.lengths[slot]
+            self.s1 -= old
+            self.s2 -= old * old
+            self.skx -= (self.count - size) * old
+        else:
+            self.n += 1
+        self.lengths[slot] = length
+        self.s1 += length
+        self.s2 += length * length
+        self.skx += self.count * length
+        self.count += 1
+        return True
+
+    def add_start(self, previous_start: Optional[date], new_start: date) -> bool:
+        if previous_start is None or new_start <= previous_start:
+            return False
+        return self.add((new_start - previous_start).days)
+
+    @property
+    def mean(self) -> float:
+        return self.s1 / self.n if self.n else 0.0
+
+    @property
+    def variance(self) -> float:
+        if self.n < 2:
+            return 0.0
+        return max(0.0, (self.s2 - self.s1 * self.s1 / self.n) / (self.n - 1))
+
+    @property
+    def slope(self) -> float:
+        # Nagib linearne regresije duzine po rednom broju ciklusa; Σk i Σk² u zatvorenom obliku.
+        n = self.n
+        if n < 3:
+            return 0.0
+        first = self.count - n
+        sk = n * first + n * (n - 1) / 2
+        sk2 = sum_squares(self.count - 1) - sum_squares(first - 1)
+        denominator = n * sk2 - sk * sk
+        return (n * self.skx - sk * self.s1) / denominator if denominator else 0.0
+
+    def predict(self):
+        # Sledeca duzina = prosek + trend do sledeceg ciklusa (najvise ±3 dana) i ~95% interval.
+        if self.n < MIN_CYCLES_FOR_PREDICTION:
+            return None
+        drift = max(-3.0, min(3.0, self.slope * (self.n + 1) / 2))
+        length = max(CYCLE_MIN_LENGTH, min(CYCLE_MAX_LENGTH, round(self.mean + drift)))
+        margin = math.ceil(1.96 * math.sqrt(self.variance)) if self.n >= 3 else 3
+        return length, max(CYCLE_MIN_LENGTH, length - margin), min(CYCLE_MAX_LENGTH, length + margin)
+
+    def ordered(self) -> list:
+        size = len(self.lengths)
+        return [self.lengths[k % size] for k in range(self.count - self.n, self.count)]
+
+    def copy(self) -> "CycleHistory":
+        clone = CycleHistory.__new__(CycleHistory)
+        clone.lengths = array("H", self.lengths)
+        clone.count, clone.n, clone.s1, clone.s2, clone.skx = self.count, self.n, self.s1, self.s2, self.skx
+        return clone
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CycleHistory) and self.count == other.count and self.ordered() == other.ordered()
+
+    def to_bytes(self) -> bytes:
+        return self.HEADER.pack(self.count, self.n) + array("H", self.ordered()).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CycleHistory":
+        count, n = cls.HEADER.unpack_from(data)
+        history = cls()
+        lengths = array("H")
+        lengths.frombytes(data[cls.HEADER.size:])
+        # Ostecen ili rucno izmenjen zapis bi dao negativan count i pogresan nagib u predict().
+        if n != len(lengths) or count < n:
+            raise ValueError(f"neispravna istorija ciklusa: count={count}, n={n}, duzina={len(lengths)}")
+        if not all(CYCLE_MIN_LENGTH <= length <= CYCLE_MAX_LENGTH for length in lengths):
+            raise ValueError(f"duzina ciklusa van {CYCLE_MIN_LENGTH}-{CYCLE_MAX_LENGTH}: {list(lengths)}")
+        # Zapis iz veceg CYCLE_HISTORY_SIZE: ostaju najnovije duzine.
+        lengths = lengths[-len(history.lengths):]
+        history.count = count - len(lengths)
+        for length in lengths:
+            history.add(length)
+        return history
+
+def sum_squares(m: int) -> float:
+    return m * (m + 1) * (2 * m + 1) / 6 if m > 0 else 0.0
+
+def cycle_prediction(user: dict):
+    # (duzina, donja, gornja granica): naucena iz istorije ako je ima dovoljno, inace uneta duzina.
+    history = user.get("cycle_history")
+    predicted = history.predict() if history is not None else None
+    if predicted is not None:
+        # donja granica ne sme pre kraja menstruacije
+        length, low, high = predicted
+        return length, max(low, int(user.get("period_length", 5)) + 1), high
+    cycle = int(user.get("cycle_length", 28))
+    return cycle, cycle, cycle
+
+# --- TASTATURE ---
+# InlineKeyboardMarkup je nepromenljiv, pa se svaka tastatura pravi jednom i deli.
+# Outbox ih cuva po imenu (KEYBOARDS) umesto celog JSON-a tastature.
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("📅 Podesi ciklus", callback_data="setup")],
+        [InlineKeyboardButton("📊 Moj ciklus", callback_data="status")],
+        [InlineKeyboardButton("📍 Trenutni dan", callback_data="today")],
+        [InlineKeyboardButton("🗓 Kalendar", callback_data="kal_0")],
+    ]
+)
+
+MOOD_KEYBOARD = InlineKeyboardMarkup(
+    [
         [
-            [
-                InlineKeyboardButton("🌟 Sjajan", callback_data="mood_sjajan"),
-                InlineKeyboardButton("😐 Onako", callback_data="mood_onako"),
-            ],
-            [
-                InlineKeyboardButton("😣 Težak", callback_data="mood_tezak"),
-                InlineKeyboardButton("🔥 Stresan", callback_data="mood_stresan"),
-            ],
-        ]
-    )
+            InlineKeyboardButton("🌟 Sjajan", callback_data="mood_sjajan"),
+            InlineKeyboardButton("😐 Onako", callback_data="mood_onako"),
+        ],
+        [
+            InlineKeyboardButton("😣 Težak", callback_data="mood_tezak"),
+            InlineKeyboardButton("🔥 Stresan", callback_data="mood_stresan"),
+        ],
+    ]
+)
 
-def sign_keyboard() -> InlineKeyboardMarkup:
+def build_sign_keyboard() -> InlineKeyboardMarkup:
     rows = []
     row = []
     for i, sign in enumerate(HOROSCOPE_SIGNS, start=1):
@@ -297,7 +708,49 @@ def sign_keyboard() -> InlineKeyboardMarkup:
     rows.append([InlineKeyboardButton("Preskoči", callback_data="sign_skip")])
     return InlineKeyboardMarkup(rows)
 
+SIGN_KEYBOARD = build_sign_keyboard()
+
+CALENDAR_MONTHS = 6  # koliko meseci unapred moze da se lista
+
+def build_calendar_keyboard(page: int) -> InlineKeyboardMarkup:
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀", callback_data=f"kal_{page - 1}"))
+    nav.append(InlineKeyboardButton(f"{page + 1}/{CALENDAR_MONTHS}", callback_data=f"kal_{page}"))
+    if page < CALENDAR_MONTHS - 1:
+        nav.append(InlineKeyboardButton("▶", callback_data=f"kal_{page + 1}"))
+    return InlineKeyboardMarkup([nav, [InlineKeyboardButton("📍 Trenutni dan", callback_data="today")]])
+
+CALENDAR_KEYBOARDS = [build_calendar_keyboard(page) for page in range(CALENDAR_MONTHS)]
+KEYBOARDS = {"main": MAIN_MENU_KEYBOARD, "mood": MOOD_KEYBOARD, "sign": SIGN_KEYBOARD}
+KEYBOARDS.update((f"kal_{page}", markup) for page, markup in enumerate(CALENDAR_KEYBOARDS))
+KEYBOARD_NAMES = {id(markup): name for name, markup in KEYBOARDS.items()}
+
+def main_menu_keyboard() -> InlineKeyboardMarkup:
+    return MAIN_MENU_KEYBOARD
+
+def mood_keyboard() -> InlineKeyboardMarkup:
+    return MOOD_KEYBOARD
+
+def sign_keyboard() -> InlineKeyboardMarkup:
+    return SIGN_KEYBOARD
+
 # --- KALKULATORI I UTILITY FUNKCIJE ---
+@functools.lru_cache(maxsize=None)
+def zone(name: Optional[str]) -> ZoneInfo:
+    return ZoneInfo(name) if name else TZ
+
+def known_timezone(name: Optional[str]) -> bool:
+    try:
+        zone(name)
+    except (ValueError, ZoneInfoNotFoundError):
+        return False
+    return True
+
+def user_today(user: dict) -> date:
+    # "Danas" po vremenskoj zoni korisnika, ne servera.
+    return datetime.now(zone(user.get("timezone"))).date()
+
 def parse_date(text: str):
     t = text.strip()
     for fmt in ["%d.%m.%Y", "%d.%m.%Y."]:
@@ -311,7 +764,7 @@ def calc_next_dates(user: dict):
     if not user.get("last_start"):
         return None
     last_start = user["last_start"]
-    cycle = int(user.get("cycle_length", 28))
+    cycle, cycle_low, cycle_high = cycle_prediction(user)
     period_len = int(user.get("period_length", 5))
     next_start = last_start + timedelta(days=cycle)
     fertile_start = last_start + timedelta(days=cycle - 18)
@@ -319,70 +772,781 @@ def calc_next_dates(user: dict):
     period_end = last_start + timedelta(days=period_len)
     return {
         "next_start": next_start,
+        "next_start_earliest": last_start + timedelta(days=cycle_low),
+        "next_start_latest": last_start + timedelta(days=cycle_high),
+        "cycle_length": cycle,
         "fertile_start": fertile_start,
         "fertile_end": fertile_end,
         "period_end": period_end,
     }
 
+# Lokalni datumi u raznim zonama se razlikuju do 2 dana (UTC-12 / UTC+14), pa datum unet
+# kao "danas" posle promene zone (/vreme) moze biti dan-dva u buducnosti; to je 1. dan.
+START_SKEW_DAYS = 2
+
+def ovulation_day(cycle: int, period_len: int) -> int:
+    # Ovulacija je ~14 dana pre sledeceg ciklusa (za 28 dana to je 14. dan), ali najranije
+    # dan posle menstruacije: kod kratkog ciklusa i duge menstruacije (npr. 20 i 7) bi
+    # inace pala u menstruaciju. Radi i nad NumPy nizovima (cycle_state_bulk).
+    return np.maximum(cycle - 14, period_len + 1)
+
 def get_cycle_state_for_today(user: dict):
     if not user.get("last_start"):
         return None, None
-    today = datetime.now(TZ).date()
+    today = user_today(user)
     delta_days = (today - user["last_start"]).days
-    if delta_days < 0:
+    if delta_days < -START_SKEW_DAYS:
         return None, None
+    delta_days = max(delta_days, 0)
     day_of_cycle = delta_days + 1
     period_len = int(user.get("period_length", 5))
+    ovulation = int(ovulation_day(cycle_prediction(user)[0], period_len))
     if day_of_cycle <= period_len:
         phase = "menstrualna faza"
-    elif day_of_cycle <= 13:
+    elif day_of_cycle < ovulation:
         phase = "folikularna faza"
-    elif day_of_cycle == 14:
+    elif day_of_cycle == ovulation:
         phase = "ovulacija"
     else:
         phase = "luteinska faza"
     return day_of_cycle, phase
 
-def fetch_weather_category():
-    if not WEATHER_API_KEY:
+# --- BULK KALKULATOR (NumPy) ---
+# Isto sto rade get_cycle_state_for_today i calc_next_dates, ali za ceo batch korisnika
+# odjednom. Datumi su ordinali (date.toordinal()), 0 znaci da datum nije unet.
+PHASE_NAMES = ("menstrualna faza", "folikularna faza", "ovulacija", "luteinska faza")
+PHASE_NONE = -1
+
+def profiles_to_columns(profiles: list):
+    last_start = np.fromiter(
+        (p["last_start"].toordinal() if p.get("last_start") else 0 for p in profiles),
+        dtype=np.int32, count=len(profiles),
+    )
+    cycle_length = np.fromiter((cycle_prediction(p)[0] for p in profiles), dtype=np.int32, count=len(profiles))
+    period_length = np.fromiter((int(p.get("period_length", 5)) for p in profiles), dtype=np.int32, count=len(profiles))
+    return last_start, cycle_length, period_length
+
+def cycle_state_bulk(last_start, cycle_length, period_length, today: date) -> dict:
+    # today: lokalni datum primalaca (broadcast ih grupise po zoni), nikad datum servera
+    last_start = np.asarray(last_start, dtype=np.int32)
+    cycle_length = np.asarray(cycle_length, dtype=np.int32)
+    period_length = np.asarray(period_length, dtype=np.int32)
+    today_ord = today.toordinal()
+
+    day_of_cycle = today_ord - last_start + 1
+    valid = (last_start > 0) & (day_of_cycle >= 1 - START_SKEW_DAYS)
+    day_of_cycle = np.maximum(day_of_cycle, 1)
+    ovulation = ovulation_day(cycle_length, period_length)
+    phase = np.select(
+        [day_of_cycle <= period_length, day_of_cycle < ovulation, day_of_cycle == ovulation],
+        [0, 1, 2],
+        default=3,
+    ).astype(np.int8)
+    phase[~valid] = PHASE_NONE
+    day_of_cycle[~valid] = 0
+
+    has_start = last_start > 0
+    return {
+        "day_of_cycle": day_of_cycle,
+        "phase": phase,
+        "next_start": np.where(has_start, last_start + cycle_length, 0),
+        "fertile_start": np.where(has_start, last_start + cycle_length - 18, 0),
+        "fertile_end": np.where(has_start, last_start + cycle_length - 12, 0),
+        "period_end": np.where(has_start, last_start + period_length, 0),
+    }
+
+def bulk_state_at(states: dict, i: int):
+    code = int(states["phase"][i])
+    if code == PHASE_NONE:
         return None, None
+    return int(states["day_of_cycle"][i]), PHASE_NAMES[code]
+
+# --- METRIKE ---
+# Prometheus tekstualni format, bez dodatnih zavisnosti. observe/inc su par dict lookup-a
+# i jedan bisect, pa instrumentacija moze stalno da bude ukljucena.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self, prefix: str = "ciklus"):
+        self.prefix = prefix
+        self.histograms: dict = {}
+        self.counters: dict = {}
+        self.gauges: dict = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def set_counter(self, name: str, value: float, **labels):
+        # za brojace koji se vode van Metrics (npr. u logging handler-u), prepisu se pri scrape-u
+        self.counters[self._key(name, labels)] = value
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+            typed = set()
+            for (name, labels), value in sorted(store.items()):
+                full = f"{self.prefix}_{name}"
+                if full not in typed:
+                    lines.append(f"# TYPE {full} {kind}")
+                    typed.add(full)
+                lines.append(f"{full}{self._labels(labels)} {value}")
+        typed = set()
+        for (name, labels), hist in sorted(self.histograms.items()):
+            full = f"{self.prefix}_{name}"
+            if full not in typed:
+                lines.append(f"# TYPE {full} histogram")
+                typed.add(full)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, hist.counts):
+                cumulative += count
+                le = self._labels(labels, f'le="{bound}"')
+                lines.append(f"{full}_bucket{le} {cumulative}")
+            le = self._labels(labels, 'le="+Inf"')
+            lines.append(f"{full}_bucket{le} {hist.count}")
+            lines.append(f"{full}_sum{self._labels(labels)} {hist.sum}")
+            lines.append(f"{full}_count{self._labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# --- PROFILISANJE ---
+# Ukljucuje se sa PROFILE=1 ili admin komandom /profil. Pozadinska nit svakih
+# PROFILE_INTERVAL sekundi uzme stek event loop niti i broji ga u "folded" formatu
+# (flamegraph.pl, speedscope, inferno). Svaki update i job dobija Trace sa vremenom
+# po delovima (weather, render, send, db); ako traje duze od SLOW_UPDATE_SECONDS,
+# cuva se zajedno sa stekovima uzorkovanim dok je on radio.
+PROFILE_ENABLED = os.getenv("PROFILE") == "1"
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "1.0"))
+SLOW_TRACES_KEPT = int(os.getenv("SLOW_TRACES_KEPT", "50"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", ".")
+
+current_trace: ContextVar = ContextVar("current_trace", default=None)
+
+class Trace:
+    __slots__ = ("kind", "name", "at", "started", "elapsed", "spans", "samples")
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.at = datetime.now(TZ)
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        self.spans: dict = {}  # deo -> sekundi
+        self.samples: dict = {}  # folded stek -> broj uzoraka
+
+    def add(self, part: str, seconds: float):
+        self.spans[part] = self.spans.get(part, 0.0) + seconds
+
+    def breakdown(self) -> dict:
+        parts = dict(self.spans)
+        parts["ostalo"] = max(0.0, self.elapsed - sum(self.spans.values()))
+        return parts
+
+    def summary(self) -> str:
+        parts = ", ".join(f"{part} {seconds * 1000:.0f}ms" for part, seconds in self.breakdown().items())
+        return f"{self.kind} {self.name}: {self.elapsed * 1000:.0f}ms ({parts})"
+
+class Span:
+    # with Span("weather"): ... dodaje trajanje tekucem Trace-u; bez profilisanja ne radi nista.
+    __slots__ = ("part", "trace", "started")
+
+    def __init__(self, part: str):
+        self.part = part
+
+    def __enter__(self):
+        self.trace = current_trace.get()
+        if self.trace is not None:
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.part, time.perf_counter() - self.started)
+
+def folded(samples: dict, root: Optional[str] = None) -> str:
+    prefix = f"{root};" if root else ""
+    return "".join(f"{prefix}{stack} {count}\n" for stack, count in sorted(samples.items()))
+
+class Profiler:
+    def __init__(self, interval: float = PROFILE_INTERVAL, threshold: float = SLOW_UPDATE_SECONDS):
+        self.interval = interval
+        self.threshold = threshold
+        self.enabled = False
+        self.samples: dict = {}
+        self.idle = 0  # uzorci dok loop ceka na I/O
+        self.slow: deque = deque(maxlen=SLOW_TRACES_KEPT)
+        self.active: dict = {}  # id(frame-a run_traced) -> Trace
+        self._labels: dict = {}
+        self._ident: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Nit za uzorkovanje dodaje kljuceve u samples i trace.samples; citaoci iz
+        # event loop-a rade samo nad kopijom uzetom pod ovim lock-om (snapshot).
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.enabled:
+            return
+        self._ident = threading.get_ident()  # zove se iz event loop niti
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+        self._thread.start()
+        self.enabled = True
+        logger.info(
+            "Profilisanje ukljuceno (uzorak na %.0fms, sporo od %.2fs)", self.interval * 1000, self.threshold
+        )
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._stop.set()
+        self._thread.join()
+        logger.info("Profilisanje iskljuceno")
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.idle = 0
+        self.slow.clear()
+
+    def snapshot(self, trace: Optional[Trace] = None) -> dict:
+        with self.lock:
+            return dict(trace.samples if trace is not None else self.samples)
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._ident)
+            if frame is None:
+                continue
+            if frame.f_code.co_name == "select" and frame.f_code.co_filename.endswith("selectors.py"):
+                self.idle += 1
+                continue
+            stack, trace = [], None
+            while frame is not None:
+                if trace is None and frame.f_code is TRACED_CODE:
+                    trace = self.active.get(id(frame))
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            with self.lock:
+                self.samples[key] = self.samples.get(key, 0) + 1
+                if trace is not None:
+                    trace.samples[key] = trace.samples.get(key, 0) + 1
+
+    async def run_traced(self, kind: str, name: str, coroutine):
+        trace = Trace(kind, name)
+        token = current_trace.set(trace)
+        frame_id = id(sys._getframe())
+        self.active[frame_id] = trace
+        try:
+            return await coroutine
+        finally:
+            self.active.pop(frame_id, None)
+            current_trace.reset(token)
+            trace.elapsed = time.perf_counter() - trace.started
+            if trace.elapsed >= self.threshold:
+                self.slow.append(trace)
+                metrics.inc("slow_traces_total", kind=kind)
+                logger.warning("Sporo: %s", trace.summary())
+
+    def dump(self, directory: str = PROFILE_DIR) -> str:
+        path = os.path.join(directory, f"profil-{datetime.now(TZ):%Y%m%d-%H%M%S}.folded")
+        with open(path, "w") as f:
+            f.write(folded(self.snapshot()))
+        return path
+
+    def slow_folded(self) -> str:
+        return "".join(folded(self.snapshot(trace), f"{trace.kind} {trace.name}") for trace in list(self.slow))
+
+TRACED_CODE = Profiler.run_traced.__code__
+profiler = Profiler()
+
+def update_label(update: object) -> str:
+    # bez teksta poruke: u tragu ostaje samo komanda ili callback
+    if isinstance(update, Update):
+        if update.callback_query is not None:
+            return f"callback:{update.callback_query.data}"
+        message = update.effective_message
+        if message is not None and message.text and message.text.startswith("/"):
+            return f"komanda:{message.text.split()[0]}"
+        return "poruka"
+    return type(update).__name__
+
+async def timed_call(callback, name: str, args, kwargs):
+    started = time.perf_counter()
     try:
-        url = (
-            "https://api.openweathermap.org/data/2.5/weather"
-            f"?q={DEFAULT_CITY}&appid={WEATHER_API_KEY}&units=metric&lang=sr"
+        return await callback(*args, **kwargs)
+    except Exception as e:
+        metrics.inc("handler_errors_total", handler=name, type=type(e).__name__)
+        raise
+    finally:
+        metrics.observe("handler_seconds", time.perf_counter() - started, handler=name)
+
+def timed(callback, name: Optional[str] = None):
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        if profiler.enabled and current_trace.get() is None:
+            # handler van PerChatUpdateProcessor-a, ili job
+            kind = "update" if args and isinstance(args[0], Update) else "job"
+            return await profiler.run_traced(kind, name, timed_call(callback, name, args, kwargs))
+        return await timed_call(callback, name, args, kwargs)
+
+    return wrapper
+
+def instrument_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        else:
+            handler.callback = timed(handler.callback)
+
+HTTP_ERROR_TYPES = {400: "BadRequest", 401: "InvalidToken", 403: "Forbidden", 404: "InvalidToken", 409: "Conflict", 429: "RetryAfter"}
+
+class InstrumentedRequest(HTTPXRequest):
+    # Svaki poziv Bot API-ja: latencija po metodi i greske po tipu (kao sto bi ih PTB podigao).
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            with Span("send"):
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+        except TelegramError as e:
+            metrics.inc("telegram_api_errors_total", method=api_method, type=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("telegram_api_seconds", time.perf_counter() - started, method=api_method)
+        if code >= 400:
+            error_type = HTTP_ERROR_TYPES.get(code, "NetworkError" if code >= 500 else f"HTTP{code}")
+            metrics.inc("telegram_api_errors_total", method=api_method, type=error_type)
+        return code, payload
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        if METRICS_TOKEN and self.get_query_argument("token", None) != METRICS_TOKEN:
+            self.set_status(403)
+            return
+        metrics.set_gauge("fragment_cache_entries", len(fragments))
+        metrics.set_gauge("weather_breaker_open", int(weather.breaker.state == "open"))
+        metrics.set_gauge("weather_cities_cached", len(weather._cache))
+        metrics.set_counter("log_suppressed_total", log_duplicates.suppressed)
+        if log_handler is not None:
+            metrics.set_gauge("log_queue_depth", log_handler.queue.qsize())
+            metrics.set_counter("log_records_total", log_handler.records)
+            metrics.set_counter("log_emit_seconds_total", log_handler.seconds)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+def attach_metrics_route(application) -> bool:
+    # run_webhook ne nudi dodavanje ruta, pa se kacimo na vec pokrenut tornado app preko
+    # internih atributa PTB-a (Updater._httpd._http_server.request_callback). Zato je
+    # python-telegram-bot zakucan na 21.6; ako ih nova verzija nema, to se jasno javlja.
+    updater = application.updater
+    if updater is None or getattr(updater, "_httpd", False) is None:
+        logger.warning("Ne mogu da dodam /metrics, webhook server nije pokrenut")
+        return False
+    httpd = getattr(updater, "_httpd", None)
+    web_app = getattr(getattr(httpd, "_http_server", None), "request_callback", None)
+    if not isinstance(web_app, tornado.web.Application):
+        logger.error(
+            "Ne mogu da dodam /metrics: python-telegram-bot %s nema Updater._httpd._http_server "
+            "(ruta trazi interni API verzije 21.6)",
+            TG_VER,
         )
-        resp = requests.get(url, timeout=6)
-        data = resp.json()
-        if "weather" not in data or not data["weather"]:
+        return False
+    web_app.add_handlers(r".*", [(r"/metrics", MetricsHandler)])
+    logger.info("Metrike dostupne na /metrics")
+    return True
+
+async def attach_metrics_job(context: ContextTypes.DEFAULT_TYPE):
+    attach_metrics_route(context.application)
+
+# --- KONKURENTNA OBRADA UPDATE-A ---
+# Razliciti chatovi se obradjuju paralelno, a update-i istog chata strogo redom
+# (ConversationHandler stanja, update_streak). Svaki chat ima svoj red i jednog radnika;
+# do_process_update ceka da radnik obradi bas taj update, pa PTB-ov semafor i
+# update_queue.join() (a time i Application.stop) pokrivaju i cekanje u redu i obradu.
+# PTB-ov limit (max_queued) je zato ukupan broj update-a u redovima i u obradi; koliko
+# handlera istovremeno radi ogranicava _slots, a jedan chat ne moze da drzi vise od
+# max_per_chat mesta, pa spor ili spamerski chat ne zauzima tudje mesto.
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(
+        self,
+        max_concurrent_updates: int = MAX_CONCURRENT_UPDATES,
+        max_queued: int = MAX_QUEUED_UPDATES,
+        max_per_chat: int = MAX_QUEUED_PER_CHAT,
+    ):
+        super().__init__(max(max_queued, max_concurrent_updates))
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self.max_per_chat = max_per_chat
+        self._queues: dict = {}  # chat -> deque[(enqueued_at, coroutine, future, oznaka za profiler)]
+        self._workers: dict = {}  # chat -> asyncio.Task
+        self.pending = 0
+        self.in_flight = 0
+
+    @staticmethod
+    def chat_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return ("user", update.effective_user.id)
+        return None
+
+    def _report(self):
+        metrics.set_gauge("updates_pending", self.pending)
+        metrics.set_gauge("updates_in_flight", self.in_flight)
+        metrics.set_gauge("update_chats_queued", len(self._queues))
+
+    async def _run(self, coroutine, label: Optional[str] = None):
+        # Omotac za profiler se pravi tek ovde, neposredno pre await-a: korutina koja je
+        # zatvorena pre pokretanja (odbacena, otkazana) tako se zatvara bez omotaca.
+        if label is not None:
+            coroutine = profiler.run_traced("update", label, coroutine)
+        async with self._slots:
+            self.in_flight += 1
+            self._report()
+            try:
+                await coroutine
+            finally:
+                self.in_flight -= 1
+                self._report()
+
+    async def _drain(self, key):
+        # Update ostaje na celu reda dok se obradjuje, pa len(queue) broji i njega.
+        queue = self._queues[key]
+        try:
+            while queue:
+                enqueued_at, coroutine, done, label = queue[0]
+                self.pending -= 1
+                try:
+                    await self._handle(key, enqueued_at, coroutine, done, label)
+                finally:
+                    queue.popleft()
+        finally:
+            # Radnik otkazan usred reda: ostali pozivaoci ne smeju da cekaju zauvek.
+            while queue:
+                _, coroutine, done, _ = queue.popleft()
+                self.pending -= 1
+                coroutine.close()
+                done.cancel()
+            self._queues.pop(key, None)
+            self._workers.pop(key, None)
+            self._report()
+
+    async def _handle(self, key, enqueued_at: float, coroutine, done: asyncio.Future, label: Optional[str]):
+        if done.done():
+            # pozivalac je otkazan pre nego sto je update dosao na red
+            coroutine.close()
+            return
+        metrics.observe("update_queue_wait_seconds", time.perf_counter() - enqueued_at)
+        try:
+            await self._process(key, coroutine, label)
+        except asyncio.CancelledError:
+            done.cancel()
+            raise
+        except Exception as e:
+            if not done.done():
+                done.set_exception(e)
+        else:
+            if not done.done():
+                done.set_result(None)
+
+    async def _process(self, key, coroutine, label: Optional[str] = None):
+        await self._run(coroutine, label)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self.chat_key(update)
+        queue = self._queues.get(key) if key is not None else None
+        if queue is not None and len(queue) >= self.max_per_chat:
+            # Chat salje brze nego sto ga obradjujemo; odbacujemo, umesto da zauzme ceo PTB limit.
+            coroutine.close()
+            metrics.inc("updates_dropped_total")
+            logger.warning("Red za chat %s je pun (%s), update odbacen", key, self.max_per_chat)
+            return
+        label = update_label(update) if profiler.enabled else None
+        if key is None:
+            await self._run(coroutine, label)
+            return
+        done = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append((time.perf_counter(), coroutine, done, label))
+        self.pending += 1
+        self._report()
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._drain(key))
+        await done
+
+    async def wait_idle(self):
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    async def initialize(self) -> None:
+        return
+
+    async def shutdown(self) -> None:
+        # Posle Application.stop() redovi su vec prazni; ovo je samo osigurac.
+        await self.wait_idle()
+
+# --- VREME ---
+# Handleri nikad ne cekaju OpenWeatherMap: citaju poslednju dobru vrednost iz kesa,
+# a osvezavanje ide u pozadini preko zajednickog (pooled) httpx klijenta.
+# Kes i zahtevi su po gradu: istovremeni zahtevi za isti grad dele jedan upit
+# (single-flight), pa broj poziva raste sa brojem razlicitih gradova, ne korisnika.
+def normalize_city(text: Optional[str]) -> Optional[str]:
+    city = " ".join((text or "").split())[:60]
+    if not city or city.lower() in ("-", "preskoci", "preskoči"):
+        return None
+    return city.title()
+
+def user_city(user: dict) -> str:
+    return user.get("city") or DEFAULT_CITY
+
+def classify_weather(data: dict):
+    if "weather" not in data or not data["weather"]:
+        return None, None
+    main = data["weather"][0]["main"].lower()
+    desc = data["weather"][0].get("description", "")
+    if "rain" in main or "drizzle" in main or "thunder" in main or "snow" in main:
+        return "kisovito", desc
+    if "clear" in main:
+        return "suncano", desc
+    return "oblacno", desc
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 3, reset_after: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+class WeatherClient:
+    def __init__(
+        self,
+        api_key: Optional[str],
+        url: str = WEATHER_URL,
+        ttl: float = WEATHER_TTL,
+        timeout: float = WEATHER_TIMEOUT,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.api_key = api_key
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._cache: dict = {}  # city -> (fetched_at, category, description)
+        self._refreshing: dict = {}  # city -> asyncio.Task
+        self.unknown: OrderedDict = OrderedDict()  # grad za koji API vraca 404 -> do kada ga preskacemo
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            )
+
+    async def close(self):
+        for task in list(self._refreshing.values()):
+            task.cancel()
+        self._refreshing.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _fetch(self, city: str):
+        await self.start()
+        params = {"q": city, "appid": self.api_key, "units": "metric", "lang": "sr"}
+        resp = await self._client.get(self.url, params=params)
+        resp.raise_for_status()
+        return classify_weather(resp.json())
+
+    async def refresh(self, city: str = DEFAULT_CITY):
+        if not self.api_key or not self.breaker.allow():
+            return self.cached(city)
+        started = time.perf_counter()
+        try:
+            category, desc = await self._fetch(city)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                self.breaker.record_failure()
+                metrics.inc("weather_fetch_errors_total", type=type(e).__name__)
+                # %-argumenti umesto f-stringa: na vrucim putanjama poruku formatira nit za logovanje
+                # samo status: poruka HTTPStatusError sadrzi URL, a u njemu je appid
+                logger.warning(
+                    "Greska pri citanju vremena za %s: HTTP %s (breaker %s)", city, e.response.status_code, self.breaker.state
+                )
+                return self.cached(city)
+            # Nepostojeci grad je greska korisnika, ne API-ja: ne otvara breaker.
+            metrics.inc("weather_fetch_errors_total", type="CityNotFound")
+            self.unknown[city] = time.monotonic() + WEATHER_UNKNOWN_TTL
+            self.unknown.move_to_end(city)
+            if len(self.unknown) > WEATHER_UNKNOWN_KEPT:
+                self.unknown.popitem(last=False)
             return None, None
-        main = data["weather"][0]["main"].lower()
-        desc = data["weather"][0].get("description", "")
-        if "rain" in main or "drizzle" in main or "thunder" in main or "snow" in main:
-            return "kisovito", desc
-        if "clear" in main:
-            return "suncano", desc
-        return "oblacno", desc
-    except Exception as e:
-        logger.warning(f"Greska pri citanju vremena {e}")
+        except Exception as e:
+            self.breaker.record_failure()
+            metrics.inc("weather_fetch_errors_total", type=type(e).__name__)
+            logger.warning("Greska pri citanju vremena za %s: %r (breaker %s)", city, e, self.breaker.state)
+            return self.cached(city)
+        finally:
+            metrics.observe("weather_fetch_seconds", time.perf_counter() - started)
+        self.breaker.record_success()
+        self.unknown.pop(city, None)
+        self._cache[city] = (time.monotonic(), category, desc)
+        return category, desc
+
+    def is_unknown(self, city: str) -> bool:
+        expires = self.unknown.get(city)
+        if expires is None:
+            return False
+        if time.monotonic() >= expires:
+            del self.unknown[city]
+            return False
+        return True
+
+    def cached(self, city: str = DEFAULT_CITY):
+        entry = self._cache.get(city)
+        if entry is None:
+            return None, None
+        return entry[1], entry[2]
+
+    def is_fresh(self, city: str = DEFAULT_CITY) -> bool:
+        entry = self._cache.get(city)
+        return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    def _inflight(self, city: str) -> asyncio.Task:
+        task = self._refreshing.get(city)
+        if task is not None:
+            metrics.inc("weather_singleflight_joins_total")
+            return task
+        task = asyncio.get_running_loop().create_task(self.refresh(city))
+        self._refreshing[city] = task
+        task.add_done_callback(lambda _t, c=city: self._refreshing.pop(c, None))
+        return task
+
+    async def fetch(self, city: str = DEFAULT_CITY):
+        # Ceka svez podatak; ako je upit za isti grad vec u toku, prikljucuje mu se.
+        if self.is_unknown(city) or not self.api_key or not self.breaker.allow():
+            return self.cached(city)
+        with Span("weather"):
+            return await asyncio.shield(self._inflight(city))
+
+    def refresh_in_background(self, city: str = DEFAULT_CITY):
+        if city in self._refreshing or self.is_unknown(city) or not self.api_key or not self.breaker.allow():
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._inflight(city)
+
+    async def prefetch(self, cities) -> int:
+        stale = {city for city in cities if not self.is_unknown(city) and not self.is_fresh(city)}
+        if stale:
+            await asyncio.gather(*(self.fetch(city) for city in stale))
+        return len(stale)
+
+    def get(self, city: str = DEFAULT_CITY):
+        # Stale-while-revalidate: uvek odmah vrati ono sto imamo, osvezi ako je zastarelo.
+        if self.is_fresh(city):
+            metrics.inc("weather_cache_total", result="hit")
+        else:
+            metrics.inc("weather_cache_total", result="stale" if city in self._cache else "miss")
+            self.refresh_in_background(city)
+        return self.cached(city)
+
+weather = WeatherClient(WEATHER_API_KEY)
+
+def fetch_weather_category(city: str = DEFAULT_CITY):
+    if not WEATHER_API_KEY:
         return None, None
+    return weather.get(city)
+
+WEATHER_PARTS = {
+    "suncano": "☀️ Vremenski utisak\nSunce cesto podigne energiju, ali ne znaci da moras da guras na maksimum.\n\n",
+    "kisovito": "🌧️ Vremenski utisak\nKisni dan ume da spusti raspoloženje i fokus, normalno je ako si usporenija.\n\n",
+    "oblacno": "☁️ Vremenski utisak\nOblacno cesto donese tihi umor, prilagodi tempo, bez drame.\n\n",
+}
 
 def weather_part(weather_cat: Optional[str]) -> str:
-    if weather_cat == "suncano":
-        return "☀️ Vremenski utisak\nSunce cesto podigne energiju, ali ne znaci da moras da guras na maksimum.\n\n"
-    if weather_cat == "kisovito":
-        return "🌧️ Vremenski utisak\nKisni dan ume da spusti raspoloženje i fokus, normalno je ako si usporenija.\n\n"
-    if weather_cat == "oblacno":
-        return "☁️ Vremenski utisak\nOblacno cesto donese tihi umor, prilagodi tempo, bez drame.\n\n"
-    return ""
+    return WEATHER_PARTS.get(weather_cat, "")
+
+PHASE_PARTS = {
+    "menstrualna faza": "🩸 Menstrualna faza\nMoguci su grcevi, pad energije, veca osetljivost, spusti gas bez krivice.\n\n",
+    "folikularna faza": "🌱 Folikularna faza\nEnergija cesto raste, lakse se uvodi rutina i pokret.\n\n",
+    "ovulacija": "💛 Ovulacija\nCesto peak faza, vise energije i samopouzdanja, dobar dan za akciju.\n\n",
+    "luteinska faza": "🌙 Luteinska faza\nCesce su natecenost, promena raspolozenja i veca glad, hormoni rade svoje.\n\n",
+}
+PHASE_TITLES = {phase: sys.intern(phase.capitalize()) for phase in PHASE_PARTS}
 
 def phase_part(phase: str) -> str:
-    if "menstrualna" in phase:
-        return "🩸 Menstrualna faza\nMoguci su grcevi, pad energije, veca osetljivost, spusti gas bez krivice.\n\n"
-    if "folikularna" in phase:
-        return "🌱 Folikularna faza\nEnergija cesto raste, lakse se uvodi rutina i pokret.\n\n"
-    if "ovulacija" in phase:
-        return "💛 Ovulacija\nCesto peak faza, vise energije i samopouzdanja, dobar dan za akciju.\n\n"
-    return "🌙 Luteinska faza\nCesce su natecenost, promena raspolozenja i veca glad, hormoni rade svoje.\n\n"
+    return PHASE_PARTS.get(phase) or PHASE_PARTS["luteinska faza"]
 
 def streak_prefix(user: dict) -> str:
     streak = user.get("bad_mood_streak", 0)
@@ -392,80 +1556,155 @@ def streak_prefix(user: dict) -> str:
         return "⚠️ Drugi dan zaredom teži dan.\nNormalno je. Danas igramo pametno, ne herojski.\n\n"
     return ""
 
-def build_today_overview(user: dict) -> str:
-    day_of_cycle, phase = get_cycle_state_for_today(user)
-    if day_of_cycle is None:
-        return "Nemam datum poslednje menstruacije.\nUdji na Podesi ciklus i unesi datum."
-    weather_cat, _ = fetch_weather_category()
-    star_sign = user.get("star_sign")
-    prefix = streak_prefix(user)
-    if "menstrualna" in phase:
-        action_block = action_block_menstrual()
-    elif "folikularna" in phase:
-        action_block = action_block_follicular()
-    elif "ovulacija" in phase:
-        action_block = action_block_ovulation()
-    else:
-        action_block = action_block_luteal()
-
-    hl_block = hl_mood_block("onako", phase)
-
-    return (
-        f"📍 Danas je {day_of_cycle}. dan ciklusa – <b>{phase.capitalize()}</b>\n\n"
-        f"{prefix}"
-        f"{weather_part(weather_cat)}"
-        f"{phase_part(phase)}"
-        f"{daily_horoscope(star_sign)}\n\n"
-        f"{action_block}\n\n"
-        f"{hl_block}\n\n"
-        "🤍 Tvoj ekskluzivni dnevni recept za transformaciju – prilagođen samo tebi i tvom ciklusu.\n"
-        "Transformations nije samo trening. To je sinhronizacija sa sobom."
-    )
+def action_block_for_phase(phase: str) -> str:
+    return ACTION_BLOCKS.get(phase) or ACTION_BLOCKS["luteinska faza"]
+
+# --- KEŠ FRAGMENATA ---
+# Deo poruke posle zaglavlja zavisi samo od (faza, znak, vreme, mood) i varijante dana,
+# pa ga za taj dan renderujemo jednom. Varijanta je deterministicka po (chat, datum),
+# tako da isti chat isti dan uvek dobija isti tekst. Datum je lokalni datum primaoca
+# (korisnici su u raznim zonama), pa je kes podeljen po danu; dani stariji od
+# FRAGMENT_DAYS_KEPT od najnovijeg se brisu.
+FRAGMENT_VARIANTS = int(os.getenv("FRAGMENT_VARIANTS", "8"))
+FRAGMENT_DAYS_KEPT = 3  # od UTC-12 do UTC+14 istovremeno vaze najvise tri datuma
+
+class FragmentCache:
+    def __init__(self):
+        self._days: dict = {}  # ordinal lokalnog datuma -> {kljuc: tekst}
+        self.hits = 0
+        self.misses = 0
+
+    def _store_for(self, day: date) -> dict:
+        ordinal = day.toordinal()
+        store = self._days.get(ordinal)
+        if store is None:
+            store = self._days[ordinal] = {}
+            newest = max(self._days)
+            for old in [d for d in self._days if d <= newest - FRAGMENT_DAYS_KEPT]:
+                del self._days[old]
+        return store
+
+    def get(self, day: date, key: tuple, build):
+        store = self._store_for(day)
+        value = store.get(key)
+        if value is None:
+            self.misses += 1
+            # seme sadrzi i datum, inace bi svaka varijanta imala isti tekst svaki dan
+            value = store[key] = build(random.Random(repr((day.toordinal(), key))))
+        else:
+            self.hits += 1
+        return value
 
-def build_mood_message(user: dict, mood_key: str) -> str:
-    day_of_cycle, phase = get_cycle_state_for_today(user)
-    weather_cat, _ = fetch_weather_category()
-    prefix = streak_prefix(user)
-    header = (
-        f"🧠 Tvoj feedback za danas\nDanas je {day_of_cycle}. dan ciklusa – <b>{phase.capitalize()}</b>\n\n"
-        f"{prefix}"
-        f"{weather_part(weather_cat)}"
-        f"{phase_part(phase)}"
-        f"{daily_horoscope(user.get('star_sign'))}\n\n"
-    )
+    def __len__(self) -> int:
+        return sum(len(store) for store in self._days.values())
 
-    if "menstrualna" in phase:
-        action_block = action_block_menstrual()
-    elif "folikularna" in phase:
-        action_block = action_block_follicular()
-    elif "ovulacija" in phase:
-        action_block = action_block_ovulation()
-    else:
-        action_block = action_block_luteal()
+fragments = FragmentCache()
 
-    hl_block = hl_mood_block(mood_key, phase)
+def daily_variant(chat_id: Optional[int], day: date) -> int:
+    if chat_id is None:
+        return random.randrange(FRAGMENT_VARIANTS)
+    return hash((chat_id, day.toordinal())) % FRAGMENT_VARIANTS
+
+TODAY_BODY = Template(
+    "{weather}{phase}{horoscope}\n\n{action}\n\n{hl}\n\n"
+    "🤍 Tvoj ekskluzivni dnevni recept za transformaciju – prilagođen samo tebi i tvom ciklusu.\n"
+    "Transformations nije samo trening. To je sinhronizacija sa sobom."
+)
+MOOD_THANKS = "\n\n🤍 Hvala ti sto si prijavila dan."
+MOOD_BODIES = {
+    "sjajan": Template(
+        "{weather}{phase}{horoscope}\n\n"
+        "🌟 Sjajan dan\nBravo. Zapamti sta je radilo i ponovi sutra – hormoni su ti saveznici danas."
+        "\n\n{action}\n\n{hl}" + MOOD_THANKS
+    ),
+    "onako": Template("{weather}{phase}{horoscope}\n\n{feedback}\n\n✅ Mali plus za kraj dana\n{hl}\n\n{action}" + MOOD_THANKS),
+    # tezak, stresan; HORMONE_HACK_BLOCK je deo sablona, ne gradi se po pritisku
+    None: Template(
+        "{weather}{phase}{horoscope}\n\n{action}\n\n{feedback}\n\n💥 Brzi reset\n{hl}\n\n"
+        + HORMONE_HACK_BLOCK.replace("{", "{{").replace("}", "}}") + MOOD_THANKS
+    ),
+}
+OKAY_FEEDBACK = {"luteinska faza": LUTEAL_OKAY_MOOD_MSGS, "folikularna faza": FOLIKULAR_OKAY_MOOD_MSGS}
+OKAY_FEEDBACK_DEFAULT = ("Dobar posao što držiš stabilnost.",)
+BAD_FEEDBACK = {
+    "luteinska faza": LUTEAL_BAD_MOOD_MSGS,
+    "folikularna faza": FOLIKULAR_BAD_MOOD_MSGS,
+    "ovulacija": OVULATION_BAD_MOOD_MSGS,
+}
+TODAY_HEADER = Template("📍 Danas je {day}. dan ciklusa – <b>{phase}</b>\n\n{streak}{body}")
+MOOD_HEADER = Template("🧠 Tvoj feedback za danas\nDanas je {day}. dan ciklusa – <b>{phase}</b>\n\n{streak}{body}")
+NO_LAST_START = "Nemam datum poslednje menstruacije.\nUdji na Podesi ciklus i unesi datum."
+FUTURE_LAST_START = "Datum poslednje menstruacije je u budućnosti.\nUdji na Podesi ciklus i unesi ispravan datum."
+
+def no_state_text(user: dict) -> str:
+    # tekst kad get_cycle_state_for_today ne da stanje
+    return FUTURE_LAST_START if user.get("last_start") else NO_LAST_START
+
+def render_today_body(phase: str, star_sign: Optional[str], weather_cat: Optional[str], rng) -> str:
+    horoscope = daily_horoscope(star_sign, rng)
+    return TODAY_BODY.render(
+        weather=weather_part(weather_cat),
+        phase=phase_part(phase),
+        horoscope=horoscope,
+        action=action_block_for_phase(phase),
+        hl=hl_mood_block("onako", phase, rng),
+    )
 
+def render_mood_body(phase: str, star_sign: Optional[str], weather_cat: Optional[str], mood_key: str, rng) -> str:
+    # Redosled poziva rng-a (horoskop, Herbalife, feedback) odredjuje varijantu dana; ne menjati.
+    horoscope = daily_horoscope(star_sign, rng)
+    hl_block = hl_mood_block(mood_key, phase, rng)
     if mood_key == "sjajan":
-        feedback = "🌟 Sjajan dan\nBravo. Zapamti sta je radilo i ponovi sutra – hormoni su ti saveznici danas."
-        return header + feedback + f"\n\n{action_block}\n\n{hl_block}" + "\n\n🤍 Hvala ti sto si prijavila dan."
+        feedback = None
     elif mood_key == "onako":
-        feedback = random.choice(LUTEAL_OKAY_MOOD_MSGS if "luteinska" in phase else FOLIKULAR_OKAY_MOOD_MSGS if "folikularna" in phase else ["Dobar posao što držiš stabilnost."])
-        extra = f"\n\n✅ Mali plus za kraj dana\n{hl_block}"
-        return header + feedback + extra + f"\n\n{action_block}" + "\n\n🤍 Hvala ti sto si prijavila dan."
+        feedback = rng.choice(OKAY_FEEDBACK.get(phase, OKAY_FEEDBACK_DEFAULT))
     else:
-        if "luteinska" in phase:
-            feedback = random.choice(LUTEAL_BAD_MOOD_MSGS)
-        elif "folikularna" in phase:
-            feedback = random.choice(FOLIKULAR_BAD_MOOD_MSGS)
-        elif "ovulacija" in phase:
-            feedback = random.choice(OVULATION_BAD_MOOD_MSGS)
-        else:
-            feedback = random.choice(MENSTRUAL_BAD_MOOD_MSGS)
-        extra = f"\n\n💥 Brzi reset\n{hl_block}\n\n{hormone_hack_block()}"
-        return header + f"{action_block}\n\n{feedback}" + extra + "\n\n🤍 Hvala ti sto si prijavila dan."
+        feedback = rng.choice(BAD_FEEDBACK.get(phase, MENSTRUAL_BAD_MOOD_MSGS))
+    template = MOOD_BODIES.get(mood_key) or MOOD_BODIES[None]
+    return template.render(
+        weather=weather_part(weather_cat),
+        phase=phase_part(phase),
+        horoscope=horoscope,
+        action=action_block_for_phase(phase),
+        hl=hl_block,
+        feedback=feedback,
+    )
+
+def phase_title(phase: str) -> str:
+    return PHASE_TITLES.get(phase) or phase.capitalize()
+
+def build_today_overview(
+    user: dict,
+    chat_id: Optional[int] = None,
+    state: Optional[tuple] = None,
+    day: Optional[date] = None,
+) -> str:
+    # day: lokalni datum primaoca za koji je state izracunat (broadcast ga zna unapred)
+    with Span("render"):
+        day_of_cycle, phase = state or get_cycle_state_for_today(user)
+        if day_of_cycle is None:
+            return no_state_text(user)
+        day = day or user_today(user)
+        weather_cat, _ = fetch_weather_category(user_city(user))
+        star_sign = user.get("star_sign")
+        key = ("today", phase, star_sign, weather_cat, daily_variant(chat_id, day))
+        body = fragments.get(day, key, lambda rng: render_today_body(phase, star_sign, weather_cat, rng))
+        return TODAY_HEADER.render(day=day_text(day_of_cycle), phase=phase_title(phase), streak=streak_prefix(user), body=body)
+
+def build_mood_message(user: dict, mood_key: str, chat_id: Optional[int] = None) -> str:
+    with Span("render"):
+        day_of_cycle, phase = get_cycle_state_for_today(user)
+        if day_of_cycle is None:
+            return no_state_text(user)
+        day = user_today(user)
+        weather_cat, _ = fetch_weather_category(user_city(user))
+        star_sign = user.get("star_sign")
+        key = ("mood", phase, star_sign, weather_cat, mood_key, daily_variant(chat_id, day))
+        body = fragments.get(day, key, lambda rng: render_mood_body(phase, star_sign, weather_cat, mood_key, rng))
+        return MOOD_HEADER.render(day=day_text(day_of_cycle), phase=phase_title(phase), streak=streak_prefix(user), body=body)
 
 def update_streak(user: dict, mood_key: str):
-    today = datetime.now(TZ).date()
+    today = user_today(user)
     last_date = user.get("last_mood_date")
     streak = user.get("bad_mood_streak", 0)
 
@@ -481,17 +1720,875 @@ def update_streak(user: dict, mood_key: str):
     user["bad_mood_streak"] = streak
     user["last_mood_date"] = today
 
+# --- PERSISTENCIJA (SQLite) ---
+# Svaki chat je jedan red; pise se samo red koji se promenio, a cita se tek kad
+# chat zaista zatreba (refresh_chat_data), pa start ne zavisi od broja korisnika.
+# Upis je write-behind: izmenjeni redovi se skupljaju u _dirty i upisuju jednom
+# transakcijom posle PERSIST_FLUSH_DELAY sekundi ili kad ih bude PERSIST_FLUSH_ROWS.
+CHAT_COLUMNS = {
+    "cycle_length": "INTEGER",
+    "period_length": "INTEGER",
+    "last_start": "INTEGER",
+    "star_sign": "TEXT",
+    "seen_start": "INTEGER NOT NULL DEFAULT 0",
+    "bad_mood_streak": "INTEGER",
+    "last_mood_date": "INTEGER",
+    "city": "TEXT",
+    "cycle_history": "BLOB",
+    "delivery_minute": f"INTEGER NOT NULL DEFAULT {DEFAULT_DELIVERY_MINUTE}",
+    "timezone": f"TEXT NOT NULL DEFAULT '{DEFAULT_TIMEZONE}'",
+}
+# Vrednosti za NOT NULL kolone kad polje nije postavljeno (npr. {} iz starog pickle-a za
+# chat koji je samo poslao /ping).
+DB_DEFAULTS = {"seen_start": 0, "delivery_minute": DEFAULT_DELIVERY_MINUTE, "timezone": DEFAULT_TIMEZONE}
+DATE_FIELDS = {"last_start", "last_mood_date"}
+BOOL_FIELDS = {"seen_start"}
+HISTORY_FIELDS = {"cycle_history"}
+
+def to_db_value(field: str, value):
+    if value is None:
+        return DB_DEFAULTS.get(field)
+    if field in DATE_FIELDS:
+        return value.toordinal()
+    if field in BOOL_FIELDS:
+        return int(bool(value))
+    if field in HISTORY_FIELDS:
+        return value.to_bytes()
+    return value
+
+def from_db_value(field: str, value):
+    if field in DATE_FIELDS:
+        return date.fromordinal(value)
+    if field in BOOL_FIELDS:
+        return bool(value)
+    if field in HISTORY_FIELDS:
+        try:
+            return CycleHistory.from_bytes(value)
+        except (ValueError, struct.error) as e:
+            # Bez istorije predikcija koristi unetu duzinu ciklusa; chat ostaje upotrebljiv.
+            logger.warning("Odbacujem neispravnu istoriju ciklusa: %s", e)
+            return None
+    return value
+
+def row_bytes(row: tuple) -> int:
+    # Procena korisnog sadrzaja reda (INTEGER 8 bajtova, TEXT po duzini), bez SQLite overhead-a.
+    return sum(len(v.encode()) if isinstance(v, str) else 8 for v in row if v is not None)
+
+class SQLitePersistence(BasePersistence):
+    def __init__(
+        self,
+        path: str = DB_PATH,
+        update_interval: float = PERSIST_INTERVAL,
+        flush_delay: float = PERSIST_FLUSH_DELAY,
+        flush_rows: int = PERSIST_FLUSH_ROWS,
+    ):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        self._written: dict = {}  # chat_id -> poslednji upisan red, da ne pisemo iste podatke
+        self._dirty: dict = {}  # chat_id -> red koji jos nije upisan
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.flush_delay = flush_delay
+        self.flush_rows = flush_rows
+        self._loaded: set = set()
+        self.outbox = Outbox(self.conn)
+        self.journal = MoodJournal(self.conn)
+        self.staging = Staging(self.conn)
+
+    def _create_schema(self):
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY)")
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(chats)")}
+        for name, sql_type in CHAT_COLUMNS.items():
+            if name not in existing:
+                self.conn.execute(f"ALTER TABLE chats ADD COLUMN {name} {sql_type}")
+        if "version" not in existing:
+            # raste pri svakom upisu reda; po njoj se vidi da je pre-render zastareo
+            self.conn.execute("ALTER TABLE chats ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS chats_subscribed ON chats(chat_id) WHERE seen_start = 1"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS chats_city ON chats(city) WHERE seen_start = 1"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS chats_delivery ON chats(timezone, delivery_minute) WHERE seen_start = 1"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "name TEXT NOT NULL, conv_key TEXT NOT NULL, chat_id INTEGER, state INTEGER, "
+            "PRIMARY KEY (name, conv_key))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS conversations_chat ON conversations(chat_id)")
+
+    @staticmethod
+    def row_from_chat_data(data: dict) -> tuple:
+        return tuple(to_db_value(field, data.get(field)) for field in CHAT_COLUMNS)
+
+    def write_rows(self, rows: dict, remember: bool = True):
+        if not rows:
+            return
+        columns = ", ".join(CHAT_COLUMNS)
+        placeholders = ", ".join("?" for _ in range(len(CHAT_COLUMNS) + 1))
+        updates = ", ".join(f"{c} = excluded.{c}" for c in CHAT_COLUMNS)
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                f"INSERT INTO chats (chat_id, {columns}) VALUES ({placeholders}) "
+                f"ON CONFLICT(chat_id) DO UPDATE SET {updates}, version = chats.version + 1",
+                [(chat_id, *row) for chat_id, row in rows.items()],
+            )
+        if remember:
+            self._written.update(rows)
+
+    def load_chat(self, chat_id: int) -> Optional[dict]:
+        row = self.conn.execute(
+            f"SELECT {', '.join(CHAT_COLUMNS)} FROM chats WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._written[chat_id] = tuple(row)
+        return self.chat_data_from_row(row)
+
+    @staticmethod
+    def chat_data_from_row(row) -> dict:
+        # Prazne kolone preskacemo, da ensure_user_defaults popuni podrazumevane vrednosti.
+        return {field: from_db_value(field, value) for field, value in zip(CHAT_COLUMNS, row) if value is not None}
+
+    def load_chats(self, chat_ids: list) -> dict:
+        result = {}
+        for i in range(0, len(chat_ids), 500):
+            chunk = chat_ids[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT chat_id, {', '.join(CHAT_COLUMNS)} FROM chats "
+                f"WHERE chat_id IN ({', '.join('?' for _ in chunk)})",
+                chunk,
+            )
+            for chat_id, *row in rows:
+                result[chat_id] = self.chat_data_from_row(row)
+        return result
+
+    def chat_versions(self, chat_ids: list) -> dict:
+        result = {}
+        for i in range(0, len(chat_ids), 500):
+            chunk = chat_ids[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT chat_id, version FROM chats WHERE chat_id IN ({', '.join('?' for _ in chunk)})", chunk
+            )
+            result.update(rows)
+        return result
+
+    def iter_rows(self, batch_size: int = 1000):
+        # Svi chatovi kao (chat_id, *CHAT_COLUMNS), keyset paginacijom po chat_id.
+        last = -(2 ** 63)
+        while True:
+            rows = self.conn.execute(
+                f"SELECT chat_id, {', '.join(CHAT_COLUMNS)} FROM chats WHERE chat_id > ? ORDER BY chat_id LIMIT ?",
+                (last, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            yield rows
+            last = rows[-1][0]
+
+    def iter_subscribed_chat_ids(self, batch_size: int = 1000):
+        # Keyset paginacija po parcijalnom indeksu: u memoriji je uvek samo jedan batch.
+        last = -(2 ** 63)
+        while True:
+            rows = self.conn.execute(
+                "SELECT chat_id FROM chats WHERE seen_start = 1 AND chat_id > ? ORDER BY chat_id LIMIT ?",
+                (last, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            yield [row[0] for row in rows]
+            last = rows[-1][0]
+
+    def subscribed_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM chats WHERE seen_start = 1").fetchone()[0]
+
+    def due_chat_ids(self, timezone: str, minute: int) -> list:
+        rows = self.conn.execute(
+            "SELECT chat_id FROM chats WHERE seen_start = 1 AND timezone = ? AND delivery_minute = ?",
+            (timezone, minute),
+        )
+        return [row[0] for row in rows]
+
+    def delivery_timezones(self) -> set:
+        return {row[0] for row in self.conn.execute("SELECT DISTINCT timezone FROM chats WHERE seen_start = 1")}
+
+    def subscribed_cities(self) -> set:
+        rows = self.conn.execute("SELECT DISTINCT city FROM chats WHERE seen_start = 1")
+        return {row[0] or DEFAULT_CITY for row in rows}
+
+    def unsubscribe(self, chat_ids: list):
+        self.flush_dirty()  # da zaostali red iz bafera ne vrati seen_start = 1
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("UPDATE chats SET seen_start = 0 WHERE chat_id = ?", [(c,) for c in chat_ids])
+        for chat_id in chat_ids:
+            self._written.pop(chat_id, None)
+
+    def chat_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+
+    def is_empty(self) -> bool:
+        return self.conn.execute("SELECT 1 FROM chats LIMIT 1").fetchone() is None
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        if chat_id in self._loaded:
+            return
+        self._loaded.add(chat_id)
+        stored = self.load_chat(chat_id)
+        if stored:
+            # U memoriji su podrazumevane vrednosti ili (posle forget) zastarela kopija.
+            chat_data.clear()
+            chat_data.update(stored)
+
+    def forget(self, chat_id: int):
+        # Sledeci refresh_chat_data ponovo cita red, jer ga je mozda menjao drugi proces.
+        self._loaded.discard(chat_id)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        row = self.row_from_chat_data(data)
+        pending = self._dirty.get(chat_id)
+        if (pending if pending is not None else self._written.get(chat_id)) == row:
+            return
+        self._dirty[chat_id] = row
+        metrics.set_gauge("persistence_dirty_chats", len(self._dirty))
+        self._schedule_flush()
+
+    def record_mood(self, chat_id: int, day: date, mood_key: str, phase: Optional[str], cycle_day: Optional[int]):
+        with Span("db"):
+            self.journal.append(chat_id, day, mood_key, phase, cycle_day)
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if len(self._dirty) + len(self.journal.pending) >= self.flush_rows:
+            self.flush_dirty()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_delay, self.flush_dirty)
+
+    def flush_dirty(self) -> int:
+        with Span("db"):
+            return self._flush_dirty()
+
+    def _flush_dirty(self) -> int:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.journal.flush()
+        if not self._dirty:
+            return 0
+        rows, self._dirty = self._dirty, {}
+        started = time.perf_counter()
+        try:
+            self.write_rows(rows)
+        except sqlite3.Error:
+            # Vrati redove u bafer (novije izmene imaju prednost) i probaj pri sledecem flush-u.
+            rows.update(self._dirty)
+            self._dirty = rows
+            logger.exception("Upis %s chatova nije uspeo, ostaju u baferu", len(rows))
+            return 0
+        metrics.observe("persistence_flush_seconds", time.perf_counter() - started)
+        metrics.inc("persistence_rows_written_total", len(rows))
+        metrics.inc("persistence_bytes_written_total", sum(row_bytes(row) for row in rows.values()))
+        metrics.set_gauge("persistence_dirty_chats", 0)
+        return len(rows)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._dirty.pop(chat_id, None)
+        self.conn.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+        self._written.pop(chat_id, None)
+        self._loaded.discard(chat_id)
+
+    async def flush(self) -> None:
+        # PTB ovo zove pri gasenju, posle poslednjeg update_persistence.
+        self.flush_dirty()
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # Ostali tipovi podataka se ne cuvaju (store_data iznad), ali ih BasePersistence trazi.
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = self.conn.execute("SELECT conv_key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(conv_key)): state for conv_key, state in rows}
+
+    def load_conversations(self, name: str, chat_id: int) -> dict:
+        rows = self.conn.execute(
+            "SELECT conv_key, state FROM conversations WHERE name = ? AND chat_id = ?", (name, chat_id)
+        )
+        return {tuple(json.loads(conv_key)): state for conv_key, state in rows}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        conv_key = json.dumps(list(key))
+        if new_state is None:
+            self.conn.execute("DELETE FROM conversations WHERE name = ? AND conv_key = ?", (name, conv_key))
+            return
+        self.conn.execute(
+            "INSERT INTO conversations (name, conv_key, chat_id, state) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(name, conv_key) DO UPDATE SET state = excluded.state",
+            (name, conv_key, key[0] if key else None, new_state),
+        )
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        return
+
+    async def update_bot_data(self, data: dict) -> None:
+        return
+
+    async def update_callback_data(self, data) -> None:
+        return
+
+    async def drop_user_data(self, user_id: int) -> None:
+        return
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        return
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        return
+
+class _PickleLoader(pickle.Unpickler):
+    # PicklePersistence cuva referencu na Bot kao persistent id, nama ne treba.
+    def persistent_load(self, pid):
+        return None
+
+def migrate_pickle(pickle_path: str, persistence: SQLitePersistence) -> int:
+    with open(pickle_path, "rb") as f:
+        data = _PickleLoader(f).load()
+    chat_data = data.get("chat_data") or {}
+    rows = {
+        chat_id: SQLitePersistence.row_from_chat_data(user)
+        for chat_id, user in chat_data.items()
+        if isinstance(chat_id, int) and isinstance(user, MutableMapping)  # dict ili UserProfile
+    }
+    persistence.write_rows(rows)
+    os.replace(pickle_path, pickle_path + ".migrated")
+    return len(rows)
+
+def chat_profile(application, chat_id: int) -> dict:
+    return chat_profiles(application, [chat_id])[0]
+
+def chat_profiles(application, chat_ids: list) -> list:
+    persistence = application.persistence
+    if cluster_of(application) is not None and isinstance(persistence, SQLitePersistence):
+        # U CLUSTER_MODE chat je mogao da izmeni drugi radnik, pa je kopija u memoriji
+        # ovog procesa mozda zastarela; baza je jedini pouzdan izvor.
+        persistence.flush_dirty()
+        loaded = persistence.load_chats(chat_ids)
+        return [loaded.get(chat_id) or {} for chat_id in chat_ids]
+    missing = [chat_id for chat_id in chat_ids if not application.chat_data.get(chat_id)]
+    loaded = {}
+    if missing and isinstance(persistence, SQLitePersistence):
+        loaded = persistence.load_chats(missing)
+    return [application.chat_data.get(chat_id) or loaded.get(chat_id) or {} for chat_id in chat_ids]
+
+# --- VISE RADNIKA (CLUSTER_MODE) ---
+# Vise procesa iza load balancer-a deli isti SQLite fajl (WAL). Jedan od njih drzi
+# lease "leader" i samo on salje vecernji broadcast; update-i istog chata se preko
+# chat_locks obradjuju redom i kad stignu na razlicite procese, a stanje chata i
+# ConversationHandler-a se pre obrade cita iz baze i posle obrade odmah upisuje.
+# Upiti nad leases/chat_locks mogu da cekaju tudji upis (busy timeout), pa idu u nit
+# (asyncio.to_thread), da event loop ne stoji dok drugi proces pise.
+LEADER_LEASE = "leader"
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))
+CHAT_LOCK_TTL = float(os.getenv("CHAT_LOCK_TTL", "30"))
+
+class ClusterCoordinator:
+    def __init__(self, path: str = DB_PATH, worker_id: str = WORKER_ID, lease_ttl: float = LEASE_TTL, lock_ttl: float = CHAT_LOCK_TTL):
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.lock_ttl = lock_ttl
+        self.is_leader = False
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_locks (chat_id INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db_lock = threading.Lock()  # jedna konekcija, vise niti iz to_thread
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._db_lock:
+            return self.conn.execute(sql, params)
+
+    def _take(self, table: str, key_column: str, key, ttl: float) -> bool:
+        # Jedan upsert: uzmi red ako je slobodan, istekao ili je vec nas.
+        now = time.time()
+        try:
+            cur = self._execute(
+                f"INSERT INTO {table} ({key_column}, owner, expires_at) VALUES (?, ?, ?) "
+                f"ON CONFLICT({key_column}) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                f"WHERE {table}.expires_at < ? OR {table}.owner = excluded.owner",
+                (key, self.worker_id, now + ttl, now),
+            )
+        except sqlite3.OperationalError as e:
+            # baza zakljucana duze od busy timeout-a: kao da je red zauzet, pozivalac ce probati ponovo
+            logger.warning("Ne mogu da uzmem %s %s: %s", table, key, e)
+            return False
+        return cur.rowcount == 1
+
+    async def try_lead(self) -> bool:
+        leader = await asyncio.to_thread(self._take, "leases", "name", LEADER_LEASE, self.lease_ttl)
+        if leader != self.is_leader:
+            logger.info("Radnik %s %s ulogu lidera", self.worker_id, "preuzima" if leader else "gubi")
+        self.is_leader = leader
+        metrics.set_gauge("cluster_leader", int(leader))
+        return leader
+
+    def resign(self):
+        self._execute("DELETE FROM leases WHERE name = ? AND owner = ?", (LEADER_LEASE, self.worker_id))
+        self.is_leader = False
+
+    def leader(self) -> Optional[str]:
+        row = self._execute(
+            "SELECT owner FROM leases WHERE name = ? AND expires_at >= ?", (LEADER_LEASE, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    async def lock_chat(self, chat_id: int) -> bool:
+        started = time.perf_counter()
+        delay = 0.005
+        while not await asyncio.to_thread(self._take, "chat_locks", "chat_id", chat_id, self.lock_ttl):
+            if time.perf_counter() - started > self.lock_ttl:
+                return False
+            await asyncio.sleep(delay)
+            delay = min(0.2, delay * 2)
+        metrics.observe("cluster_chat_lock_wait_seconds", time.perf_counter() - started)
+        return True
+
+    async def unlock_chat(self, chat_id: int):
+        await asyncio.to_thread(
+            self._execute, "DELETE FROM chat_locks WHERE chat_id = ? AND owner = ?", (chat_id, self.worker_id)
+        )
+
+    def close(self):
+        self.resign()
+        self._execute("DELETE FROM chat_locks WHERE owner = ?", (self.worker_id,))
+        self.conn.close()
+
+class ClusterUpdateProcessor(PerChatUpdateProcessor):
+    def __init__(self, coordinator: ClusterCoordinator, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self.coordinator = coordinator
+        self.application = None  # postavlja build_application
+
+    @staticmethod
+    def check_cluster_support(application):
+        # Interni PTB delovi koje _sync_conversations koristi; bolje pasti na startu nego tiho
+        # raditi sa zastarelim stanjem razgovora posle nadogradnje PTB-a.
+        conversations = getattr(application, "_conversation_handler_conversations", None)
+        if not isinstance(conversations, dict) or not all(
+            hasattr(tracking, "update_no_track") and hasattr(tracking, "data") for tracking in conversations.values()
+        ):
+            raise RuntimeError("CLUSTER_MODE trazi python-telegram-bot 21.6 (interni API za stanje razgovora)")
+
+    def _sync_conversations(self, chat_id: int):
+        persistence = self.application.persistence
+        for name, conversations in self.application._conversation_handler_conversations.items():
+            stored = persistence.load_conversations(name, chat_id)
+            for key in [k for k in conversations.data if k[0] == chat_id and k not in stored]:
+                del conversations.data[key]
+            conversations.update_no_track(stored)
+
+    async def _process(self, key, coroutine, label: Optional[str] = None):
+        chat_id = key if isinstance(key, int) else key[1]
+        if not await self.coordinator.lock_chat(chat_id):
+            logger.warning(
+                "Chat %s je i dalje zakljucan posle %ss, obradjujem bez lock-a", chat_id, self.coordinator.lock_ttl
+            )
+        try:
+            persistence = self.application.persistence
+            if isinstance(persistence, SQLitePersistence):
+                persistence.forget(chat_id)
+                self._sync_conversations(chat_id)
+            await self._run(coroutine, label)
+            # Upis pre otpustanja lock-a, da sledeci proces vidi ovu izmenu.
+            await self.application.update_persistence()
+            if isinstance(persistence, SQLitePersistence):
+                persistence.flush_dirty()
+        finally:
+            await self.coordinator.unlock_chat(chat_id)
+
+def cluster_of(application) -> Optional[ClusterCoordinator]:
+    processor = application.update_processor
+    return processor.coordinator if isinstance(processor, ClusterUpdateProcessor) else None
+
+async def lease_job(context: ContextTypes.DEFAULT_TYPE):
+    cluster = cluster_of(context.application)
+    if cluster is not None:
+        await cluster.try_lead()
+
+# --- DNEVNIK RASPOLOŽENJA ---
+# Jedan red u mood_events po (chat, dan): novi pritisak istog dana zamenjuje raniji, pa
+# se dan ne broji dvaput. Pored toga mood_rollup drzi gotove brojace po (mesec, faza,
+# mood), pa izvestaj za sve korisnike cita par desetina redova umesto miliona dogadjaja;
+# zamena dana u njemu skida stari mood i dodaje novi. Statistika jednog korisnika ide
+# preko pokrivajuceg indeksa (chat_id, month, phase, mood).
+MOOD_KEYS = ("sjajan", "onako", "tezak", "stresan")
+MOOD_CODES = {key: i for i, key in enumerate(MOOD_KEYS)}
+MOOD_EMOJI = ("🌟", "😐", "😣", "🔥")
+PHASE_CODES = {name: i for i, name in enumerate(PHASE_NAMES)}
+PHASE_EMOJI = ("🩸", "🌱", "💛", "🌙")
+
+def month_key(day: date) -> int:
+    return day.year * 100 + day.month
+
+def months_back(day: date, months: int) -> int:
+    index = day.year * 12 + day.month - 1 - (months - 1)
+    return (index // 12) * 100 + index % 12 + 1
+
+class MoodJournal:
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.pending: dict = {}  # (chat_id, dan) -> dogadjaj koji ceka sledeci flush
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS mood_events ("
+            "chat_id INTEGER NOT NULL, day INTEGER NOT NULL, month INTEGER NOT NULL, "
+            "mood INTEGER NOT NULL, phase INTEGER NOT NULL, cycle_day INTEGER NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS mood_events_chat ON mood_events(chat_id, month, phase, mood)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS mood_rollup ("
+            "month INTEGER NOT NULL, phase INTEGER NOT NULL, mood INTEGER NOT NULL, events INTEGER NOT NULL, "
+            "PRIMARY KEY (month, phase, mood)) WITHOUT ROWID"
+        )
+        self._migrate_one_per_day()
+
+    def _migrate_one_per_day(self):
+        # Starije baze imaju red po pritisku: ostaje poslednji pritisak dana, a rollup se racuna iz pocetka.
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'mood_events_day'").fetchone():
+            return
+        with self.conn:
+            self.conn.execute("BEGIN")
+            removed = self.conn.execute(
+                "DELETE FROM mood_events WHERE rowid NOT IN (SELECT MAX(rowid) FROM mood_events GROUP BY chat_id, day)"
+            ).rowcount
+            self.conn.execute("CREATE UNIQUE INDEX mood_events_day ON mood_events(chat_id, day)")
+            self.rebuild_rollup()
+        if removed:
+            logger.info("Dnevnik raspolozenja: uklonjeno %s ponovljenih unosa istog dana", removed)
+
+    def append(self, chat_id: int, day: date, mood_key: str, phase: Optional[str], cycle_day: Optional[int]):
+        ordinal = day.toordinal()
+        self.pending[(chat_id, ordinal)] = (
+            chat_id, ordinal, month_key(day), MOOD_CODES[mood_key],
+            PHASE_CODES.get(phase, PHASE_NONE), cycle_day or 0,
+        )
+
+    def flush(self) -> int:
+        if not self.pending:
+            return 0
+        events, self.pending = self.pending, {}
+        rollup: dict = {}
+        try:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                for chat_id, day, month, mood, phase, _ in events.values():
+                    previous = self.conn.execute(
+                        "SELECT month, phase, mood FROM mood_events WHERE chat_id = ? AND day = ?", (chat_id, day)
+                    ).fetchone()
+                    if previous is not None:
+                        rollup[previous] = rollup.get(previous, 0) - 1
+                    rollup[(month, phase, mood)] = rollup.get((month, phase, mood), 0) + 1
+                self.conn.executemany(
+                    "INSERT INTO mood_events (chat_id, day, month, mood, phase, cycle_day) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(chat_id, day) DO UPDATE SET mood = excluded.mood, phase = excluded.phase, "
+                    "cycle_day = excluded.cycle_day",
+                    list(events.values()),
+                )
+                self.conn.executemany(
+                    "INSERT INTO mood_rollup (month, phase, mood, events) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(month, phase, mood) DO UPDATE SET events = events + excluded.events",
+                    [(*key, count) for key, count in rollup.items() if count],
+                )
+        except sqlite3.Error:
+            # Transakcija je vracena: dogadjaji ostaju na cekanju (noviji pritisci imaju prednost).
+            events.update(self.pending)
+            self.pending = events
+            logger.exception("Upis %s raspolozenja nije uspeo, ostaju u baferu", len(events))
+            return 0
+        metrics.inc("mood_events_total", len(events))
+        return len(events)
+
+    def distribution(self, since_month: int, chat_id: Optional[int] = None) -> list:
+        # [(mesec, faza, mood, broj)], za jednog korisnika ili za sve
+        if chat_id is None:
+            rows = self.conn.execute(
+                "SELECT month, phase, mood, events FROM mood_rollup WHERE month >= ? AND events > 0 "
+                "ORDER BY month, phase, mood",
+                (since_month,),
+            )
+        else:
+            rows = self.conn.execute(
+                "SELECT month, phase, mood, COUNT(*) FROM mood_events WHERE chat_id = ? AND month >= ? "
+                "GROUP BY month, phase, mood ORDER BY month, phase, mood",
+                (chat_id, since_month),
+            )
+        return rows.fetchall()
+
+    def rebuild_rollup(self):
+        # Brojaci iz pocetka, iz mood_events; zove se unutar transakcije pozivaoca.
+        self.conn.execute("DELETE FROM mood_rollup")
+        self.conn.execute(
+            "INSERT INTO mood_rollup (month, phase, mood, events) "
+            "SELECT month, phase, mood, COUNT(*) FROM mood_events GROUP BY month, phase, mood"
+        )
+
+def journal_of(application) -> Optional[MoodJournal]:
+    persistence = application.persistence
+    return persistence.journal if isinstance(persistence, SQLitePersistence) else None
+
+def format_phase_distribution(rows: list) -> str:
+    # rows: (mesec, faza, mood, broj) -> jedan red po fazi, zbirno za sve mesece
+    totals: dict = {}
+    for _, phase, mood, count in rows:
+        totals.setdefault(phase, [0, 0, 0, 0])[mood] += count
+    lines = []
+    for code, name in enumerate(PHASE_NAMES):
+        counts = totals.get(code)
+        if not counts:
+            continue
+        total = sum(counts)
+        hard = (counts[2] + counts[3]) * 100 // total
+        moods = " · ".join(f"{MOOD_EMOJI[i]} {counts[i]}" for i in range(len(MOOD_KEYS)))
+        lines.append(f"{PHASE_EMOJI[code]} {phase_title(name)}: {moods} (teških {hard}%)")
+    return "\n".join(lines)
+
+def format_monthly_report(rows: list) -> str:
+    by_month: dict = {}
+    for row in rows:
+        by_month.setdefault(row[0], []).append(row)
+    parts = []
+    for month, month_rows in by_month.items():
+        total = sum(r[3] for r in month_rows)
+        parts.append(f"🗓 {month % 100:02d}.{month // 100} ({total} unosa)\n{format_phase_distribution(month_rows)}")
+    return "\n\n".join(parts)
+
+async def statistika(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    journal = journal_of(context.application)
+    if journal is None:
+        await update.message.reply_text("Statistika trenutno nije dostupna.")
+        return
+    months = 3
+    if context.args and context.args[0].isdigit():
+        months = max(1, min(12, int(context.args[0])))
+    journal.flush()
+    today = user_today(ensure_user_defaults(context))  # dogadjaji se beleze pod lokalnim datumom korisnika
+    rows = journal.distribution(months_back(today, months), update.effective_chat.id)
+    if not rows:
+        await update.message.reply_text("Još nema zabeleženih raspoloženja. Izaberi kako ti je prošao dan u dnevnoj poruci. 🙂")
+        return
+    await update.message.reply_text(
+        f"📈 Tvoja raspoloženja po fazama (poslednjih {months} mes.)\n\n{format_phase_distribution(rows)}"
+    )
+
+async def izvestaj(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /izvestaj [meseci] [chat_id] – samo za ADMIN_IDS
+    if update.effective_chat.id not in ADMIN_IDS:
+        return
+    journal = journal_of(context.application)
+    if journal is None:
+        await update.message.reply_text("Nema SQLite persistencije.")
+        return
+    args = [a for a in context.args if a.lstrip("-").isdigit()]
+    months = max(1, min(24, int(args[0]))) if args else 6
+    chat_id = int(args[1]) if len(args) > 1 else None
+    journal.flush()
+    # prozor po lokalnom datumu korisnika iz izvestaja, ili admina za izvestaj o svima
+    profile = chat_profile(context.application, chat_id) if chat_id is not None else ensure_user_defaults(context)
+    started = time.perf_counter()
+    rows = journal.distribution(months_back(user_today(profile), months), chat_id)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    who = f"chat {chat_id}" if chat_id is not None else "svi korisnici"
+    body = format_monthly_report(rows) if rows else "Nema podataka."
+    await update.message.reply_text(f"📊 Raspoloženja po fazama, {who}, {months} mes. ({elapsed_ms:.1f} ms)\n\n{body}")
+
+# --- KALENDAR ---
+# Projekcija ciklusa po mesecima: mreza dana sa oznakama i opsezi faza. Strana (jedan mesec)
+# zavisi samo od (poslednji pocetak, duzina ciklusa, trajanje menstruacije, mesec), pa se
+# pamti u LRU kesu; racuna se tek kad je neko otvori, a korisnici sa istim podesavanjima
+# i listanje napred-nazad dele iste strane.
+CALENDAR_CACHE_SIZE = 4096
+MONTH_NAMES = (
+    "Januar", "Februar", "Mart", "April", "Maj", "Jun",
+    "Jul", "Avgust", "Septembar", "Oktobar", "Novembar", "Decembar",
+)
+WEEKDAY_HEADER = " ".join(f"{name:3}" for name in ("Po", "Ut", "Sr", "Če", "Pe", "Su", "Ne")).rstrip()
+CALENDAR_PHASES = (
+    ("menstrualna faza", "🩸 Menstruacija"),
+    ("folikularna faza", "🌱 Folikularna faza"),
+    ("ovulacija", "🥚 Ovulacija"),
+    ("luteinska faza", "🌙 Luteinska faza"),
+)
+CALENDAR_LEGEND = "M menstruacija · P plodni dani · O ovulacija (procena)"
+
+def projected_day(day: date, last_start: date, cycle: int, period_len: int):
+    # (faza, oznaka u mrezi) za dan projekcije; ista pravila kao get_cycle_state_for_today
+    # i calc_next_dates, samo ponovljena za svaki sledeci ciklus.
+    delta = (day - last_start).days
+    if delta < 0:
+        return None, " "
+    day_of_cycle = delta % cycle + 1
+    ovulation = int(ovulation_day(cycle, period_len))
+    fertile = cycle - 17 <= day_of_cycle <= cycle - 11
+    if day_of_cycle <= period_len:
+        return "menstrualna faza", "M"
+    if day_of_cycle < ovulation:
+        return "folikularna faza", "P" if fertile else " "
+    if day_of_cycle == ovulation:
+        return "ovulacija", "O"
+    return "luteinska faza", "P" if fertile else " "
+
+def format_day_runs(days: list) -> str:
+    runs = []
+    for d in days:
+        if runs and runs[-1][1] == d - 1:
+            runs[-1][1] = d
+        else:
+            runs.append([d, d])
+    return ", ".join(f"{a}." if a == b else f"{a}.–{b}." for a, b in runs)
+
+@functools.lru_cache(maxsize=CALENDAR_CACHE_SIZE)
+def calendar_page(last_start: date, cycle: int, period_len: int, year: int, month: int) -> str:
+    first = date(year, month, 1)
+    days = ((date(year + month // 12, month % 12 + 1, 1)) - first).days
+    cells = ["   "] * first.weekday()
+    by_phase: dict = {}
+    fertile = []
+    for d in range(1, days + 1):
+        phase, mark = projected_day(date(year, month, d), last_start, cycle, period_len)
+        cells.append(f"{d:2d}{mark}")
+        if phase:
+            by_phase.setdefault(phase, []).append(d)
+        if mark in ("P", "O"):
+            fertile.append(d)
+    weeks = [" ".join(cells[i:i + 7]).rstrip() for i in range(0, len(cells), 7)]
+    lines = [f"🗓 <b>{MONTH_NAMES[month - 1]} {year}</b>", "<pre>" + "\n".join([WEEKDAY_HEADER, *weeks]) + "</pre>"]
+    for phase, label in CALENDAR_PHASES:
+        if phase in by_phase:
+            lines.append(f"{label}: {format_day_runs(by_phase[phase])}")
+    if fertile:
+        lines.append(f"💞 Plodni dani: {format_day_runs(fertile)}")
+    lines.append(f"\n<i>{CALENDAR_LEGEND}</i>")
+    return "\n".join(lines)
+
+def calendar_text(user: dict, page: int) -> Optional[str]:
+    if not user.get("last_start"):
+        return None
+    today = user_today(user)
+    month_index = today.year * 12 + today.month - 1 + page
+    return calendar_page(
+        user["last_start"],
+        cycle_prediction(user)[0],
+        int(user.get("period_length", 5)),
+        month_index // 12,
+        month_index % 12 + 1,
+    )
+
+async def kalendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = ensure_user_defaults(context)
+    text = calendar_text(user, 0)
+    if text is None:
+        await update.message.reply_text(
+            "Nemam datum poslednje menstruacije. Udji na Podesi ciklus i unesi datum.",
+            reply_markup=main_menu_keyboard(),
+        )
+        return
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=CALENDAR_KEYBOARDS[0])
+
 # --- DIJAGNOSTIČKE KOMANDE ---
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     now_local = datetime.now(TZ)
-    await update.message.reply_text(f"✅ PONG, Beograd vreme: {now_local.strftime('%d.%m.%Y %H:%M:%S')}")
+    startup = context.bot_data.get("startup_seconds")
+    startup_txt = f"\nStartup: {startup:.3f}s" if startup is not None else ""
+    await update.message.reply_text(f"✅ PONG, Beograd vreme: {now_local.strftime('%d.%m.%Y %H:%M:%S')}{startup_txt}")
+
+async def profil(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /profil [on|off|dump|spori|reset] – samo za ADMIN_IDS; vazi za radnika koji je primio komandu
+    if update.effective_chat.id not in ADMIN_IDS:
+        return
+    action = context.args[0].lower() if context.args else ""
+    if action == "on":
+        profiler.start()
+    elif action == "off":
+        profiler.stop()
+    elif action == "reset":
+        profiler.reset()
+    elif action == "dump":
+        samples = profiler.snapshot()
+        if not samples:
+            await update.message.reply_text("Nema uzoraka. Uključi sa /profil on.")
+            return
+        try:
+            caption = f"Sačuvano i u {profiler.dump()}"
+        except OSError as e:
+            caption = f"Upis u {PROFILE_DIR} nije uspeo: {e}"
+        await update.message.reply_document(
+            document=folded(samples).encode(), filename="profil.folded", caption=caption
+        )
+        return
+    elif action == "spori":
+        if not profiler.slow:
+            await update.message.reply_text(f"Nema update-a sporijih od {profiler.threshold:.2f}s.")
+            return
+        lines = [f"{trace.at:%H:%M:%S} {trace.summary()}" for trace in list(profiler.slow)[-10:]]
+        await update.message.reply_text("🐢 Poslednji spori:\n" + "\n".join(lines))
+        stacks = profiler.slow_folded()
+        if stacks:
+            await update.message.reply_document(document=stacks.encode(), filename="spori.folded")
+        return
+    leaves: dict = {}
+    for stack, count in profiler.snapshot().items():
+        leaf = stack.rsplit(";", 1)[-1]
+        leaves[leaf] = leaves.get(leaf, 0) + count
+    total = sum(leaves.values())
+    hot = "\n".join(
+        f"{count * 100 / total:5.1f}% {leaf}" for leaf, count in sorted(leaves.items(), key=lambda x: -x[1])[:5]
+    )
+    await update.message.reply_text(
+        f"🔬 Profilisanje: {'uključeno' if profiler.enabled else 'isključeno'}\n"
+        f"Uzoraka: {total} (+{profiler.idle} dok loop čeka)\n"
+        f"Sporih (≥{profiler.threshold:.2f}s): {len(profiler.slow)}\n"
+        + (f"\nNajtoplije funkcije:\n{hot}\n" if hot else "")
+        + "\n/profil on|off|dump|spori|reset"
+    )
 
 async def jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
     jq = context.application.job_queue
-    name = job_name_daily(chat_id)
-    jobs_list = jq.get_jobs_by_name(name) if jq else []
-    await update.message.reply_text(f"📌 Jobs za chat {chat_id}, found: {len(jobs_list)}")
+    jobs_list = jq.get_jobs_by_name(BROADCAST_JOB_NAME) if jq else []
+    subscribed = subscribed_count(context.application)
+    last = context.bot_data.get("last_broadcast", "još nije bilo")
+    cluster = cluster_of(context.application)
+    details = f"\nRadnik: {cluster.worker_id}, lider: {cluster.leader() or 'nema'}" if cluster else ""
+    outbox = outbox_of(context.application)
+    if outbox is not None:
+        details += f"\nOutbox na čekanju: {outbox.depth()}"
+    await update.message.reply_text(
+        f"📌 Broadcast job found: {len(jobs_list)}, pretplaćenih chatova: {subscribed}\n"
+        f"Poslednji broadcast: {last}{details}"
+    )
 
 async def testin1(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -500,19 +2597,19 @@ async def testin1(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Nema job_queue.")
         return
 
+    kind = f"testin1:{update.message.message_id}"
+
     async def one_shot(ctx: ContextTypes.DEFAULT_TYPE):
-        await ctx.bot.send_message(chat_id=chat_id, text="✅ JobQueue radi, ovo je poruka posle 60s")
+        await send_via_outbox(ctx.application, chat_id, kind, "✅ JobQueue radi, ovo je poruka posle 60s")
 
     jq.run_once(one_shot, when=60, name=f"oneshot_{chat_id}")
     await update.message.reply_text("OK, šaljem test za 60 sekundi.")
 
 async def nextrun(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
     jq = context.application.job_queue
-    name = job_name_daily(chat_id)
-    jobs_list = jq.get_jobs_by_name(name) if jq else []
+    jobs_list = jq.get_jobs_by_name(BROADCAST_JOB_NAME) if jq else []
     if not jobs_list:
-        await update.message.reply_text("Nema daily job-a za ovaj chat, uradi /start.")
+        await update.message.reply_text("Nema daily broadcast job-a.")
         return
 
     j = jobs_list[0]
@@ -533,59 +2630,823 @@ async def test22(update: Update, context: ContextTypes.DEFAULT_TYPE):
     class J: pass
     j = J()
     j.chat_id = update.effective_chat.id
+    j.data = f"test22:{update.message.message_id}"  # da test ne zauzme kljuc prave vecernje poruke
     context.job = j
     await daily22_job(context)
 
 # --- DAILY JOB ---
-async def daily22_job(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    chat_id = job.chat_id
-    stored = context.application.chat_data.get(chat_id, {})
-    if not stored:
-        stored = {}
+NO_DATA_REMINDER = (
+    "⏰ Večernji podsetnik\nJoš uvek nemam tvoje podatke o ciklusu. 😊\n"
+    "Kada podesiš, svako veče stiže personalizovana poruka!\nUdji na Podeši ciklus i krenimo! 🚀"
+)
+
+DAILY_MESSAGE = Template("{overview}\n\nKako ti je prosao dan? Izaberi najblizu opciju:")
 
+def render_daily_message(
+    stored: dict,
+    chat_id: Optional[int] = None,
+    state: Optional[tuple] = None,
+    day: Optional[date] = None,
+):
     if not stored.get("last_start"):
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="⏰ Večernji podsetnik\nJoš uvek nemam tvoje podatke o ciklusu. 😊\nKada podesiš, svako veče stiže personalizovana poruka!\nUdji na Podeši ciklus i krenimo! 🚀",
-            parse_mode="HTML",
+        return NO_DATA_REMINDER, None
+    return DAILY_MESSAGE.render(overview=build_today_overview(stored, chat_id, state, day)), MOOD_KEYBOARD
+
+async def daily22_job(context: ContextTypes.DEFAULT_TYPE):
+    chat_id = context.job.chat_id
+    text, markup = render_daily_message(chat_profile(context.application, chat_id), chat_id)
+    await send_via_outbox(
+        context.application,
+        chat_id,
+        getattr(context.job, "data", None) or "daily",
+        text,
+        parse_mode="HTML",
+        reply_markup=markup,
+    )
+
+# --- BROADCAST 22:00 ---
+# Jedan job za sve chatove umesto po jednog po chatu: primaoci idu u batch-evima,
+# a slanje kroz token bucket da ne probijemo Telegram limit (~30 poruka/s).
+BROADCAST_JOB_NAME = "daily22_broadcast"
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5"))
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        # 429 od Telegrama vazi za ceo bot, pa pauziramo sve posiljaoce odjednom.
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class BroadcastStats:
+    def __init__(self, total: int):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retries = 0
+        self.skipped = 0  # vec isporuceno ranije (npr. ponovljen job posle restarta)
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"{self.sent}/{self.total} poslato, {self.failed} neuspešno, {self.blocked} blokiralo bota, "
+            f"{self.retries} ponavljanja, {self.skipped} vec poslato, "
+            f"{self.elapsed:.1f}s ({self.throughput:.1f} msg/s)"
         )
+
+async def send_with_retry(bot, limiter: TokenBucket, stats: BroadcastStats, chat_id: int, **kwargs) -> str:
+    for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+        await limiter.acquire()
+        try:
+            await bot.send_message(chat_id=chat_id, **kwargs)
+            return "sent"
+        except RetryAfter as e:
+            stats.retries += 1
+            limiter.pause(float(e.retry_after))
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            logger.warning("Broadcast BadRequest za chat_id=%s: %s", chat_id, e)
+            return "failed"
+        except NetworkError as e:
+            stats.retries += 1
+            logger.warning("Broadcast mrezna greska za chat_id=%s, pokusaj %s: %s", chat_id, attempt, e)
+            await asyncio.sleep(min(30, 2 ** attempt))
+    # Privremena greska: outbox ce poruku pokusati ponovo kasnije.
+    return "retry"
+
+def subscribed_batches(application, batch_size: int = BROADCAST_BATCH):
+    if isinstance(application.persistence, SQLitePersistence):
+        yield from application.persistence.iter_subscribed_chat_ids(batch_size)
         return
+    ids = [
+        chat_id
+        for chat_id, data in application.chat_data.items()
+        if isinstance(chat_id, int) and isinstance(data, MutableMapping) and data.get("seen_start")
+    ]
+    for i in range(0, len(ids), batch_size):
+        yield ids[i:i + batch_size]
+
+def subscribed_count(application) -> int:
+    if isinstance(application.persistence, SQLitePersistence):
+        return application.persistence.subscribed_count()
+    return sum(1 for batch in subscribed_batches(application) for _ in batch)
+
+def subscribed_cities(application, chat_ids: Optional[list] = None) -> set:
+    if chat_ids is not None:
+        return {user_city(profile) for profile in chat_profiles(application, chat_ids)}
+    if isinstance(application.persistence, SQLitePersistence):
+        return application.persistence.subscribed_cities()
+    return {
+        user_city(data)
+        for data in application.chat_data.values()
+        if isinstance(data, MutableMapping) and data.get("seen_start")
+    }
+
+async def prefetch_weather(application, chat_ids: Optional[list] = None) -> int:
+    # Pre slanja osvezi vreme za svaki razlicit grad jednom, da render ne naleti na prazan kes.
+    if not WEATHER_API_KEY:
+        return 0
+    cities = subscribed_cities(application, chat_ids)
+    fetched = await weather.prefetch(cities)
+    logger.info("Vreme pre broadcast-a: %s gradova, osvezeno %s", len(cities), fetched)
+    return fetched
+
+def unsubscribe_chats(application, chat_ids: list):
+    in_memory = [chat_id for chat_id in chat_ids if chat_id in application.chat_data]
+    for chat_id in in_memory:
+        application.chat_data[chat_id]["seen_start"] = False
+    if in_memory:
+        application.mark_data_for_update_persistence(chat_ids=in_memory)
+    if isinstance(application.persistence, SQLitePersistence):
+        application.persistence.unsubscribe(chat_ids)
+
+def render_batch(application, batch: list, day: date):
+    # Stanje ciklusa za ceo batch u jednom NumPy prolazu; renderujemo grupisano po fazi,
+    # da uzastopni korisnici pogadjaju iste fragmente u kesu.
+    profiles = chat_profiles(application, batch)
+    states = cycle_state_bulk(*profiles_to_columns(profiles), today=day)
+    order = np.argsort(states["phase"], kind="stable")
+    chat_ids, rendered = [], []
+    for i in order.tolist():
+        chat_id = batch[i]
+        try:
+            rendered.append(render_daily_message(profiles[i], chat_id, bulk_state_at(states, i), day))
+        except Exception:
+            logger.exception("Broadcast render greska za chat_id=%s", chat_id)
+            rendered.append(None)
+        chat_ids.append(chat_id)
+    return chat_ids, rendered
+
+async def broadcast_daily(
+    application,
+    day: date,
+    chat_ids=None,
+    limiter: Optional[TokenBucket] = None,
+) -> BroadcastStats:
+    # day: lokalni datum primalaca; DeliveryScheduler salje svaku zonu posebno, sa njenim datumom
+    if chat_ids is not None:
+        chat_ids = list(chat_ids)
+        batches = (chat_ids[i:i + BROADCAST_BATCH] for i in range(0, len(chat_ids), BROADCAST_BATCH))
+    else:
+        # Prvo upisi sve sto je u memoriji, da indeks pretplacenih bude tacan.
+        if application.persistence:
+            await application.update_persistence()
+            if isinstance(application.persistence, SQLitePersistence):
+                application.persistence.flush_dirty()
+        batches = subscribed_batches(application)
+    outbox = outbox_of(application)
+    staging = application.persistence.staging if outbox is not None else None
+    limiter = limiter or (outbox.limiter if outbox is not None else TokenBucket(BROADCAST_RATE))
+    stats = BroadcastStats(0)
+
+    async def deliver(chat_id: int, rendered) -> str:
+        if rendered is None:
+            return "failed"
+        text, markup = rendered
+        return await send_with_retry(
+            application.bot, limiter, stats, chat_id,
+            text=text, parse_mode="HTML", reply_markup=markup,
+        )
+
+    for batch in batches:
+        stats.total += len(batch)
+        blocked = []
+        staged = staging.fresh(batch, day) if staging is not None else {}
+        stale = [chat_id for chat_id in batch if chat_id not in staged]
+        if stale:
+            # Bez pre-render-a, ili se profil promenio posle njega: renderuj sada.
+            await prefetch_weather(application, stale)
+            stale, rendered = render_batch(application, stale, day)
+        else:
+            rendered = []
+        metrics.inc("broadcast_prerendered_total", len(staged))
+        if outbox is not None:
+            # Kroz outbox: ponovljen job (retry, restart) ne salje ponovo ono sto je vec otislo.
+            batch = list(staged) + stale
+            payloads = list(staged.values()) + [
+                Outbox.encode(r[0], "HTML", r[1]) if r is not None else None for r in rendered
+            ]
+            results = await outbox.send_payloads(application.bot, limiter, stats, batch, payloads, "daily", day)
+        else:
+            batch = stale
+            results = await asyncio.gather(
+                *(deliver(chat_id, r) for chat_id, r in zip(batch, rendered)), return_exceptions=True
+            )
+        for chat_id, result in zip(batch, results):
+            metrics.inc("broadcast_messages_total", result=result if isinstance(result, str) else "failed")
+            if result == "sent":
+                stats.sent += 1
+            elif result == "skipped":
+                stats.skipped += 1
+            elif result == "blocked":
+                stats.blocked += 1
+                blocked.append(chat_id)
+            else:
+                stats.failed += 1
+                if isinstance(result, Exception):
+                    logger.error("Broadcast greska za chat_id=%s: %r", chat_id, result)
+        # Ko je blokirao bota vise ne dobija vecernju poruku, dok ponovo ne uradi /start.
+        if blocked:
+            unsubscribe_chats(application, blocked)
+
+    stats.finished = time.monotonic()
+    metrics.set_gauge("broadcast_last_seconds", stats.elapsed)
+    metrics.set_gauge("broadcast_last_throughput", stats.throughput)
+    logger.info("Broadcast za %s zavrsen: %s", day, stats.summary())
+    return stats
+
+# --- RASPORED PO MINUTU ---
+# Svako bira svoje vreme i zonu (/vreme). Umesto job-a po korisniku, jedan job tikne
+# jednom u minuti i za svaku zonu iz baze pokupi korisnike kojima je tada lokalno
+# vreme isporuke (indeks chats_delivery), pa ih posalje jednim broadcast-om.
+# Cena tika zavisi od broja zona i primalaca u tom minutu, ne od ukupnog broja korisnika.
+DELIVERY_CATCHUP_MINUTES = int(os.getenv("DELIVERY_CATCHUP_MINUTES", "10"))
+DELIVERY_TZ_REFRESH = 15 * 60  # koliko cesto ponovo citamo listu zona iz baze
+PRERENDER_LEAD_MINUTES = int(os.getenv("PRERENDER_LEAD_MINUTES", "30"))  # 0 = bez pre-render-a
+
+def parse_delivery_time(text: str) -> Optional[int]:
+    try:
+        hours, minutes = (int(part) for part in text.strip().split(":"))
+    except ValueError:
+        return None
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        return None
+    return hours * 60 + minutes
+
+def format_delivery_time(user) -> str:
+    minute = user.get("delivery_minute", DEFAULT_DELIVERY_MINUTE)
+    text = f"{minute // 60:02d}:{minute % 60:02d}"
+    timezone = user.get("timezone") or DEFAULT_TIMEZONE
+    return text if timezone == DEFAULT_TIMEZONE else f"{text} ({timezone})"
+
+class DeliveryScheduler:
+    def __init__(self, application):
+        self.application = application
+        self.last_minute: Optional[int] = None  # poslednji obradjen minut (UTC, od epohe)
+        self.prerendered_until: Optional[int] = None  # poslednji minut cije poruke su pre-renderovane
+        self._timezones: set = {DEFAULT_TIMEZONE}
+        self._timezones_at = float("-inf")
+        self._tasks: set = set()
+
+    def add_timezone(self, name: str):
+        self._timezones.add(name)
+
+    def timezones(self) -> set:
+        now = time.monotonic()
+        if now - self._timezones_at >= DELIVERY_TZ_REFRESH:
+            persistence = self.application.persistence
+            if isinstance(persistence, SQLitePersistence):
+                found = persistence.delivery_timezones()
+            else:
+                found = {
+                    data.get("timezone") or DEFAULT_TIMEZONE
+                    for data in self.application.chat_data.values()
+                    if isinstance(data, MutableMapping) and data.get("seen_start")
+                }
+            # Zona koja se ne da ucitati (rucno menjana baza, tzdata bez nje) se preskace.
+            for name in [name for name in found if not known_timezone(name)]:
+                logger.warning("Vremenska zona %r nije poznata, njeni korisnici se preskacu", name)
+                found.discard(name)
+            self._timezones = found | {DEFAULT_TIMEZONE}
+            self._timezones_at = now
+        return self._timezones
+
+    def recipients(self, timezone: str, minute: int) -> list:
+        persistence = self.application.persistence
+        if isinstance(persistence, SQLitePersistence):
+            return persistence.due_chat_ids(timezone, minute)
+        return [
+            chat_id
+            for chat_id, data in self.application.chat_data.items()
+            if isinstance(chat_id, int) and isinstance(data, MutableMapping) and data.get("seen_start")
+            and (data.get("timezone") or DEFAULT_TIMEZONE) == timezone
+            and data.get("delivery_minute", DEFAULT_DELIVERY_MINUTE) == minute
+        ]
+
+    def due(self, minute: int) -> dict:
+        # lokalni datum -> primaoci kojima je u tom UTC minutu vreme isporuke
+        buckets: dict = {}
+        for timezone in self.timezones():
+            # greska jedne zone ne sme da zaustavi isporuku za sve ostale
+            try:
+                local = datetime.fromtimestamp(minute * 60, zone(timezone))
+                chat_ids = self.recipients(timezone, local.hour * 60 + local.minute)
+            except Exception:
+                logger.exception("Isporuka za zonu %r u minutu %s preskocena", timezone, minute)
+                continue
+            if chat_ids:
+                buckets.setdefault(local.date(), []).extend(chat_ids)
+        return buckets
+
+    async def tick(self, now: Optional[float] = None) -> int:
+        current = int((now if now is not None else time.time()) // 60)
+        # Propusteni minuti (restart, promena lidera) se nadoknade do DELIVERY_CATCHUP_MINUTES
+        # unazad; outbox kljuc chat:datum sprecava da neko dobije poruku dvaput.
+        first = current - DELIVERY_CATCHUP_MINUTES
+        if self.last_minute is not None:
+            first = max(first, self.last_minute + 1)
+        if first > current:
+            return 0
+        if self.application.persistence:
+            await self.application.update_persistence()
+            if isinstance(self.application.persistence, SQLitePersistence):
+                self.application.persistence.flush_dirty()
+        buckets: dict = {}
+        for minute in range(first, current + 1):
+            for day, chat_ids in self.due(minute).items():
+                buckets.setdefault(day, []).extend(chat_ids)
+        self.last_minute = current
+        total = 0
+        for day, chat_ids in buckets.items():
+            total += len(chat_ids)
+            self._spawn(self._deliver(chat_ids, day))
+        metrics.inc("delivery_recipients_total", total)
+        self._schedule_prerender(current)
+        return total
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _schedule_prerender(self, current: int):
+        # Minuti koji dolaze za PRERENDER_LEAD_MINUTES se renderuju unapred, u pozadini,
+        # pa u minutu isporuke ostaje samo slanje.
+        persistence = self.application.persistence
+        if PRERENDER_LEAD_MINUTES <= 0 or not isinstance(persistence, SQLitePersistence) or outbox_of(self.application) is None:
+            return
+        first = current + 1
+        if self.prerendered_until is not None:
+            first = max(first, self.prerendered_until + 1)
+        last = current + PRERENDER_LEAD_MINUTES
+        if first > last:
+            return
+        buckets: dict = {}
+        for minute in range(first, last + 1):
+            for day, chat_ids in self.due(minute).items():
+                buckets.setdefault(day, []).extend(chat_ids)
+        self.prerendered_until = last
+        for day, chat_ids in buckets.items():
+            self._spawn(self._prerender(chat_ids, day))
+
+    async def _prerender(self, chat_ids: list, day: date):
+        try:
+            await prerender(self.application, chat_ids, day)
+        except Exception:
+            logger.exception("Pre-render za %s nije uspeo", day)
 
-    overview = build_today_overview(stored)
-    text = (
-        f"{overview}\n\n"
-        "Kako ti je prosao dan? Izaberi najblizu opciju:"
+    async def _deliver(self, chat_ids: list, day: date):
+        try:
+            stats = await broadcast_daily(self.application, day, chat_ids)
+        except Exception:
+            logger.exception("Dnevna isporuka za %s nije uspela", day)
+            return
+        self.application.bot_data["last_broadcast"] = stats.summary()
+
+def scheduler_of(application) -> Optional[DeliveryScheduler]:
+    jq = application.job_queue
+    jobs_list = jq.get_jobs_by_name(BROADCAST_JOB_NAME) if jq else []
+    return jobs_list[0].data if jobs_list else None
+
+async def delivery_tick_job(context: ContextTypes.DEFAULT_TYPE):
+    cluster = cluster_of(context.application)
+    # Samo lider salje; novi lider nadoknadi minute koje je stari propustio.
+    if cluster is not None and not await cluster.try_lead():
+        return
+    await context.job.data.tick()
+
+def schedule_broadcast(jq):
+    for j in jq.get_jobs_by_name(BROADCAST_JOB_NAME):
+        j.schedule_removal()
+    now = datetime.now(TZ)
+    jq.run_repeating(
+        timed(delivery_tick_job),
+        interval=60,
+        first=61 - now.second - now.microsecond / 1e6,  # sekund posle pocetka sledeceg minuta
+        name=BROADCAST_JOB_NAME,
+        data=DeliveryScheduler(jq.application),
+        job_kwargs={"misfire_grace_time": 50, "coalesce": True},
     )
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=text,
-        parse_mode="HTML",
-        reply_markup=mood_keyboard(),
+# --- PRE-RENDER ---
+# Poruke za narednih PRERENDER_LEAD_MINUTES minuta se renderuju unapred u tabelu
+# prerendered (vec kodiran outbox payload), pa broadcast u minutu isporuke samo salje.
+# Uz payload ide verzija reda iz chats; ko je u medjuvremenu promenio podatke ima
+# noviju verziju i renderuje se ponovo pri slanju.
+class Staging:
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS prerendered ("
+            "day INTEGER NOT NULL, chat_id INTEGER NOT NULL, version INTEGER NOT NULL, payload TEXT NOT NULL, "
+            "PRIMARY KEY (day, chat_id)) WITHOUT ROWID"
+        )
+
+    def store(self, day: date, rows: list):
+        # rows: (chat_id, version, payload); jedna transakcija za ceo batch, ne po redu
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO prerendered (day, chat_id, version, payload) VALUES (?, ?, ?, ?)",
+                [(day.toordinal(), chat_id, version, payload) for chat_id, version, payload in rows],
+            )
+
+    def fresh(self, chat_ids: list, day: date) -> dict:
+        # chat_id -> payload, samo za redove cija se verzija nije menjala od pre-render-a
+        result = {}
+        for i in range(0, len(chat_ids), 500):
+            chunk = chat_ids[i:i + 500]
+            rows = self.conn.execute(
+                "SELECT p.chat_id, p.payload FROM prerendered p JOIN chats c ON c.chat_id = p.chat_id "
+                f"WHERE p.day = ? AND p.version = c.version AND p.chat_id IN ({', '.join('?' for _ in chunk)})",
+                [day.toordinal(), *chunk],
+            )
+            result.update(rows)
+        return result
+
+    def prune(self, before: date) -> int:
+        return self.conn.execute("DELETE FROM prerendered WHERE day < ?", (before.toordinal(),)).rowcount
+
+async def prerender(application, chat_ids: list, day: date) -> int:
+    persistence = application.persistence
+    persistence.flush_dirty()
+    stored = 0
+    for i in range(0, len(chat_ids), BROADCAST_BATCH):
+        batch = chat_ids[i:i + BROADCAST_BATCH]
+        await prefetch_weather(application, batch)
+        # verziju citamo pre render-a: izmena u toku render-a dobija noviju i ne prolazi kao sveza
+        versions = persistence.chat_versions(batch)
+        batch, rendered = render_batch(application, batch, day)
+        rows = [
+            (chat_id, versions[chat_id], Outbox.encode(r[0], "HTML", r[1]))
+            for chat_id, r in zip(batch, rendered)
+            if r is not None and chat_id in versions
+        ]
+        persistence.staging.store(day, rows)
+        stored += len(rows)
+        await asyncio.sleep(0)  # ne drzimo petlju ceo pre-render
+    metrics.inc("prerendered_total", stored)
+    logger.info("Pre-render za %s: %s/%s poruka", day, stored, len(chat_ids))
+    return stored
+
+# --- OUTBOX ---
+# Svaka odlazna poruka se prvo upise u tabelu outbox sa kljucem chat:datum:vrsta,
+# pa tek onda salje i oznaci kao isporucena. Restart ili ponovljen job ne salju
+# istu poruku dvaput (INSERT OR IGNORE), a ono sto nije otislo pokupi outbox_drain_job.
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "16"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_TTL = float(os.getenv("OUTBOX_TTL", str(6 * 3600)))  # posle toga poruka vise nije aktuelna
+OUTBOX_POLL = float(os.getenv("OUTBOX_POLL", "15"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "3"))
+
+class Outbox:
+    def __init__(self, conn: sqlite3.Connection, rate: float = BROADCAST_RATE, workers: int = OUTBOX_WORKERS):
+        self.conn = conn
+        self.limiter = TokenBucket(rate)
+        self.workers = workers
+        self._inflight: set = set()  # id-jevi koje upravo saljemo, da ih drain ne uzme dvaput
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY, idem_key TEXT NOT NULL UNIQUE, chat_id INTEGER NOT NULL, kind TEXT NOT NULL, "
+            "payload TEXT, status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, next_attempt_at REAL NOT NULL, expires_at REAL NOT NULL, sent_at REAL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_due ON outbox(next_attempt_at) WHERE status = 'pending'"
+        )
+
+    @staticmethod
+    def idempotency_key(chat_id: int, kind: str, day: date) -> str:
+        # day je lokalni datum primaoca, da "jedna dnevna poruka" vazi za njegov dan
+        return f"{chat_id}:{day.isoformat()}:{kind}"
+
+    @staticmethod
+    def encode(text: str, parse_mode: Optional[str] = None, reply_markup: Optional[InlineKeyboardMarkup] = None) -> str:
+        if reply_markup is not None:
+            # deljene tastature idu po imenu, ostale kao pun JSON
+            reply_markup = KEYBOARD_NAMES.get(id(reply_markup)) or reply_markup.to_dict()
+        return json.dumps({"text": text, "parse_mode": parse_mode, "reply_markup": reply_markup})
+
+    @staticmethod
+    def decode(payload: str) -> dict:
+        kwargs = json.loads(payload)
+        markup = kwargs.get("reply_markup")
+        if isinstance(markup, str):
+            kwargs["reply_markup"] = KEYBOARDS[markup]
+        elif markup:
+            kwargs["reply_markup"] = InlineKeyboardMarkup.de_json(markup, None)
+        return kwargs
+
+    def enqueue_many(self, items: list, ttl: float = OUTBOX_TTL):
+        # items: (idem_key, chat_id, kind, payload)
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO outbox (idem_key, chat_id, kind, payload, created_at, next_attempt_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(key, chat_id, kind, payload, now, now, now + ttl) for key, chat_id, kind, payload in items],
+            )
+
+    def status_of(self, keys: list) -> dict:
+        result = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT idem_key, id, chat_id, payload, status, next_attempt_at FROM outbox WHERE idem_key IN ({', '.join('?' for _ in chunk)})",
+                chunk,
+            )
+            for key, *row in rows:
+                result[key] = row
+        return result
+
+    def due(self, limit: int = 500) -> list:
+        rows = self.conn.execute(
+            "SELECT id, chat_id, payload, expires_at FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+            "ORDER BY next_attempt_at LIMIT ?",
+            (time.time(), limit + len(self._inflight)),
+        ).fetchall()
+        return [row for row in rows if row[0] not in self._inflight][:limit]
+
+    def mark(self, row_id: int, status: str):
+        if status == "sent":
+            # payload vise ne treba, ostaje samo kljuc da se poruka ne bi ponovila
+            self.conn.execute(
+                "UPDATE outbox SET status = 'sent', payload = NULL, sent_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (time.time(), row_id),
+            )
+        elif status == "retry":
+            self.conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, "
+                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END, "
+                "next_attempt_at = ? + MIN(3600, 30 * (1 << MIN(attempts, 7))) WHERE id = ?",
+                (OUTBOX_MAX_ATTEMPTS, time.time(), row_id),
+            )
+        else:
+            self.conn.execute("UPDATE outbox SET status = ?, attempts = attempts + 1 WHERE id = ?", (status, row_id))
+
+    def depth(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+    def prune(self, days: int = OUTBOX_RETENTION_DAYS) -> int:
+        cur = self.conn.execute(
+            "DELETE FROM outbox WHERE status != 'pending' AND created_at < ?", (time.time() - days * 86400,)
+        )
+        return cur.rowcount
+
+    async def deliver(self, bot, limiter: TokenBucket, stats: BroadcastStats, rows: list) -> list:
+        # rows: (id, chat_id, payload); najvise self.workers poruka je istovremeno u letu
+        slots = asyncio.Semaphore(self.workers)
+
+        async def one(row_id: int, chat_id: int, payload: str) -> str:
+            async with slots:
+                try:
+                    result = await send_with_retry(bot, limiter, stats, chat_id, **self.decode(payload))
+                except Exception as e:
+                    logger.error("Outbox greska za chat_id=%s: %r", chat_id, e)
+                    result = "retry"
+                self.mark(row_id, result)
+                metrics.inc("outbox_delivered_total", result=result)
+                return result
+
+        ids = [row[0] for row in rows]
+        self._inflight.update(ids)
+        try:
+            return await asyncio.gather(*(one(*row) for row in rows))
+        finally:
+            self._inflight.difference_update(ids)
+
+    async def send_rendered(
+        self,
+        bot,
+        limiter: TokenBucket,
+        stats: BroadcastStats,
+        chat_ids: list,
+        rendered: list,
+        kind: str,
+        day: date,
+        parse_mode: Optional[str] = "HTML",
+    ) -> list:
+        payloads = [self.encode(r[0], parse_mode, r[1]) if r is not None else None for r in rendered]
+        return await self.send_payloads(bot, limiter, stats, chat_ids, payloads, kind, day)
+
+    async def send_payloads(
+        self,
+        bot,
+        limiter: TokenBucket,
+        stats: BroadcastStats,
+        chat_ids: list,
+        payloads: list,
+        kind: str,
+        day: date,
+    ) -> list:
+        # payloads su vec kodirani (encode), npr. iz pre-render tabele; None = render nije uspeo
+        keys = [self.idempotency_key(chat_id, kind, day) for chat_id in chat_ids]
+        self.enqueue_many([
+            (key, chat_id, kind, payload)
+            for key, chat_id, payload in zip(keys, chat_ids, payloads)
+            if payload is not None
+        ])
+        stored = self.status_of(keys)
+        now = time.time()
+        results: list = [None] * len(keys)
+        to_send, positions = [], []
+        for i, key in enumerate(keys):
+            row = stored.get(key)
+            if row is None:
+                results[i] = "failed"  # render nije uspeo
+            elif row[3] != "pending" or row[0] in self._inflight:
+                results[i] = "skipped"
+            elif row[4] > now:
+                results[i] = "retry"  # ceka backoff posle neuspelog slanja; salje ga drain
+            else:
+                to_send.append(tuple(row[:3]))
+                positions.append(i)
+        for i, result in zip(positions, await self.deliver(bot, limiter, stats, to_send)):
+            results[i] = result
+        return results
+
+    async def drain(self, bot, limit: int = 500) -> int:
+        now = time.time()
+        rows = self.due(limit)
+        expired = [row[0] for row in rows if row[3] < now]
+        for row_id in expired:
+            self.mark(row_id, "expired")
+        rows = [row[:3] for row in rows if row[3] >= now]
+        if not rows:
+            return 0
+        started = time.monotonic()
+        stats = BroadcastStats(len(rows))
+        results = await self.deliver(bot, self.limiter, stats, rows)
+        sent = results.count("sent")
+        metrics.set_gauge("outbox_drain_rate", sent / max(time.monotonic() - started, 1e-9))
+        logger.info("Outbox drain: %s/%s poslato, %s isteklo", sent, len(rows), len(expired))
+        return sent
+
+def outbox_of(application) -> Optional[Outbox]:
+    persistence = application.persistence
+    return persistence.outbox if isinstance(persistence, SQLitePersistence) else None
+
+async def send_via_outbox(application, chat_id: int, kind: str, text: str, parse_mode: Optional[str] = None, reply_markup=None) -> str:
+    outbox = outbox_of(application)
+    if outbox is None:
+        await application.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, reply_markup=reply_markup)
+        return "sent"
+    day = user_today(chat_profile(application, chat_id))
+    results = await outbox.send_rendered(
+        application.bot, outbox.limiter, BroadcastStats(1), [chat_id], [(text, reply_markup)], kind, day,
+        parse_mode=parse_mode,
     )
+    return results[0]
+
+async def outbox_drain_job(context: ContextTypes.DEFAULT_TYPE):
+    outbox = outbox_of(context.application)
+    if outbox is None:
+        return
+    cluster = cluster_of(context.application)
+    if cluster is not None and not cluster.is_leader:
+        return
+    await outbox.drain(context.bot)
+    metrics.set_gauge("outbox_depth", outbox.depth())
+
+async def outbox_prune_job(context: ContextTypes.DEFAULT_TYPE):
+    outbox = outbox_of(context.application)
+    if outbox is not None:
+        logger.info("Outbox: obrisano %s starih poruka", outbox.prune())
+        staging = context.application.persistence.staging
+        pruned = staging.prune(datetime.now(TZ).date() - timedelta(days=1))
+        logger.info("Pre-render: obrisano %s starih poruka", pruned)
+
+def schedule_outbox(jq):
+    jq.run_repeating(timed(outbox_drain_job), interval=OUTBOX_POLL, first=OUTBOX_POLL, name="outbox_drain")
+    jq.run_daily(timed(outbox_prune_job), time=dtime(hour=4, minute=0, tzinfo=TZ), name="outbox_prune")
+
+# --- SPAM DUGMADI ---
+# Dugmad (Danas, raspolozenje) se lako spamuju, a svaki klik je render plus edit poruke.
+# Po chatu: token bucket (CALLBACK_RATE/s, do CALLBACK_BURST zaredom); isti klik na istu
+# poruku u roku od CALLBACK_COALESCE_SECONDS se spaja sa prethodnim; edit se preskace ako
+# je tekst isti kao poslednji poslat u tu poruku (Telegram bi vratio "message is not modified").
+# Hash-evi se pamte po procesu, pa u CLUSTER_MODE (drugi radnik je mogao da izmeni istu
+# poruku) preskakanja nema i oslanjamo se samo na gresku "message is not modified".
+CALLBACK_RATE = float(os.getenv("CALLBACK_RATE", "1"))
+CALLBACK_BURST = int(os.getenv("CALLBACK_BURST", "4"))
+CALLBACK_COALESCE_SECONDS = float(os.getenv("CALLBACK_COALESCE_SECONDS", "2"))
+CALLBACK_STATE_KEPT = 10_000  # chatova (bucket) i poruka (hash teksta) u memoriji
+
+class CallbackGuard:
+    def __init__(
+        self,
+        rate: float = CALLBACK_RATE,
+        burst: int = CALLBACK_BURST,
+        coalesce: float = CALLBACK_COALESCE_SECONDS,
+        kept: int = CALLBACK_STATE_KEPT,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.coalesce = coalesce
+        self.kept = kept
+        self._chats: dict = {}  # chat_id -> [tokens, updated, poslednji klik, kada]
+        self._edits: OrderedDict = OrderedDict()  # (chat_id, message_id) -> hash poslednjeg teksta
+
+    def admit(self, chat_id: int, click) -> Optional[str]:
+        # None = obradi klik; inace razlog zasto ga preskacemo
+        now = time.monotonic()
+        state = self._chats.get(chat_id)
+        if state is None:
+            if len(self._chats) >= self.kept:
+                self._evict(now)
+            state = self._chats[chat_id] = [float(self.burst), now, None, float("-inf")]
+        if state[2] == click and now - state[3] < self.coalesce:
+            return "coalesced"
+        state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate)
+        state[1] = now
+        if state[0] < 1:
+            return "limited"
+        state[0] -= 1
+        state[2], state[3] = click, now
+        return None
+
+    def _evict(self, now: float):
+        # chat ciji je bucket pun i prozor za spajanje istekao nema sta da pamti
+        idle = max(self.coalesce, self.burst / self.rate)
+        self._chats = {k: v for k, v in self._chats.items() if now - v[1] < idle}
+
+    def unchanged(self, key: tuple, digest: int) -> bool:
+        if self._edits.get(key) != digest:
+            return False
+        self._edits.move_to_end(key)
+        return True
+
+    def remember(self, key: tuple, digest: int):
+        self._edits[key] = digest
+        self._edits.move_to_end(key)
+        if len(self._edits) > self.kept:
+            self._edits.popitem(last=False)
+
+callback_guard = CallbackGuard()
+
+async def edit_callback_message(query, text: str, parse_mode: Optional[str] = None, reply_markup=None):
+    # Sve izmene poruka idu ovuda, da zapamceni hash odgovara stvarnom tekstu poruke
+    # (tacno samo sa jednim procesom, zato je kljuc None u CLUSTER_MODE).
+    message = query.message
+    key = (message.chat.id, message.message_id) if message is not None and not CLUSTER_MODE else None
+    markup_key = KEYBOARD_NAMES.get(id(reply_markup)) or (reply_markup.to_json() if reply_markup else None)
+    digest = hash((text, parse_mode, markup_key))
+    if key is not None and callback_guard.unchanged(key, digest):
+        metrics.inc("callback_edits_skipped_total")
+        return
+    try:
+        await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+        metrics.inc("callback_edits_skipped_total")
+    if key is not None:
+        callback_guard.remember(key, digest)
 
 # --- START SA ZAKAZIVANJEM ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = ensure_user_defaults(context)
-    chat_id = update.effective_chat.id
     user["seen_start"] = True
 
-    jq = context.application.job_queue
-    name = job_name_daily(chat_id)
-    if jq:
-        for j in jq.get_jobs_by_name(name):
-            j.schedule_removal()
-        jq.run_daily(
-            daily22_job,
-            time=dtime(hour=22, minute=0, tzinfo=TZ),
-            name=name,
-            chat_id=chat_id,
-        )
-
     await update.message.reply_text(
         "Hej, ja sam bot za ciklus, vreme, horoskop i raspolozenje. 🤖🩸\n\n"
-        "Svako veče u 22:00 stiže dnevna poruka automatski.\n"
+        f"Svako veče u {format_delivery_time(user)} stiže dnevna poruka automatski "
+        "(promeni sa /vreme HH:MM).\n"
         "Izaberi opciju:",
         reply_markup=main_menu_keyboard(),
     )
@@ -599,17 +3460,17 @@ async def setup_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     ensure_user_defaults(context)
-    await query.edit_message_text("Unesi duzinu ciklusa u danima (20–45), npr. 28:")
+    await edit_callback_message(query, "Unesi duzinu ciklusa u danima (20–45), npr. 28:")
     return SET_CYCLE_LENGTH
 
 async def set_cycle_length(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = ensure_user_defaults(context)
     try:
         value = int(update.message.text.strip())
-        if not 20 <= value <= 45:
+        if not CYCLE_MIN_LENGTH <= value <= CYCLE_MAX_LENGTH:
             raise ValueError
     except ValueError:
-        await update.message.reply_text("Molim te, upisi broj između 20 i 45.")
+        await update.message.reply_text(f"Molim te, upisi broj između {CYCLE_MIN_LENGTH} i {CYCLE_MAX_LENGTH}.")
         return SET_CYCLE_LENGTH
     user["cycle_length"] = value
     await update.message.reply_text("Ok. Koliko dana traje menstruacija (2–10), npr. 5?")
@@ -619,10 +3480,10 @@ async def set_period_length(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = ensure_user_defaults(context)
     try:
         value = int(update.message.text.strip())
-        if not 2 <= value <= 10:
+        if not PERIOD_MIN_LENGTH <= value <= PERIOD_MAX_LENGTH:
             raise ValueError
     except ValueError:
-        await update.message.reply_text("Molim te, upisi broj između 2 i 10.")
+        await update.message.reply_text(f"Molim te, upisi broj između {PERIOD_MIN_LENGTH} i {PERIOD_MAX_LENGTH}.")
         return SET_PERIOD_LENGTH
     user["period_length"] = value
     await update.message.reply_text("Super. Pošalji datum poslednje menstruacije (dd.mm.yyyy), npr. 21.11.2025.")
@@ -631,7 +3492,7 @@ async def set_period_length(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def set_last_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = ensure_user_defaults(context)
     date_obj = parse_date(update.message.text)
-    today = datetime.now(TZ).date()
+    today = user_today(user)
     if not date_obj:
         await update.message.reply_text("Ne mogu da pročitam datum. Probaj format: 21.11.2025.")
         return SET_LAST_START
@@ -641,21 +3502,15 @@ async def set_last_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if (today - date_obj).days > 90:
         await update.message.reply_text("Datum je previše star. Unesi poslednju menstruaciju iz poslednja 3 meseca.")
         return SET_LAST_START
+    previous_start = user.get("last_start")
+    if previous_start is not None and date_obj > previous_start:
+        # Novi pocetak ne brise stari: razmak ulazi u istoriju i uci duzinu ciklusa.
+        history = user.get("cycle_history") or CycleHistory()
+        if history.add_start(previous_start, date_obj):
+            user["cycle_history"] = history
     user["last_start"] = date_obj
     user["bad_mood_streak"] = 0
-
-    chat_id = update.effective_chat.id
-    jq = context.application.job_queue
-    name = job_name_daily(chat_id)
-    if jq:
-        for j in jq.get_jobs_by_name(name):
-            j.schedule_removal()
-        jq.run_daily(
-            daily22_job,
-            time=dtime(hour=22, minute=0, tzinfo=TZ),
-            name=name,
-            chat_id=chat_id,
-        )
+    user["seen_start"] = True
 
     await update.message.reply_text(
         "Zabeleženo. Sada izaberi horoskopski znak ili preskoči.",
@@ -667,54 +3522,109 @@ async def set_star_sign(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user = ensure_user_defaults(context)
-    chat_id = update.effective_chat.id
 
     if query.data == "sign_skip":
         user["star_sign"] = None
     else:
         user["star_sign"] = query.data.split("_", 1)[1]
 
-    jq = context.application.job_queue
-    name = job_name_daily(chat_id)
-    if jq:
-        for j in jq.get_jobs_by_name(name):
-            j.schedule_removal()
-        jq.run_daily(
-            daily22_job,
-            time=dtime(hour=22, minute=0, tzinfo=TZ),
-            name=name,
+    await edit_callback_message(
+        query,
+        "Iz kog si grada? Napiši ime grada (npr. Novi Sad, Niš, Beč) ili pošalji - za Beograd."
+    )
+    return SET_CITY
+
+async def check_city(bot, chat_id: int, city: str):
+    # Posle odgovora, u pozadini: zagreje kes (prva dnevna poruka vec ima vreme) i javi ako grad ne postoji.
+    await weather.fetch(city)
+    if weather.is_unknown(city):
+        await bot.send_message(
             chat_id=chat_id,
+            text=f"Ne pronalazim grad „{city}“, pa u dnevnoj poruci neće biti vremena. "
+            "Promeni ga u Podesi ciklus (ili pošalji - za Beograd).",
         )
 
+async def set_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = ensure_user_defaults(context)
+    city = normalize_city(update.message.text)
+    if city and WEATHER_API_KEY:
+        if weather.is_unknown(city):
+            await update.message.reply_text("Ne pronalazim taj grad. Probaj ponovo ili pošalji - za Beograd.")
+            return SET_CITY
+        # Handler ne ceka OpenWeatherMap: grad se prihvata odmah, a proverava u pozadini.
+        context.application.create_task(check_city(context.bot, update.effective_chat.id, city), update=update)
+    user["city"] = city
+
     info = calc_next_dates(user)
     sign_txt = user["star_sign"] if user["star_sign"] else "nije podešeno"
     text = "✅ Podešavanje završeno!\n\n"
     if info:
         text += (
             f"Znak: {sign_txt}\n"
+            f"Grad: {city or 'Beograd'}\n"
             f"Sledeća menstruacija oko: {info['next_start'].strftime('%d.%m.%Y.')}\n"
             f"Plodni dani: {info['fertile_start'].strftime('%d.%m.%Y.')} – {info['fertile_end'].strftime('%d.%m.%Y.')}\n\n"
         )
-    text += "Svako veče u 22:00 stiže dnevna poruka automatski. 🚀"
-    await query.edit_message_text(text, reply_markup=main_menu_keyboard())
+    text += f"Svako veče u {format_delivery_time(user)} stiže dnevna poruka automatski. 🚀"
+    await update.message.reply_text(text, reply_markup=main_menu_keyboard())
     return ConversationHandler.END
 
+async def delivery_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = ensure_user_defaults(context)
+    if not context.args:
+        await update.message.reply_text(
+            f"Dnevna poruka stiže u {format_delivery_time(user)}.\n"
+            "Promena: /vreme HH:MM [zona], npr. /vreme 21:30 ili /vreme 08:00 Europe/London"
+        )
+        return
+    minute = parse_delivery_time(context.args[0])
+    if minute is None:
+        await update.message.reply_text("Vreme upiši kao HH:MM, npr. 21:30.")
+        return
+    timezone = user.get("timezone") or DEFAULT_TIMEZONE
+    if len(context.args) > 1:
+        try:
+            timezone = zone(context.args[1]).key
+        except (ValueError, ZoneInfoNotFoundError):
+            await update.message.reply_text("Ne poznajem tu vremensku zonu. Primer: Europe/Vienna, America/New_York.")
+            return
+    user["delivery_minute"] = minute
+    user["timezone"] = timezone
+    scheduler = scheduler_of(context.application)
+    if scheduler is not None:
+        scheduler.add_timezone(timezone)
+    await update.message.reply_text(f"✅ Dnevna poruka će stizati u {format_delivery_time(user)}.")
+
 async def cb_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    if update.effective_chat is None:
+        # Dugme iz inline poruke (inline_message_id, bez chata): nema chat_data ni profila.
+        metrics.inc("callbacks_dropped_total", reason="inline")
+        await query.answer()
+        return
+    message_id = query.message.message_id if query.message is not None else None
+    skipped = callback_guard.admit(update.effective_chat.id, (message_id, query.data))
+    if skipped is not None:
+        # Ponovljen ili prebrz klik: samo ugasimo "sat" na dugmetu, bez render-a i edit-a.
+        metrics.inc("callbacks_dropped_total", reason=skipped)
+        await query.answer("Polako 🙂" if skipped == "limited" else None)
+        return
     await query.answer()
     user = ensure_user_defaults(context)
     data = query.data
     if data.startswith("mood_"):
         mood_key = data.split("_", 1)[1]
-        if not user.get("last_start"):
-            await query.edit_message_text(
-                "Nemam datum poslednje menstruacije.\nUdji na Podesi ciklus i unesi datum.",
-                reply_markup=main_menu_keyboard(),
-            )
+        cycle_day, phase = get_cycle_state_for_today(user)
+        if cycle_day is None:
+            await edit_callback_message(query, no_state_text(user), reply_markup=main_menu_keyboard())
             return
         update_streak(user, mood_key)
-        text = build_mood_message(user, mood_key)
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=main_menu_keyboard())
+        if mood_key in MOOD_CODES and isinstance(context.application.persistence, SQLitePersistence):
+            context.application.persistence.record_mood(
+                update.effective_chat.id, user_today(user), mood_key, phase, cycle_day
+            )
+        text = build_mood_message(user, mood_key, update.effective_chat.id)
+        await edit_callback_message(query, text, parse_mode="HTML", reply_markup=main_menu_keyboard())
         return
     if data == "status":
         info = calc_next_dates(user)
@@ -727,6 +3637,8 @@ async def cb_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Trajanje menstruacije: {user['period_length']} dana\n"
                 f"Poslednji pocetak: {user['last_start'].strftime('%d.%m.%Y.')}\n"
                 f"Znak: {user['star_sign'] if user.get('star_sign') else 'nije podešeno'}\n"
+                f"Grad: {user.get('city') or 'Beograd'}\n"
+                f"Dnevna poruka: {format_delivery_time(user)}\n"
             )
             if info:
                 text += (
@@ -735,50 +3647,96 @@ async def cb_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"Plodni dani: {info['fertile_start'].strftime('%d.%m.%Y.')} – {info['fertile_end'].strftime('%d.%m.%Y.')}\n"
                     f"Kraj tekuće menstruacije: {info['period_end'].strftime('%d.%m.%Y.')}\n"
                 )
-        await query.edit_message_text(text, reply_markup=main_menu_keyboard())
+                history = user.get("cycle_history")
+                if history is not None and history.predict() is not None:
+                    text += (
+                        f"\n🧮 Naučeno iz {history.n} ciklusa: oko {info['cycle_length']} dana, "
+                        f"sledeća menstruacija između {info['next_start_earliest'].strftime('%d.%m.')} "
+                        f"i {info['next_start_latest'].strftime('%d.%m.%Y.')}\n"
+                    )
+        await edit_callback_message(query, text, reply_markup=main_menu_keyboard())
+        return
+    if data.startswith("kal_"):
+        page = max(0, min(CALENDAR_MONTHS - 1, int(data[4:]) if data[4:].isdigit() else 0))
+        text = calendar_text(user, page)
+        if text is None:
+            await edit_callback_message(
+                query,
+                "Nemam datum poslednje menstruacije. Udji na Podesi ciklus i unesi datum.",
+                reply_markup=main_menu_keyboard(),
+            )
+            return
+        await edit_callback_message(query, text, parse_mode="HTML", reply_markup=CALENDAR_KEYBOARDS[page])
         return
     if data == "today":
-        text = build_today_overview(user) + "\n\nKako ti je prosao dan? Izaberi najblizu opciju:"
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=mood_keyboard())
+        text = DAILY_MESSAGE.render(overview=build_today_overview(user, update.effective_chat.id))
+        await edit_callback_message(query, text, parse_mode="HTML", reply_markup=mood_keyboard())
         return
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    metrics.inc("unhandled_errors_total", type=type(context.error).__name__)
     logger.exception("Unhandled error", exc_info=context.error)
 
 async def post_init(application):
-    jq = application.job_queue
-    if jq is None:
-        return
-    for chat_id, data in list(application.chat_data.items()):
-        try:
-            if not isinstance(chat_id, int) or not isinstance(data, dict):
-                continue
-            if not data.get("seen_start"):
-                continue
-            name = job_name_daily(chat_id)
-            for j in jq.get_jobs_by_name(name):
-                j.schedule_removal()
-            jq.run_daily(
-                daily22_job,
-                time=dtime(hour=22, minute=0, tzinfo=TZ),
-                name=name,
-                chat_id=chat_id,
-            )
-            logger.info(f"Rescheduled daily job for chat_id={chat_id}")
-        except Exception as e:
-            logger.exception(f"post_init reschedule greska {e}")
-
-def main():
-    persistence = PicklePersistence(filepath=PERSISTENCE_PATH)
-
-    app = (
+    if PROFILE_ENABLED:
+        profiler.start()
+    await weather.start()
+    weather.refresh_in_background(DEFAULT_CITY)
+    if application.job_queue is not None:
+        schedule_broadcast(application.job_queue)
+        schedule_outbox(application.job_queue)
+        # Job queue krece tek posle webhook servera, pa je ruta tada vec spremna za kacenje.
+        application.job_queue.run_once(attach_metrics_job, when=0)
+    cluster = cluster_of(application)
+    if cluster is not None:
+        ClusterUpdateProcessor.check_cluster_support(application)  # stanje razgovora je ucitano tek posle initialize
+        await cluster.try_lead()
+        if application.job_queue is not None:
+            application.job_queue.run_repeating(timed(lease_job), interval=LEASE_TTL / 3, first=LEASE_TTL / 3, name="cluster_lease")
+    boot_started = application.bot_data.pop("boot_started", None)
+    if boot_started is not None:
+        application.bot_data["startup_seconds"] = time.monotonic() - boot_started
+        logger.info("Startup zavrsen za %.3fs", application.bot_data["startup_seconds"])
+
+async def post_shutdown(application):
+    profiler.stop()
+    await weather.close()
+    cluster = cluster_of(application)
+    if cluster is not None:
+        cluster.close()
+
+def build_application(
+    persistence: BasePersistence,
+    bot_api_url: Optional[str] = BOT_API_URL,
+    cluster: Optional[ClusterCoordinator] = None,
+):
+    if not TOKEN:
+        raise RuntimeError("BOT_TOKEN env variable nije podesena")
+    builder = (
         ApplicationBuilder()
         .token(TOKEN)
         .persistence(persistence)
         .post_init(post_init)
-        .build()
+        .post_shutdown(post_shutdown)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .context_types(ContextTypes(chat_data=UserProfile))
     )
-
+    if bot_api_url:
+        builder = builder.base_url(bot_api_url)
+    processor = None
+    if cluster is not None:
+        processor = ClusterUpdateProcessor(cluster, max(1, MAX_CONCURRENT_UPDATES))
+    elif MAX_CONCURRENT_UPDATES > 1:
+        processor = PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES)
+    if processor is not None:
+        builder = builder.concurrent_updates(processor)
+    app = builder.build()
+    if cluster is not None:
+        processor.application = app
+
+    # Razgovor mesa tekstualne korake i dugmad, pa se vodi po (chat, korisnik); per_message=True
+    # bi dozvolio samo CallbackQueryHandler-e. PTB zato pri pokretanju upozorava da se dugmad
+    # ne prate po poruci, sto je ovde ocekivano.
     conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(setup_entry, pattern="^setup$")],
         states={
@@ -786,23 +3744,212 @@ def main():
             SET_PERIOD_LENGTH: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_period_length)],
             SET_LAST_START: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_last_start)],
             SET_STAR_SIGN: [CallbackQueryHandler(set_star_sign, pattern="^(sign_.*|sign_skip)$")],
+            SET_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_city)],
         },
         fallbacks=[
             CommandHandler("cancel", cancel_setup),
             CommandHandler("start", start),
         ],
         allow_reentry=True,
+        name="setup",
+        persistent=True,
+        per_message=False,
     )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("test22", test22))
     app.add_handler(CommandHandler("ping", ping))
     app.add_handler(CommandHandler("jobs", jobs))
+    app.add_handler(CommandHandler("profil", profil))
     app.add_handler(CommandHandler("testin1", testin1))
     app.add_handler(CommandHandler("nextrun", nextrun))
+    app.add_handler(CommandHandler("statistika", statistika))
+    app.add_handler(CommandHandler("vreme", delivery_time))
+    app.add_handler(CommandHandler("izvestaj", izvestaj))
+    app.add_handler(CommandHandler("kalendar", kalendar))
     app.add_handler(conv_handler)
     app.add_handler(CallbackQueryHandler(cb_router))
     app.add_error_handler(error_handler)
+    for handlers in app.handlers.values():
+        instrument_handlers(handlers)
+    return app
+
+# --- IZVOZ / UVOZ KORISNIKA ---
+# Selidba korisnika izmedju hostova bez kopiranja baze ili pickle fajla:
+#   python ciklus_bot.py export korisnici.jsonl      (ili .csv)
+#   python ciklus_bot.py import korisnici.jsonl [--skip N]
+# Oba smera idu kroz generatore, u batch-evima od TRANSFER_BATCH redova, pa memorija ne
+# zavisi od broja korisnika. Uvoz je upsert po chat_id: posle pada se samo ponovi (ili
+# nastavi sa --skip od poslednjeg prijavljenog reda). Uvoz pokretati dok bot ne radi.
+TRANSFER_BATCH = 5000
+TRANSFER_PROGRESS_EVERY = 100_000
+EXPORT_FIELDS = ("chat_id", *CHAT_COLUMNS)
+INT_FIELDS = {"chat_id", "cycle_length", "period_length", "bad_mood_streak", "delivery_minute"}
+
+def export_record(chat_id: int, row) -> dict:
+    record = {"chat_id": chat_id}
+    for field, value in zip(CHAT_COLUMNS, row):
+        if value is not None:
+            value = from_db_value(field, value)
+            if field in DATE_FIELDS:
+                value = value.isoformat()
+            elif field in HISTORY_FIELDS:
+                value = {"count": value.count, "lengths": value.ordered()}
+        record[field] = value
+    return record
+
+def import_record(record: dict):
+    # (chat_id, red za write_rows); radi i za JSONL i za CSV (gde je sve string)
+    values = {}
+    for field in EXPORT_FIELDS:
+        value = record.get(field)
+        if value is None or value == "":
+            continue
+        if field in DATE_FIELDS:
+            value = date.fromisoformat(value)
+        elif field in BOOL_FIELDS:
+            value = value in (True, 1, "1", "true", "True")
+        elif field in HISTORY_FIELDS:
+            if isinstance(value, str):
+                value = json.loads(value)
+            lengths = value["lengths"]
+            value = CycleHistory.from_bytes(
+                CycleHistory.HEADER.pack(value["count"], len(lengths)) + array("H", lengths).tobytes()
+            )
+        elif field in INT_FIELDS:
+            value = int(value)
+        values[field] = value
+    chat_id = values.pop("chat_id")
+    check_profile(values)
+    # Kroz UserProfile, da polja kojih nema u zapisu dobiju iste vrednosti kao kod novog korisnika.
+    return chat_id, SQLitePersistence.row_from_chat_data(UserProfile(values))
+
+PROFILE_RANGES = {
+    "cycle_length": (CYCLE_MIN_LENGTH, CYCLE_MAX_LENGTH),
+    "period_length": (PERIOD_MIN_LENGTH, PERIOD_MAX_LENGTH),
+    "delivery_minute": (0, 24 * 60 - 1),
+}
+
+def check_profile(values: dict) -> None:
+    # Iste granice kao kod podesavanja i /vreme; los zapis ne sme da stigne do baze
+    # (npr. nepoznata zona bi posle rusila svaki tik DeliveryScheduler-a).
+    for field, (low, high) in PROFILE_RANGES.items():
+        if field in values and not low <= values[field] <= high:
+            raise ValueError(f"{field}={values[field]} van {low}-{high}")
+    star_sign = values.get("star_sign")
+    if star_sign is not None and star_sign not in SIGN_INDEX:
+        raise ValueError(f"nepoznat znak {star_sign!r}")
+    if "timezone" in values and not known_timezone(values["timezone"]):
+        raise ValueError(f"nepoznata vremenska zona {values['timezone']!r}")
+
+class TransferProgress:
+    def __init__(self, action: str, total: Optional[int] = None):
+        self.action = action
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+        self._next = TRANSFER_PROGRESS_EVERY
+        self._logged = -1
+
+    def advance(self, rows: int, force: bool = False, position: Optional[int] = None):
+        self.done += rows
+        if (self.done < self._next and not force) or self.done == self._logged:
+            return
+        self._logged = self.done
+        self._next = self.done + TRANSFER_PROGRESS_EVERY
+        elapsed = time.monotonic() - self.started
+        done = f"{self.done}/{self.total} ({self.done / self.total:.0%})" if self.total else str(self.done)
+        resume = f", upisano do zapisa {position}" if position is not None else ""
+        logger.info("%s: %s, %.0f redova/s%s", self.action, done, self.done / max(elapsed, 1e-9), resume)
+
+def export_users(persistence: SQLitePersistence, path: str, fmt: str) -> int:
+    progress = TransferProgress("Izvoz", persistence.chat_count())
+    # Pisemo u privremeni fajl pa ga zamenimo, da prekinut izvoz ne ostavi pola fajla.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, EXPORT_FIELDS) if fmt == "csv" else None
+        if writer is not None:
+            writer.writeheader()
+        for rows in persistence.iter_rows(TRANSFER_BATCH):
+            records = (export_record(chat_id, row) for chat_id, *row in rows)
+            if writer is not None:
+                writer.writerows(
+                    {k: json.dumps(v) if isinstance(v, dict) else int(v) if isinstance(v, bool) else v for k, v in r.items()}
+                    for r in records
+                )
+            else:
+                f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+            progress.advance(len(rows))
+    os.replace(tmp_path, path)
+    progress.advance(0, force=True)
+    return progress.done
+
+def read_records(path: str, fmt: str, skip: int = 0):
+    # (redni broj, zapis): dict za CSV, neparsirana linija za JSONL; broj ide u --skip za nastavak
+    with open(path, encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            for number, record in enumerate(csv.DictReader(f), start=1):
+                if number > skip:
+                    yield number, record
+            return
+        lines = (line for line in f if line.strip())
+        for number, line in enumerate(lines, start=1):
+            if number > skip:
+                yield number, line
+
+def import_users(persistence: SQLitePersistence, path: str, fmt: str, skip: int = 0) -> tuple:
+    progress = TransferProgress("Uvoz")
+    errors = 0
+    batch: dict = {}
+    last = skip
+    for number, record in read_records(path, fmt, skip):
+        try:
+            chat_id, row = import_record(json.loads(record) if isinstance(record, str) else record)
+        except (KeyError, TypeError, ValueError, OverflowError, struct.error) as e:
+            errors += 1
+            logger.warning("Uvoz: red %s preskocen: %r", number, e)
+            continue
+        batch[chat_id] = row
+        last = number
+        if len(batch) >= TRANSFER_BATCH:
+            persistence.write_rows(batch, remember=False)
+            progress.advance(len(batch), position=last)
+            batch = {}
+    persistence.write_rows(batch, remember=False)
+    progress.advance(len(batch), force=True, position=last)
+    return progress.done, errors
+
+def admin_cli(argv: list) -> int:
+    parser = argparse.ArgumentParser(prog="ciklus_bot.py", description="Izvoz i uvoz korisnika")
+    parser.add_argument("--db", default=DB_PATH, help="SQLite baza (podrazumevano DB_PATH)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="izvezi sve korisnike u JSONL/CSV")
+    import_parser = commands.add_parser("import", help="uvezi korisnike iz JSONL/CSV (upsert po chat_id)")
+    for sub in (export_parser, import_parser):
+        sub.add_argument("path")
+        sub.add_argument("--format", choices=("jsonl", "csv"), help="podrazumevano po ekstenziji fajla")
+    import_parser.add_argument("--skip", type=int, default=0, help="preskoci prvih N zapisa (nastavak prekinutog uvoza)")
+    args = parser.parse_args(argv)
+    fmt = args.format or ("csv" if args.path.lower().endswith(".csv") else "jsonl")
+    persistence = SQLitePersistence(args.db)
+    if args.command == "export":
+        exported = export_users(persistence, args.path, fmt)
+        logger.info("Izvezeno %s korisnika u %s", exported, args.path)
+        return 0
+    imported, errors = import_users(persistence, args.path, fmt, args.skip)
+    logger.info("Uvezeno %s korisnika iz %s, %s neispravnih redova", imported, args.path, errors)
+    return 1 if errors else 0
+
+def main():
+    boot_started = time.monotonic()
+    persistence = SQLitePersistence(DB_PATH)
+    if os.path.exists(PERSISTENCE_PATH) and persistence.is_empty():
+        migrated = migrate_pickle(PERSISTENCE_PATH, persistence)
+        logger.info("Migrirano %s chatova iz %s u %s", migrated, PERSISTENCE_PATH, DB_PATH)
+
+    cluster = ClusterCoordinator(DB_PATH) if CLUSTER_MODE else None
+    app = build_application(persistence, cluster=cluster)
+    app.bot_data["boot_started"] = boot_started
 
     webhook_base = os.getenv("WEBHOOK_BASE_URL")
     if not webhook_base:
@@ -821,4 +3968,6 @@ def main():
     )
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        raise SystemExit(admin_cli(sys.argv[1:]))
     main()
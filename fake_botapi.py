@@ -0,0 +1,180 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qsl
+
+# Lokalni lazni Telegram Bot API za benchmark i testiranje, bez stvarnog Telegrama.
+# Bot se na njega usmerava preko BOT_API_URL (vidi FakeBotAPI.url).
+# Za load test moze da glumi sporu mrezu (latency/jitter) i da vraca 429 kao pravi
+# Telegram: nasumicno (error_rate) ili kad se predje globalni limit poruka (rate_limit).
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Ciklus", "username": "ciklus_test_bot"}
+
+MESSAGE_METHODS = ("sendMessage", "editMessageText", "answerCallbackQuery")
+
+def parse_params(content_type: str, body: bytes) -> dict:
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/"):
+        return {}  # fajlovi (sendDocument) nas ne zanimaju
+    params = {}
+    for key, value in parse_qsl(body.decode("utf-8"), keep_blank_values=True):
+        # PTB salje ne-string vrednosti kao JSON
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit: Optional[float] = None,
+        retry_after: int = 1,
+        on_call: Optional[Callable[[str, dict, int], None]] = None,
+    ):
+        self.calls: dict = {}
+        self.rate_limited: dict = {}  # metod -> broj vracenih 429
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit  # poruka u sekundi za ceo bot, kao Telegram (~30/s)
+        self.retry_after = retry_after
+        self.on_call = on_call  # poziva se iz niti servera: (metod, parametri, HTTP status)
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._tokens = rate_limit or 0.0
+        self._refilled = time.monotonic()
+        self._thread: Optional[threading.Thread] = None
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                params = parse_params(self.headers.get("Content-Type", ""), body)
+                delay = api.latency + random.uniform(0, api.jitter) if api.jitter else api.latency
+                if delay > 0:
+                    time.sleep(delay)
+                status, payload = api.handle(method, params)
+                if api.on_call is not None:
+                    api.on_call(method, params, status)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self) -> "FakeBotAPI":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "FakeBotAPI":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _next_message(self, params: dict) -> dict:
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": params.get("message_id", message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    def _throttled(self, method: str) -> bool:
+        if method not in MESSAGE_METHODS:
+            return False
+        if self.error_rate and random.random() < self.error_rate:
+            return True
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+            self._refilled = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+    def handle(self, method: str, params: dict):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self._throttled(method):
+            with self._lock:
+                self.rate_limited[method] = self.rate_limited.get(method, 0) + 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            return 200, {"ok": True, "result": self._next_message(params)}
+        if method in ("answerCallbackQuery", "setWebhook", "deleteWebhook", "setMyCommands"):
+            return 200, {"ok": True, "result": True}
+        return 404, {"ok": False, "error_code": 404, "description": f"Not Found: method {method}"}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lazni Telegram Bot API")
+    parser.add_argument("port", type=int, nargs="?", default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="kasnjenje odgovora u sekundama")
+    parser.add_argument("--jitter", type=float, default=0.0, help="dodatno nasumicno kasnjenje do N sekundi")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="udeo poruka koje dobiju 429")
+    parser.add_argument("--rate-limit", type=float, default=None, help="poruka/s pre nego sto krene 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+    )
+    print(f"[fake-botapi] {api.url} (BOT_API_URL)")
+    api.server.serve_forever()
@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from typing import Optional
+
+import httpx
+
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+
+import bench
+from fake_botapi import FakeBotAPI
+
+# Load test celog bota: ciklus_bot.py se pokrece kao poseban proces (pravi run_webhook),
+# usmeren na lokalni fake Bot API, i dobija sinteticke webhook update-e zadatim tempom.
+# Kasnjenje se meri od POST-a na webhook do odgovora bota (sendMessage/editMessageText)
+# koji stigne u fake API, dakle kroz ceo bot: tornado, update_queue, handler, Bot API.
+#   python loadtest.py --rate 300 --duration 60
+#   python loadtest.py --rate 500 --latency 0.05 --error-rate 0.01 --json rezultat.json
+#   python loadtest.py --bot-env MAX_CONCURRENT_UPDATES=256
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ciklus_bot.py")
+REPLY_METHODS = ("sendMessage", "editMessageText")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def ms(seconds: float) -> float:
+    return seconds * 1000
+
+def latency_summary(samples: list) -> dict:
+    return {
+        "p50_ms": ms(bench.percentile(samples, 50)),
+        "p95_ms": ms(bench.percentile(samples, 95)),
+        "p99_ms": ms(bench.percentile(samples, 99)),
+        "max_ms": ms(max(samples, default=0.0)),
+    }
+
+# --- VIRTUELNI KORISNICI ---
+class VirtualUser:
+    __slots__ = ("chat_id", "session", "step", "sent_at", "query_id")
+
+    def __init__(self, chat_id: int, today):
+        self.chat_id = chat_id
+        self.session = bench.user_session(chat_id, today)
+        self.step = 0
+        self.sent_at = 0.0
+        self.query_id: Optional[str] = None
+
+class LoadGenerator:
+    # Otvorena petlja: update-i krecu po rasporedu (rate), bez obzira na odgovore.
+    # Svaki virtuelni korisnik ima najvise jedan update u letu, pa je odgovor bota
+    # jednoznacno vezan za update; ako su svi zauzeti, update se broji kao "saturated".
+    def __init__(self, users: int, rate: float, duration: float, reply_timeout: float, concurrency: int):
+        today = bench.cb.datetime.now(bench.cb.TZ).date()
+        self.free = deque(VirtualUser(20_000 + i, today) for i in range(users))
+        self.rate = rate
+        self.duration = duration
+        self.reply_timeout = reply_timeout
+        self.concurrency = concurrency
+        self.pending: dict = {}  # chat_id -> VirtualUser koji ceka odgovor
+        self.queries: dict = {}  # callback_query_id -> chat_id
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.update_id = 0
+        self.sent = 0
+        self.saturated = 0
+        self.replies = 0
+        self.replies_in_window = 0
+        self.failed = 0
+        self.unanswered = 0
+        self.webhook_status: dict = {}
+        self.webhook_latency: list = []
+        self.reply_latency: list = []
+        self.load_seconds = 0.0
+        self._load_done = False
+
+    def on_call(self, method: str, params: dict, status: int):
+        # Poziva se iz niti fake API-ja; sve ostalo radi u event loop-u.
+        at = time.perf_counter()
+        if method in REPLY_METHODS:
+            chat_id = params.get("chat_id")
+        elif method == "answerCallbackQuery" and status != 200:
+            chat_id = self.queries.get(str(params.get("callback_query_id")))  # handler puca pre odgovora
+        else:
+            return
+        if chat_id is not None and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.complete, int(chat_id), status == 200, at)
+
+    def complete(self, chat_id: int, ok: bool, at: float):
+        user = self.pending.pop(chat_id, None)
+        if user is None:
+            return  # zakasneli odgovor posle reply_timeout
+        self.queries.pop(user.query_id, None)
+        if ok:
+            self.replies += 1
+            self.replies_in_window += not self._load_done
+            self.reply_latency.append(at - user.sent_at)
+            user.step = (user.step + 1) % len(user.session)
+        else:
+            self.failed += 1
+            user.step = 0  # razgovor je mozda u pola, krece ispocetka od /start
+        self.free.append(user)
+
+    def sweep(self, force: bool = False):
+        now = time.perf_counter()
+        for chat_id, user in list(self.pending.items()):
+            if force or now - user.sent_at > self.reply_timeout:
+                del self.pending[chat_id]
+                self.queries.pop(user.query_id, None)
+                self.unanswered += 1
+                user.step = 0
+                self.free.append(user)
+
+    async def sweep_forever(self):
+        while True:
+            await asyncio.sleep(0.5)
+            self.sweep()
+
+    def next_payload(self, user: VirtualUser) -> dict:
+        self.update_id += 1
+        kind, text = user.session[user.step]
+        if kind == "message":
+            user.query_id = None
+            return bench.message_update(self.update_id, user.chat_id, text)
+        user.query_id = str(self.update_id)
+        self.queries[user.query_id] = user.chat_id
+        return bench.callback_update(self.update_id, user.chat_id, text)
+
+    async def send(self, client: httpx.AsyncClient, url: str, user: VirtualUser):
+        payload = self.next_payload(user)
+        user.sent_at = time.perf_counter()
+        self.pending[user.chat_id] = user
+        try:
+            response = await client.post(url, json=payload)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        self.webhook_status[status] = self.webhook_status.get(status, 0) + 1
+        if status == 200:
+            self.webhook_latency.append(time.perf_counter() - user.sent_at)
+        else:
+            self.complete(user.chat_id, False, time.perf_counter())
+
+    async def run(self, url: str):
+        self.loop = asyncio.get_running_loop()
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            sweeper = asyncio.create_task(self.sweep_forever())
+            tasks: set = set()
+            started = time.perf_counter()
+            for i in range(int(self.rate * self.duration)):
+                # uvek prepusti loop, i kad kasnimo, da bi odgovori stigli da se obrade
+                await asyncio.sleep(max(0.0, started + i / self.rate - time.perf_counter()))
+                if not self.free:
+                    self.saturated += 1
+                    continue
+                self.sent += 1
+                task = asyncio.create_task(self.send(client, url, self.free.popleft()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            self.load_seconds = time.perf_counter() - started
+            self._load_done = True
+            await asyncio.gather(*list(tasks))
+            deadline = time.perf_counter() + self.reply_timeout
+            while self.pending and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+            sweeper.cancel()
+            self.sweep(force=True)
+
+    def report(self) -> dict:
+        webhook_errors = sum(n for status, n in self.webhook_status.items() if status != 200)
+        return {
+            "target_rate": self.rate,
+            "offered_rate": self.sent / self.load_seconds if self.load_seconds else 0.0,
+            "sustained_ops_s": self.replies_in_window / self.load_seconds if self.load_seconds else 0.0,
+            "sent": self.sent,
+            "replies": self.replies,
+            "saturated": self.saturated,
+            "webhook_status": {str(k): v for k, v in sorted(self.webhook_status.items(), key=str)},
+            "webhook_latency": latency_summary(self.webhook_latency),
+            "reply_latency": latency_summary(self.reply_latency),
+            "errors": {
+                "webhook": webhook_errors,
+                "failed_replies": self.failed,
+                "unanswered": self.unanswered,
+            },
+            "error_rate": (webhook_errors + self.failed + self.unanswered) / self.sent if self.sent else 0.0,
+        }
+
+# --- BOT PROCES ---
+def start_bot(api: FakeBotAPI, port: int, workdir: str, extra_env: dict) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        BOT_API_URL=api.url,
+        WEBHOOK_BASE_URL=f"http://127.0.0.1:{port}",
+        PORT=str(port),
+        DB_PATH=os.path.join(workdir, "loadtest.sqlite3"),
+        PERSISTENCE_PATH=os.path.join(workdir, "loadtest.pickle"),
+        WEATHER_API_KEY="",  # bez spoljnih poziva; vreme nije deo ovog merenja
+    )
+    env.update(extra_env)
+    log = open(os.path.join(workdir, "bot.log"), "wb")
+    return subprocess.Popen([sys.executable, BOT_SCRIPT], env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def bot_log_tail(workdir: str, lines: int = 20) -> str:
+    with open(os.path.join(workdir, "bot.log"), "rb") as f:
+        return "\n".join(f.read().decode("utf-8", "replace").splitlines()[-lines:])
+
+def wait_ready(proc: subprocess.Popen, api: FakeBotAPI, port: int, workdir: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"Bot se ugasio pri startu:\n{bot_log_tail(workdir)}")
+        if api.calls.get("setWebhook"):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                return
+            except OSError:
+                pass
+        time.sleep(0.1)
+    raise SystemExit(f"Bot nije spreman posle {timeout:.0f}s:\n{bot_log_tail(workdir)}")
+
+def stop_bot(proc: subprocess.Popen):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def scrape_bot_errors(port: int) -> dict:
+    # Greske handlera iz /metrics bota (ukljucujuci RetryAfter kad fake API vrati 429).
+    params = {"token": os.environ["METRICS_TOKEN"]} if os.getenv("METRICS_TOKEN") else None
+    try:
+        text = httpx.get(f"http://127.0.0.1:{port}/metrics", params=params, timeout=5).text
+    except httpx.HTTPError:
+        return {}
+    errors: dict = {}
+    for line in text.splitlines():
+        name = line.split("{", 1)[0].split(" ", 1)[0].removeprefix(f"{bench.cb.metrics.prefix}_")
+        if name in ("handler_errors_total", "unhandled_errors_total"):
+            errors[name] = errors.get(name, 0) + int(float(line.rsplit(" ", 1)[1]))
+    return errors
+
+def print_report(result: dict):
+    errors = result["errors"]
+    print(f"{'cilj / ponuđeno':24} {result['target_rate']:.0f}/s / {result['offered_rate']:.1f}/s ({result['saturated']} bez slobodnog korisnika)")
+    print(f"{'održivo':24} {result['sustained_ops_s']:.1f} update/s ({result['replies']}/{result['sent']} odgovoreno)")
+    for label, key in (("webhook POST", "webhook_latency"), ("odgovor bota", "reply_latency")):
+        lat = result[key]
+        print(f"{label:24} p50 {lat['p50_ms']:8.1f}ms  p95 {lat['p95_ms']:8.1f}ms  p99 {lat['p99_ms']:8.1f}ms  max {lat['max_ms']:8.1f}ms")
+    print(f"{'webhook statusi':24} {result['webhook_status']}")
+    print(
+        f"{'greške':24} {result['error_rate'] * 100:.2f}% "
+        f"(webhook {errors['webhook']}, neuspeli odgovori {errors['failed_replies']}, bez odgovora {errors['unanswered']})"
+    )
+    print(f"{'429 iz Bot API-ja':24} {result['bot_api_rate_limited']}")
+    print(f"{'greške u botu':24} {result['bot_errors']}")
+    print(f"{'Bot API pozivi':24} {result['bot_api_calls']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test ciklus bota preko webhook-a i laznog Bot API-ja")
+    parser.add_argument("--rate", type=float, default=200, help="update-a u sekundi")
+    parser.add_argument("--duration", type=float, default=30, help="trajanje opterecenja u sekundama")
+    parser.add_argument("--users", type=int, default=2000, help="broj virtuelnih korisnika")
+    parser.add_argument("--concurrency", type=int, default=256, help="najvise istovremenih POST-ova")
+    parser.add_argument("--reply-timeout", type=float, default=10, help="posle toga se update broji kao bez odgovora")
+    parser.add_argument("--latency", type=float, default=0.0, help="kasnjenje fake Bot API-ja u sekundama")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="udeo Bot API poziva koji dobiju 429")
+    parser.add_argument("--api-rate-limit", type=float, default=None, help="poruka/s pre nego sto fake API vrati 429")
+    parser.add_argument("--port", type=int, default=0, help="port webhook servera bota (0 = slobodan)")
+    parser.add_argument("--bot-env", action="append", default=[], metavar="KLJUC=VREDNOST")
+    parser.add_argument("--json", help="sacuvaj rezultat u JSON fajl")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    extra_env = dict(item.split("=", 1) for item in args.bot_env)
+    port = args.port or free_port()
+    generator = LoadGenerator(args.users, args.rate, args.duration, args.reply_timeout, args.concurrency)
+    api = FakeBotAPI(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit=args.api_rate_limit,
+        on_call=generator.on_call,
+    )
+    with tempfile.TemporaryDirectory() as workdir, api:
+        proc = start_bot(api, port, workdir, extra_env)
+        try:
+            wait_ready(proc, api, port, workdir)
+            asyncio.run(generator.run(f"http://127.0.0.1:{port}/{os.environ['BOT_TOKEN']}"))
+            bot_errors = scrape_bot_errors(port)
+        finally:
+            stop_bot(proc)
+        result = generator.report()
+        result["bot_errors"] = bot_errors
+        result["bot_api_calls"] = dict(api.calls)
+        result["bot_api_rate_limited"] = dict(api.rate_limited)
+
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print(f"Rezultat sacuvan u {args.json}")
+
+if __name__ == "__main__":
+    main()
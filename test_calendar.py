@@ -0,0 +1,53 @@
+import os
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+
+# Kalendar: strana meseca prikazuje projektovane faze po danima, deli se kroz LRU kes
+# medju korisnicima sa istim podesavanjima i lista se CALENDAR_MONTHS meseci unapred.
+
+def test_page_marks_projected_phases():
+    text = cb.calendar_page(date(2026, 10, 1), 28, 5, 2026, 10)
+    lines = text.split("\n")
+    assert lines[0] == "🗓 <b>Oktobar 2026</b>"
+    assert lines[1] == "<pre>" + cb.WEEKDAY_HEADER
+    # 1. oktobar 2026 je cetvrtak
+    assert lines[2] == " ".join(["   "] * 3 + [" 1M", " 2M", " 3M", " 4M"])
+    assert "🩸 Menstruacija: 1.–5., 29.–31." in lines
+    assert "🌱 Folikularna faza: 6.–13." in lines
+    assert "🥚 Ovulacija: 14." in lines
+    assert "🌙 Luteinska faza: 15.–28." in lines
+    assert "💞 Plodni dani: 11.–17." in lines
+    assert "14O" in text and "11P" in text
+
+def test_page_starts_at_last_start():
+    text = cb.calendar_page(date(2026, 10, 20), 28, 5, 2026, 10)
+    assert "🩸 Menstruacija: 20.–24." in text
+    assert "🌱 Folikularna faza: 25.–31." in text
+    # dani pre poslednje menstruacije nemaju oznaku
+    assert text.split("\n")[2] == " ".join(["   "] * 3 + [" 1 ", " 2 ", " 3 ", " 4 "]).rstrip()
+    assert "19  20M" in text
+
+def test_text_pages_from_local_month_and_shares_cache():
+    user = {"last_start": date(2026, 10, 1), "cycle_length": 28, "period_length": 5, "timezone": "Pacific/Kiritimati"}
+    assert cb.calendar_text({"timezone": "Europe/Belgrade"}, 0) is None
+
+    cb.calendar_page.cache_clear()
+    today = datetime.now(ZoneInfo("Pacific/Kiritimati")).date()
+    month_index = today.year * 12 + today.month - 1 + 2
+    text = cb.calendar_text(user, 2)
+    assert text.startswith(f"🗓 <b>{cb.MONTH_NAMES[month_index % 12]} {month_index // 12}</b>")
+    assert cb.calendar_text(dict(user), 2) is text
+    assert cb.calendar_page.cache_info().hits == 1
+
+def test_keyboards_stop_at_the_ends():
+    def callbacks(page):
+        return [button.callback_data for button in cb.CALENDAR_KEYBOARDS[page].inline_keyboard[0]]
+
+    last = cb.CALENDAR_MONTHS - 1
+    assert callbacks(0) == ["kal_0", "kal_1"]
+    assert callbacks(1) == ["kal_0", "kal_1", "kal_2"]
+    assert callbacks(last) == [f"kal_{last - 1}", f"kal_{last}"]
@@ -0,0 +1,101 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+from telegram import Update
+from telegram.error import BadRequest
+
+import ciklus_bot as cb
+from bench import callback_update
+from fake_botapi import FakeBotAPI
+
+# CallbackGuard: ponovljen klik se spaja, spamovanje dugmadi se ogranicava po chatu,
+# a izmena poruke u isti tekst se ne salje Telegramu.
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_admit_coalesces_and_limits(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cb.time, "monotonic", clock)
+    guard = cb.CallbackGuard(rate=1, burst=3, coalesce=2)
+
+    assert guard.admit(1, (10, "today")) is None
+    assert guard.admit(1, (10, "today")) == "coalesced"
+    assert guard.admit(1, (10, "status")) is None
+    assert guard.admit(1, (10, "today")) is None
+    assert guard.admit(1, (10, "mood_sjajan")) == "limited"
+    assert guard.admit(2, (11, "today")) is None  # drugi chat ima svoj bucket
+
+    clock.now += 1.5
+    assert guard.admit(1, (10, "mood_sjajan")) is None
+    clock.now += 2.5
+    assert guard.admit(1, (10, "mood_sjajan")) is None  # prozor za spajanje istekao
+
+class FakeQuery:
+    def __init__(self, fail=None):
+        self.message = SimpleNamespace(chat=SimpleNamespace(id=1), message_id=10)
+        self.edits = []
+        self.fail = fail
+
+    async def edit_message_text(self, text, parse_mode=None, reply_markup=None):
+        self.edits.append(text)
+        if self.fail is not None:
+            raise self.fail
+
+def test_unchanged_edit_is_skipped(monkeypatch):
+    monkeypatch.setattr(cb, "callback_guard", cb.CallbackGuard())
+    monkeypatch.setattr(cb, "CLUSTER_MODE", False)
+    query = FakeQuery()
+
+    async def scenario():
+        await cb.edit_callback_message(query, "Danas")
+        await cb.edit_callback_message(query, "Danas")
+        await cb.edit_callback_message(query, "Danas", parse_mode="HTML")
+        await cb.edit_callback_message(query, "Danas", parse_mode="HTML", reply_markup=cb.main_menu_keyboard())
+        await cb.edit_callback_message(query, "Danas", parse_mode="HTML", reply_markup=cb.main_menu_keyboard())
+
+    asyncio.run(scenario())
+    assert query.edits == ["Danas"] * 3
+
+def test_not_modified_is_remembered(monkeypatch):
+    monkeypatch.setattr(cb, "callback_guard", cb.CallbackGuard())
+    monkeypatch.setattr(cb, "CLUSTER_MODE", False)
+    query = FakeQuery(BadRequest("Message is not modified"))
+
+    async def scenario():
+        await cb.edit_callback_message(query, "Status")
+        query.fail = None
+        await cb.edit_callback_message(query, "Status")
+
+    asyncio.run(scenario())
+    assert query.edits == ["Status"]
+
+def test_inline_callback_without_chat_is_answered(tmp_path):
+    calls = []
+
+    def on_call(method, params, status):
+        if method in ("answerCallbackQuery", "editMessageText", "sendMessage"):
+            calls.append(method)
+
+    payload = callback_update(1, 42, "today")
+    del payload["callback_query"]["message"]
+    payload["callback_query"]["inline_message_id"] = "inline-1"
+
+    async def scenario():
+        with FakeBotAPI(on_call=on_call) as api:
+            app = cb.build_application(cb.SQLitePersistence(str(tmp_path / "bot.sqlite3")), bot_api_url=api.url)
+            await app.initialize()
+            await app.start()
+            await app.process_update(Update.de_json(payload, app.bot))
+            await app.stop()
+            await app.shutdown()
+
+    asyncio.run(scenario())
+    assert calls == ["answerCallbackQuery"]
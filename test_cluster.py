@@ -0,0 +1,72 @@
+import asyncio
+import os
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+
+# Dva radnika (ClusterCoordinator) nad istom bazom, kao dva procesa u CLUSTER_MODE.
+
+def coordinators(tmp_path, **kwargs):
+    path = str(tmp_path / "bot.sqlite3")
+    return cb.ClusterCoordinator(path, "a", **kwargs), cb.ClusterCoordinator(path, "b", **kwargs)
+
+def test_single_leader_and_failover(tmp_path):
+    a, b = coordinators(tmp_path, lease_ttl=30)
+
+    async def scenario():
+        assert await a.try_lead()
+        assert not await b.try_lead()
+        assert await a.try_lead()  # produzenje lease-a
+        assert a.leader() == b.leader() == "a"
+        a.resign()
+        assert await b.try_lead()
+        assert not await a.try_lead()
+
+    asyncio.run(scenario())
+    b.close()
+    a.close()
+
+def test_expired_lease_is_taken_over(tmp_path):
+    a, b = coordinators(tmp_path, lease_ttl=0.05)
+
+    async def scenario():
+        assert await a.try_lead()
+        assert not await b.try_lead()
+        await asyncio.sleep(0.1)  # a se nije javio, lease je istekao
+        assert await b.try_lead()
+        assert not await a.try_lead()
+
+    asyncio.run(scenario())
+
+def test_chat_lock_serializes_workers(tmp_path):
+    a, b = coordinators(tmp_path, lock_ttl=5)
+    order = []
+
+    async def work(coordinator, name):
+        assert await coordinator.lock_chat(7)
+        order.append(f"{name} start")
+        await asyncio.sleep(0.05)
+        order.append(f"{name} end")
+        await coordinator.unlock_chat(7)
+
+    async def scenario():
+        first = asyncio.create_task(work(a, "a"))
+        await asyncio.sleep(0.01)
+        await asyncio.gather(first, work(b, "b"))
+        # drugi chat nije blokiran tudjim lock-om
+        assert await a.lock_chat(7)
+        assert await b.lock_chat(8)
+
+    asyncio.run(scenario())
+    assert order == ["a start", "a end", "b start", "b end"]
+
+def test_chat_lock_gives_up_after_ttl(tmp_path):
+    a, b = coordinators(tmp_path, lock_ttl=0.2)
+
+    async def scenario():
+        assert await a.lock_chat(7)
+        # a je "pao" sa lock-om; b ga dobija kad istekne, ne ceka zauvek
+        assert await b.lock_chat(7)
+
+    asyncio.run(scenario())
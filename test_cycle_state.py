@@ -0,0 +1,149 @@
+import json
+import os
+import random
+from array import array
+from datetime import date, timedelta
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+
+# cycle_state_bulk (NumPy, za broadcast) mora da da isto sto i skalarni
+# get_cycle_state_for_today / calc_next_dates, za svaki profil i svaki dan.
+
+TODAYS = [
+    date(2026, 10, 17),
+    date(2026, 12, 31),
+    date(2027, 1, 1),
+    date(2028, 2, 28),
+    date(2028, 2, 29),
+    date(2028, 3, 1),
+]
+
+def random_profile(rng: random.Random, today: date) -> dict:
+    user = {
+        "cycle_length": rng.randint(20, 45),
+        "period_length": rng.randint(2, 10),
+    }
+    roll = rng.random()
+    if roll < 0.05:
+        return user  # bez datuma
+    if roll < 0.1:
+        user["last_start"] = today + timedelta(days=rng.randint(1, 10))  # u buducnosti
+    else:
+        user["last_start"] = today - timedelta(days=rng.randint(0, 120))
+    if rng.random() < 0.4:
+        history = cb.CycleHistory()
+        for _ in range(rng.randint(1, 14)):
+            history.add(rng.randint(18, 50))
+        user["cycle_history"] = history
+    return user
+
+def scalar_state(user: dict, today: date, monkeypatch) -> tuple:
+    monkeypatch.setattr(cb, "user_today", lambda _user: today)
+    return cb.get_cycle_state_for_today(user)
+
+@pytest.mark.parametrize("today", TODAYS, ids=str)
+def test_bulk_matches_scalar(today, monkeypatch):
+    rng = random.Random(today.toordinal())
+    profiles = [random_profile(rng, today) for _ in range(2000)]
+    states = cb.cycle_state_bulk(*cb.profiles_to_columns(profiles), today=today)
+    for i, user in enumerate(profiles):
+        assert cb.bulk_state_at(states, i) == scalar_state(user, today, monkeypatch), user
+
+        info = cb.calc_next_dates(user)
+        if info is None:
+            assert states["next_start"][i] == 0
+            continue
+        for field in ("next_start", "fertile_start", "fertile_end", "period_end"):
+            assert date.fromordinal(int(states[field][i])) == info[field], (field, user)
+
+def test_phase_boundaries():
+    today = date(2027, 1, 1)
+    user = {"cycle_length": 28, "period_length": 5}
+    expected = {1: "menstrualna faza", 5: "menstrualna faza", 6: "folikularna faza", 14: "ovulacija", 15: "luteinska faza"}
+    profiles = [dict(user, last_start=today - timedelta(days=day - 1)) for day in expected]
+    states = cb.cycle_state_bulk(*cb.profiles_to_columns(profiles), today=today)
+    for i, (day, phase) in enumerate(expected.items()):
+        assert cb.bulk_state_at(states, i) == (day, phase)
+
+def test_start_ahead_of_local_date(monkeypatch):
+    # datum unet kao "danas" u Beogradu, pa zona promenjena na America/New_York
+    today = date(2027, 1, 1)
+    monkeypatch.setattr(cb, "user_today", lambda _user: today)
+    profiles = [
+        {"cycle_length": 28, "period_length": 5, "last_start": today + timedelta(days=ahead)}
+        for ahead in (1, cb.START_SKEW_DAYS, cb.START_SKEW_DAYS + 1)
+    ]
+    states = cb.cycle_state_bulk(*cb.profiles_to_columns(profiles), today=today)
+    expected = [(1, "menstrualna faza"), (1, "menstrualna faza"), (None, None)]
+    assert [cb.get_cycle_state_for_today(p) for p in profiles] == expected
+    assert [cb.bulk_state_at(states, i) for i in range(len(profiles))] == expected
+    monkeypatch.setattr(cb, "WEATHER_API_KEY", None)
+    assert cb.build_mood_message(profiles[2], "tezak", 1) == cb.FUTURE_LAST_START
+    assert cb.build_today_overview(profiles[2], 1) == cb.FUTURE_LAST_START
+
+def phases_by_day(user: dict, days: int, monkeypatch) -> list:
+    today = date(2027, 1, 1)
+    monkeypatch.setattr(cb, "user_today", lambda _user: today)
+    profiles = [dict(user, last_start=today - timedelta(days=day - 1)) for day in range(1, days + 1)]
+    states = cb.cycle_state_bulk(*cb.profiles_to_columns(profiles), today=today)
+    scalar = [cb.get_cycle_state_for_today(p)[1] for p in profiles]
+    assert [cb.bulk_state_at(states, i)[1] for i in range(days)] == scalar
+    return scalar
+
+def test_no_history_uses_entered_length(monkeypatch):
+    # bez istorije ovulacija je 14 dana pre kraja unetog ciklusa
+    phases = phases_by_day({"cycle_length": 32, "period_length": 5}, 32, monkeypatch)
+    assert phases.index("ovulacija") + 1 == 18
+    assert phases.count("ovulacija") == 1
+    assert phases[5:17] == ["folikularna faza"] * 12
+
+def test_short_cycle_keeps_ovulation_after_period(monkeypatch):
+    phases = phases_by_day({"cycle_length": 20, "period_length": 7}, 20, monkeypatch)
+    assert phases[:7] == ["menstrualna faza"] * 7
+    assert phases[7] == "ovulacija"
+    assert phases[8:] == ["luteinska faza"] * 12
+    assert cb.projected_day(date(2027, 1, 8), date(2027, 1, 1), 20, 7) == ("ovulacija", "O")
+
+def history_bytes(count: int, lengths: list, n=None) -> bytes:
+    return cb.CycleHistory.HEADER.pack(count, len(lengths) if n is None else n) + array("H", lengths).tobytes()
+
+def test_history_round_trip_and_malformed_records(tmp_path):
+    history = cb.CycleHistory()
+    for length in (27, 29, 30, 31):
+        history.add(length)
+    restored = cb.CycleHistory.from_bytes(history.to_bytes())
+    assert restored == history and restored.slope == history.slope
+
+    for data in (
+        history_bytes(2, [27, 29, 30]),  # count manji od broja duzina
+        history_bytes(5, [27, 29], n=3),  # zaglavlje ne odgovara sadrzaju
+        history_bytes(5, [27, 99]),  # duzina van granica
+        history_bytes(5, [27, 29])[:-1],  # odsecen zapis
+    ):
+        with pytest.raises(ValueError):
+            cb.CycleHistory.from_bytes(data)
+
+    # ostecen red u bazi: chat se ucita bez istorije, predikcija koristi unetu duzinu
+    persistence = cb.SQLitePersistence(str(tmp_path / "bot.sqlite3"))
+    row = cb.SQLitePersistence.row_from_chat_data({"cycle_length": 30, "cycle_history": history})
+    persistence.write_rows({1: row})
+    persistence.conn.execute("UPDATE chats SET cycle_history = ?", (history_bytes(1, [27, 29, 30]),))
+    loaded = persistence.load_chats([1])[1]
+    assert loaded["cycle_history"] is None
+    assert cb.cycle_prediction(loaded) == (30, 30, 30)
+
+def test_import_rejects_malformed_history(tmp_path):
+    path = tmp_path / "korisnici.jsonl"
+    records = [
+        {"chat_id": 1, "cycle_history": {"count": 1, "lengths": [27, 29, 30]}},
+        {"chat_id": 2, "cycle_history": {"count": 3, "lengths": [27, 29, 30]}},
+    ]
+    path.write_text("".join(json.dumps(r) + "\n" for r in records), encoding="utf-8")
+    persistence = cb.SQLitePersistence(str(tmp_path / "bot.sqlite3"))
+
+    assert cb.import_users(persistence, str(path), "jsonl") == (1, 1)
+    assert persistence.load_chats([1, 2])[2]["cycle_history"].ordered() == [27, 29, 30]
@@ -0,0 +1,62 @@
+import asyncio
+import os
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+
+# DeliveryScheduler: korisnik dobija poruku u svom lokalnom vremenu, sa svojim lokalnim
+# datumom, a propusteni minuti se nadoknade samo jednom.
+
+USERS = {
+    1: {"timezone": "Europe/Belgrade", "delivery_minute": 22 * 60},
+    2: {"timezone": "America/New_York", "delivery_minute": 22 * 60},
+    3: {"timezone": "Pacific/Kiritimati", "delivery_minute": 7 * 60},
+    4: {"timezone": "Europe/Belgrade", "delivery_minute": 21 * 60 + 30},
+    5: {"timezone": "Europe/Belgrade", "delivery_minute": 22 * 60, "seen_start": False},
+}
+
+def scheduler(tmp_path) -> cb.DeliveryScheduler:
+    persistence = cb.SQLitePersistence(str(tmp_path / "bot.sqlite3"))
+    persistence.write_rows({
+        chat_id: cb.SQLitePersistence.row_from_chat_data(dict({"seen_start": True}, **user))
+        for chat_id, user in USERS.items()
+    })
+    return cb.DeliveryScheduler(SimpleNamespace(persistence=persistence, chat_data={}))
+
+def minute_of(*args) -> int:
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp() // 60)
+
+def test_due_uses_local_time_and_date(tmp_path):
+    s = scheduler(tmp_path)
+    # 2026-10-17 20:00 UTC = 22:00 u Beogradu (CEST)
+    assert s.due(minute_of(2026, 10, 17, 20, 0)) == {date(2026, 10, 17): [1]}
+    # 2026-10-18 02:00 UTC = 22:00 17. oktobra u New Yorku
+    assert s.due(minute_of(2026, 10, 18, 2, 0)) == {date(2026, 10, 17): [2]}
+    # 2026-10-17 17:00 UTC = 07:00 18. oktobra na Kiritimatiju (UTC+14)
+    assert s.due(minute_of(2026, 10, 17, 17, 0)) == {date(2026, 10, 18): [3]}
+    assert s.due(minute_of(2026, 10, 17, 19, 30)) == {date(2026, 10, 17): [4]}
+
+def test_tick_catches_up_missed_minutes_once(tmp_path, monkeypatch):
+    s = scheduler(tmp_path)
+    s.application.update_persistence = lambda: asyncio.sleep(0)
+    delivered = []
+
+    async def fake_deliver(chat_ids, day):
+        delivered.append((sorted(chat_ids), day))
+
+    monkeypatch.setattr(s, "_deliver", fake_deliver)
+    monkeypatch.setattr(cb, "PRERENDER_LEAD_MINUTES", 0)
+
+    async def scenario():
+        # prvi tik posle restarta, 5 minuta posle 22:00 u Beogradu
+        now = minute_of(2026, 10, 17, 20, 5) * 60
+        assert await s.tick(now) == 1
+        assert await s.tick(now + 30) == 0  # isti minut
+        assert await s.tick(now + 60) == 0
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert delivered == [([1], date(2026, 10, 17))]
@@ -0,0 +1,31 @@
+import os
+from datetime import date, timedelta
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+
+# Kes fragmenata ne sme da "zamrzne" tekst: isti chat isti dan dobija isti tekst,
+# ali kroz dane moraju da se smenjuju svi horoskopi, ne samo FRAGMENT_VARIANTS njih.
+
+USER = {"cycle_length": 28, "period_length": 5, "star_sign": "Lav"}
+STATE = (10, "folikularna faza")
+
+def test_same_chat_same_day_is_stable(monkeypatch):
+    monkeypatch.setattr(cb, "WEATHER_API_KEY", None)
+    day = date(2026, 10, 17)
+    first = cb.build_today_overview(USER, 42, STATE, day)
+    cb.fragments._days.clear()
+    assert cb.build_today_overview(USER, 42, STATE, day) == first
+
+def test_variety_across_days(monkeypatch):
+    monkeypatch.setattr(cb, "WEATHER_API_KEY", None)
+    start = date(2026, 1, 1)
+    texts = set()
+    for offset in range(365):
+        day = start + timedelta(days=offset)
+        for chat_id in range(20):
+            texts.add(cb.build_today_overview(USER, chat_id, STATE, day))
+    assert len(texts) > 4 * cb.FRAGMENT_VARIANTS
+    horoscopes = [h.render(star_sign="Lav") for h in cb.HOROSCOPES]
+    assert all(any(h in text for text in texts) for h in horoscopes)
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+from datetime import date
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+
+# Dnevnik raspolozenja: jedan unos po (chat, dan), i u statistici korisnika i u rollup-u.
+
+DAY = date(2026, 10, 17)
+
+def journal(tmp_path) -> cb.MoodJournal:
+    return cb.MoodJournal(sqlite3.connect(str(tmp_path / "bot.sqlite3"), isolation_level=None))
+
+def test_second_press_same_day_replaces_first(tmp_path):
+    j = journal(tmp_path)
+    j.append(1, DAY, "tezak", "luteinska faza", 20)
+    j.flush()
+    j.append(1, DAY, "sjajan", "luteinska faza", 20)  # posle prozora za spajanje klikova
+    j.flush()
+    j.append(1, date(2026, 10, 18), "onako", "luteinska faza", 21)
+    j.append(2, DAY, "tezak", "folikularna faza", 8)
+    j.append(2, DAY, "stresan", "folikularna faza", 8)  # oba u istom baferu
+    j.flush()
+
+    luteal, follicular = cb.PHASE_CODES["luteinska faza"], cb.PHASE_CODES["folikularna faza"]
+    assert j.distribution(202610, 1) == [
+        (202610, luteal, cb.MOOD_CODES["sjajan"], 1),
+        (202610, luteal, cb.MOOD_CODES["onako"], 1),
+    ]
+    assert j.distribution(202610) == [
+        (202610, follicular, cb.MOOD_CODES["stresan"], 1),
+        (202610, luteal, cb.MOOD_CODES["sjajan"], 1),
+        (202610, luteal, cb.MOOD_CODES["onako"], 1),
+    ]
+    assert "teških 0%" in cb.format_phase_distribution(j.distribution(202610, 1))
+
+def test_old_journal_is_deduplicated(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "bot.sqlite3"), isolation_level=None)
+    conn.execute(
+        "CREATE TABLE mood_events (chat_id INTEGER NOT NULL, day INTEGER NOT NULL, month INTEGER NOT NULL, "
+        "mood INTEGER NOT NULL, phase INTEGER NOT NULL, cycle_day INTEGER NOT NULL)"
+    )
+    conn.executemany(
+        "INSERT INTO mood_events VALUES (?, ?, 202610, ?, 3, 20)",
+        [(1, DAY.toordinal(), 2), (1, DAY.toordinal(), 0), (1, DAY.toordinal() + 1, 1)],
+    )
+    j = cb.MoodJournal(conn)
+    assert j.distribution(202610) == [(202610, 3, 0, 1), (202610, 3, 1, 1)]
+    assert j.distribution(202610, 1) == j.distribution(202610)
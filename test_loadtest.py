@@ -0,0 +1,52 @@
+import asyncio
+import os
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+import loadtest
+from fake_botapi import FakeBotAPI
+
+# Fake Bot API vraca 429 kao Telegram kad se predje limit, a broadcast to prezivi;
+# LoadGenerator vezuje odgovor za update i broji one bez odgovora.
+
+def test_fake_api_rate_limit_is_retried(tmp_path):
+    async def scenario(api):
+        app = cb.build_application(cb.SQLitePersistence(str(tmp_path / "bot.sqlite3")), bot_api_url=api.url)
+        await app.initialize()
+        try:
+            stats = cb.BroadcastStats(6)
+            limiter = cb.TokenBucket(100)
+            results = await asyncio.gather(*(
+                cb.send_with_retry(app.bot, limiter, stats, chat_id, text="poruka") for chat_id in range(1, 7)
+            ))
+        finally:
+            await app.shutdown()
+        return results, stats
+
+    with FakeBotAPI(rate_limit=3, retry_after=1) as api:
+        results, stats = asyncio.run(scenario(api))
+        assert results == ["sent"] * 6
+        assert api.rate_limited["sendMessage"] == stats.retries >= 3
+        assert api.calls["sendMessage"] == 6 + stats.retries
+        # getMe i ostale metode ne trose limit poruka
+        assert api.handle("getMe", {})[0] == 200
+
+def test_generator_matches_replies_and_counts_timeouts():
+    gen = loadtest.LoadGenerator(users=2, rate=10, duration=1, reply_timeout=0.05, concurrency=1)
+    first, second = gen.free.popleft(), gen.free.popleft()
+    for user in (first, second):
+        assert gen.next_payload(user)["message"]["text"] == "/start"
+        user.sent_at = time.perf_counter()
+        gen.pending[user.chat_id] = user
+
+    gen.complete(first.chat_id, True, time.perf_counter())
+    assert (gen.replies, first.step) == (1, 1)
+    assert "callback_query" in gen.next_payload(first)
+
+    second.sent_at -= 1  # odgovor nije stigao na vreme
+    gen.sweep()
+    gen.complete(second.chat_id, True, time.perf_counter())  # zakasneli odgovor se ne broji
+    assert (gen.unanswered, gen.replies, second.step) == (1, 1, 0)
+    assert sorted(user.chat_id for user in gen.free) == [first.chat_id, second.chat_id]
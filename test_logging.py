@@ -0,0 +1,51 @@
+import json
+import logging
+import os
+import sys
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+
+# DuplicateFilter preskace ponovljena upozorenja u prozoru i posle prozora javi koliko
+# ih je preskoceno; JsonFormatter pravi jedan JSON red po zapisu.
+
+def record(message, created, level=logging.WARNING, exc_info=None, args=()):
+    rec = logging.LogRecord("ciklus", level, __file__, 1, message, args, exc_info)
+    rec.created = created
+    return rec
+
+def test_duplicates_are_suppressed_then_summarized():
+    duplicates = cb.DuplicateFilter(window=10)
+    assert duplicates.filter(record("Broadcast greska %s", 100, args=(1,)))
+    assert not duplicates.filter(record("Broadcast greska %s", 101, args=(1,)))
+    assert not duplicates.filter(record("Broadcast greska %s", 105, args=(1,)))
+    assert duplicates.filter(record("Broadcast greska %s", 102, args=(2,)))  # druga poruka
+    assert duplicates.filter(record("Info %s", 103, level=logging.INFO, args=(1,)))
+    assert duplicates.filter(record("Info %s", 103, level=logging.INFO, args=(1,)))  # INFO se ne filtrira
+    assert duplicates.suppressed == 2
+
+    after = record("Broadcast greska %s", 111, args=(1,))
+    assert duplicates.filter(after)
+    assert after.repeated == 2
+    assert cb.TextFormatter("%(message)s").format(after) == "Broadcast greska 1 (ponovljeno jos 2x)"
+    quiet = record("Broadcast greska %s", 122, args=(1,))
+    assert duplicates.filter(quiet)
+    assert not getattr(quiet, "repeated", 0)
+
+def test_json_formatter_keys_and_exception():
+    try:
+        raise ValueError("los red")
+    except ValueError:
+        exc_info = sys.exc_info()
+    rec = record("Uvoz: red %s preskocen", 0, level=logging.ERROR, exc_info=exc_info, args=(7,))
+    rec.repeated = 3
+    entry = json.loads(cb.JsonFormatter().format(rec))
+    assert set(entry) == {"time", "level", "logger", "message", "repeated", "exc"}
+    assert (entry["level"], entry["logger"], entry["message"]) == ("ERROR", "ciklus", "Uvoz: red 7 preskocen")
+    assert entry["repeated"] == 3
+    assert entry["exc"].startswith("Traceback") and "ValueError: los red" in entry["exc"]
+
+    plain = json.loads(cb.JsonFormatter().format(record("Ćao", 0)))
+    assert set(plain) == {"time", "level", "logger", "message"}
+    assert plain["message"] == "Ćao"
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import tornado.web
+from tornado.httputil import HTTPServerRequest
+from telegram.error import TimedOut
+
+import ciklus_bot as cb
+from fake_botapi import FakeBotAPI
+
+# Metrics.render daje Prometheus tekstualni format; InstrumentedRequest broji greske
+# Bot API-ja po tipu; /metrics ruta se kaci samo na PTB-ov tornado server koji postoji.
+
+def test_render_exposition_format():
+    m = cb.Metrics(prefix="t")
+    m.inc("sent_total", result="sent")
+    m.inc("sent_total", 2, result="sent")
+    m.inc("sent_total", result="blocked")
+    m.set_gauge("depth", 7)
+    for value in (0.001, 0.02, 0.02, 0.3, 20):
+        m.observe("send_seconds", value, method="sendMessage")
+    lines = m.render().splitlines()
+
+    assert lines[:4] == [
+        "# TYPE t_sent_total counter",
+        't_sent_total{result="blocked"} 1',
+        't_sent_total{result="sent"} 3',
+        "# TYPE t_depth gauge",
+    ]
+    assert "t_depth 7" in lines
+    assert lines.count("# TYPE t_send_seconds histogram") == 1
+    buckets = [line for line in lines if line.startswith("t_send_seconds_bucket")]
+    assert len(buckets) == len(cb.LATENCY_BUCKETS) + 1
+    counts = [int(line.rsplit(" ", 1)[1]) for line in buckets]
+    assert counts == sorted(counts)  # kumulativno, nikad ne opada
+    assert buckets[0] == 't_send_seconds_bucket{method="sendMessage",le="0.005"} 1'
+    assert 't_send_seconds_bucket{method="sendMessage",le="0.025"} 3' in buckets
+    assert buckets[-1] == 't_send_seconds_bucket{method="sendMessage",le="+Inf"} 5'
+    assert 't_send_seconds_count{method="sendMessage"} 5' in lines
+    sum_line = next(line for line in lines if line.startswith("t_send_seconds_sum"))
+    assert abs(float(sum_line.rsplit(" ", 1)[1]) - 20.341) < 1e-9
+
+def test_instrumented_request_error_types(monkeypatch):
+    m = cb.Metrics()
+    monkeypatch.setattr(cb, "metrics", m)
+
+    async def scenario(throttled_url, slow_url):
+        request = cb.InstrumentedRequest(read_timeout=0.1)
+        await request.initialize()
+        try:
+            code, _ = await request.do_request(f"{throttled_url}/sendMessage", "POST")
+            assert code == 429
+            try:
+                await request.do_request(f"{slow_url}/getMe", "POST")
+            except TimedOut:
+                pass
+            else:
+                raise AssertionError("ocekivan TimedOut")
+        finally:
+            await request.shutdown()
+
+    with FakeBotAPI(error_rate=1.0) as throttled, FakeBotAPI(latency=0.5) as slow:
+        asyncio.run(scenario(throttled.url, slow.url))
+
+    errors = {labels: n for (name, labels), n in m.counters.items() if name == "telegram_api_errors_total"}
+    assert errors == {
+        (("method", "sendMessage"), ("type", "RetryAfter")): 1,
+        (("method", "getMe"), ("type", "TimedOut")): 1,
+    }
+    assert m.histograms[m._key("telegram_api_seconds", {"method": "getMe"})].count == 1
+
+def test_metrics_route_needs_running_webhook_server(caplog):
+    web_app = tornado.web.Application()
+    httpd = SimpleNamespace(_http_server=SimpleNamespace(request_callback=web_app))
+    assert cb.attach_metrics_route(SimpleNamespace(updater=SimpleNamespace(_httpd=httpd)))
+    request = HTTPServerRequest(method="GET", uri="/metrics", host="localhost")
+    assert web_app.find_handler(request).handler_class is cb.MetricsHandler
+
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger=cb.logger.name):
+        assert not cb.attach_metrics_route(SimpleNamespace(updater=None))
+        assert not cb.attach_metrics_route(SimpleNamespace(updater=SimpleNamespace(_httpd=None)))
+        assert [r.levelno for r in caplog.records] == [logging.WARNING] * 2
+        caplog.clear()
+        # interni atributi PTB-a nestali (nova verzija): jasna greska umesto tihog preskakanja
+        assert not cb.attach_metrics_route(SimpleNamespace(updater=SimpleNamespace()))
+        assert not cb.attach_metrics_route(SimpleNamespace(updater=SimpleNamespace(_httpd=SimpleNamespace())))
+    assert [r.levelno for r in caplog.records] == [logging.ERROR] * 2
+    assert "21.6" in caplog.records[0].getMessage()
@@ -0,0 +1,84 @@
+import asyncio
+import os
+from datetime import date, datetime
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+from telegram.error import Forbidden
+
+# Outbox: ista poruka (chat, vrsta, lokalni dan) ide najvise jednom, a privremena
+# greska ostavlja poruku u redu za kasniji pokusaj.
+
+DAY = date(2026, 10, 17)
+
+class FakeBot:
+    def __init__(self, fail=None):
+        self.sent = []
+        self.fail = fail or {}  # chat_id -> izuzetak
+
+    async def send_message(self, chat_id, **kwargs):
+        if chat_id in self.fail:
+            raise self.fail[chat_id]
+        self.sent.append((chat_id, kwargs["text"]))
+
+def outbox(tmp_path) -> cb.Outbox:
+    return cb.SQLitePersistence(str(tmp_path / "bot.sqlite3")).outbox
+
+def send(box, bot, chat_ids, day=DAY, kind="daily"):
+    rendered = [(f"poruka {chat_id}", None) for chat_id in chat_ids]
+    return asyncio.run(box.send_rendered(
+        bot, cb.TokenBucket(1000), cb.BroadcastStats(len(chat_ids)), chat_ids, rendered, kind, day,
+    ))
+
+def test_same_key_is_sent_once(tmp_path):
+    box, bot = outbox(tmp_path), FakeBot()
+    assert send(box, bot, [1, 2]) == ["sent", "sent"]
+    # ponovljen job (npr. posle restarta) ne salje ponovo
+    assert send(box, bot, [1, 2, 3]) == ["skipped", "skipped", "sent"]
+    assert send(box, bot, [1], kind="izvestaj") == ["sent"]
+    assert send(box, bot, [1], day=date(2026, 10, 18)) == ["sent"]
+    assert [chat_id for chat_id, _ in bot.sent] == [1, 2, 3, 1, 1]
+    assert box.depth() == 0
+
+def test_failures_are_kept_or_finished(tmp_path):
+    box = outbox(tmp_path)
+    bot = FakeBot({1: Forbidden("bot was blocked by the user"), 2: RuntimeError("neocekivano")})
+    assert send(box, bot, [1, 2]) == ["blocked", "retry"]
+    status = box.status_of([cb.Outbox.idempotency_key(chat_id, "daily", DAY) for chat_id in (1, 2)])
+    assert [row[3] for row in status.values()] == ["blocked", "pending"]
+    # pokusaj je odlozen (backoff): ni drain ni sledeci broadcast ga ne salju odmah
+    assert box.due() == []
+    bot = FakeBot()
+    assert send(box, bot, [1, 2]) == ["skipped", "retry"]
+    assert bot.sent == []
+    box.conn.execute("UPDATE outbox SET next_attempt_at = 0")  # backoff istekao
+    assert asyncio.run(box.drain(bot)) == 1
+    assert bot.sent == [(2, "poruka 2")]
+    assert send(box, bot, [2]) == ["skipped"]
+
+def test_drain_expires_stale_messages(tmp_path):
+    box, bot = outbox(tmp_path), FakeBot()
+    box.enqueue_many([("k1", 1, "daily", cb.Outbox.encode("stara")), ("k2", 2, "daily", cb.Outbox.encode("nova"))])
+    box.conn.execute("UPDATE outbox SET expires_at = 0 WHERE idem_key = 'k1'")
+    assert asyncio.run(box.drain(bot)) == 1
+    assert bot.sent == [(2, "nova")]
+    assert [row[3] for row in box.status_of(["k1", "k2"]).values()] == ["expired", "sent"]
+
+def test_send_via_outbox_keys_by_local_day(tmp_path):
+    persistence = cb.SQLitePersistence(str(tmp_path / "bot.sqlite3"))
+    bot = FakeBot()
+    app = SimpleNamespace(
+        persistence=persistence,
+        bot=bot,
+        update_processor=None,
+        chat_data={7: {"timezone": "Pacific/Kiritimati"}},
+    )
+    assert asyncio.run(cb.send_via_outbox(app, 7, "izvestaj", "tekst")) == "sent"
+    local_day = datetime.now(ZoneInfo("Pacific/Kiritimati")).date()
+    key = cb.Outbox.idempotency_key(7, "izvestaj", local_day)
+    assert persistence.outbox.status_of([key])[key][3] == "sent"
+    assert asyncio.run(cb.send_via_outbox(app, 7, "izvestaj", "tekst")) == "skipped"
+    assert bot.sent == [(7, "tekst")]
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import os
+import pickle
+import sqlite3
+from datetime import date
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+
+def test_migrate_pickle_fills_defaults(tmp_path):
+    pickle_path = tmp_path / "bot_data.pkl"
+    chat_data = {
+        1: {"cycle_length": 30, "last_start": date(2026, 10, 1), "seen_start": True},
+        2: {},  # chat koji je samo poslao /ping
+    }
+    with open(pickle_path, "wb") as f:
+        pickle.dump({"chat_data": chat_data}, f)
+    persistence = cb.SQLitePersistence(str(tmp_path / "bot.sqlite3"))
+
+    assert cb.migrate_pickle(str(pickle_path), persistence) == 2
+
+    loaded = persistence.load_chats([1, 2])
+    assert loaded[1]["cycle_length"] == 30
+    assert loaded[1]["seen_start"] is True
+    assert loaded[2]["seen_start"] is False
+    assert loaded[2]["timezone"] == cb.DEFAULT_TIMEZONE
+    assert os.path.exists(str(pickle_path) + ".migrated")
+
+def test_import_skips_invalid_records(tmp_path):
+    path = tmp_path / "korisnici.jsonl"
+    records = [
+        {"chat_id": 1, "cycle_length": 30, "timezone": "America/New_York", "delivery_minute": 1290},
+        {"chat_id": 2, "timezone": "Mars/Olympus"},
+        {"chat_id": 3, "delivery_minute": 99999},
+        {"chat_id": 4, "period_length": -4},
+        {"chat_id": 5, "star_sign": "Zmaj"},
+        {"chat_id": 6},  # bez seen_start i ostalih polja
+    ]
+    path.write_text("".join(json.dumps(r) + "\n" for r in records), encoding="utf-8")
+    persistence = cb.SQLitePersistence(str(tmp_path / "bot.sqlite3"))
+
+    assert cb.import_users(persistence, str(path), "jsonl") == (2, 4)
+
+    loaded = persistence.load_chats([1, 2, 3, 4, 5, 6])
+    assert sorted(loaded) == [1, 6]
+    assert loaded[1]["timezone"] == "America/New_York"
+    assert loaded[6]["cycle_length"] == 28
+
+# Write-behind: izmene chatova se skupljaju u baferu i upisuju zajedno, isti red se
+# ne upisuje ponovo, a neuspeo upis ostaje u baferu za sledeci pokusaj.
+
+def stored_cycle_lengths(persistence) -> dict:
+    return dict(persistence.conn.execute("SELECT chat_id, cycle_length FROM chats"))
+
+def test_write_behind_batches_changes(tmp_path):
+    persistence = cb.SQLitePersistence(str(tmp_path / "bot.sqlite3"), flush_delay=0.05, flush_rows=3)
+    writes = []
+    write_rows = persistence.write_rows
+
+    def counting(rows, **kw):
+        writes.append(sorted(rows))
+        write_rows(rows, **kw)
+
+    persistence.write_rows = counting
+
+    async def scenario():
+        await persistence.update_chat_data(1, {"cycle_length": 30})
+        await persistence.update_chat_data(2, {"cycle_length": 31})
+        await persistence.update_chat_data(1, {"cycle_length": 32})  # isti chat, jedan red
+        assert stored_cycle_lengths(persistence) == {}
+        await asyncio.sleep(0.1)  # istekao flush_delay
+        assert stored_cycle_lengths(persistence) == {1: 32, 2: 31}
+        await persistence.update_chat_data(1, {"cycle_length": 32})  # nista se nije promenilo
+        for chat_id in (3, 4, 5):  # flush_rows redova odmah ide u bazu
+            await persistence.update_chat_data(chat_id, {"cycle_length": 28})
+        assert sorted(stored_cycle_lengths(persistence)) == [1, 2, 3, 4, 5]
+
+    asyncio.run(scenario())
+    assert writes == [[1, 2], [3, 4, 5]]
+
+def test_failed_flush_keeps_rows(tmp_path):
+    persistence = cb.SQLitePersistence(str(tmp_path / "bot.sqlite3"), flush_delay=60)
+    write_rows = persistence.write_rows
+
+    def failing(rows, **kw):
+        raise sqlite3.OperationalError("database is locked")
+
+    async def scenario():
+        await persistence.update_chat_data(1, {"cycle_length": 30})
+        await persistence.update_chat_data(2, {"cycle_length": 31})
+        persistence.write_rows = failing
+        assert persistence.flush_dirty() == 0
+        persistence.write_rows = write_rows
+        await persistence.update_chat_data(1, {"cycle_length": 33})  # novija izmena ima prednost
+        assert persistence.flush_dirty() == 2
+
+    asyncio.run(scenario())
+    assert stored_cycle_lengths(persistence) == {1: 33, 2: 31}
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import os
+from datetime import date, datetime, timedelta
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+from bench import sample_user, started_application, stop_application
+from fake_botapi import FakeBotAPI
+
+# Staging/prerender: unapred renderovana poruka vazi samo dok se red u chats ne promeni
+# (verzija); izmenjen profil se pri slanju renderuje ponovo, a stari dani se brisu.
+
+DAY = date(2026, 10, 17)
+
+def persistence_with_users(path, chat_ids) -> cb.SQLitePersistence:
+    persistence = cb.SQLitePersistence(str(path))
+    persistence.write_rows({
+        chat_id: cb.SQLitePersistence.row_from_chat_data(sample_user(chat_id)) for chat_id in chat_ids
+    })
+    return persistence
+
+def test_fresh_only_when_version_matches(tmp_path):
+    persistence = persistence_with_users(tmp_path / "bot.sqlite3", [1, 2, 3])
+    versions = persistence.chat_versions([1, 2, 3])
+    persistence.staging.store(DAY, [(1, versions[1], "p1"), (2, versions[2] + 1, "p2")])
+
+    assert persistence.staging.fresh([1, 2, 3], DAY) == {1: "p1"}
+    assert persistence.staging.fresh([1], DAY + timedelta(days=1)) == {}
+
+def test_profile_write_invalidates_staged_message(tmp_path, monkeypatch):
+    db_path = tmp_path / "bot.sqlite3"
+    persistence_with_users(db_path, [1, 2]).conn.close()
+    today = datetime.now(cb.TZ).date()  # sample_user je u podrazumevanoj zoni
+    sent = {}
+
+    def on_call(method, params, status):
+        if method == "sendMessage":
+            sent[int(params["chat_id"])] = params["text"]
+
+    rendered = []
+    render_batch = cb.render_batch
+
+    def spy(application, batch, day):
+        rendered.append(sorted(batch))
+        return render_batch(application, batch, day)
+
+    monkeypatch.setattr(cb, "render_batch", spy)
+
+    async def scenario():
+        with FakeBotAPI(on_call=on_call) as api:
+            app = await started_application(api, str(db_path))
+            persistence = app.persistence
+            assert await cb.prerender(app, [1, 2], today) == 2
+            staged = persistence.staging.fresh([1, 2], today)
+            assert sorted(staged) == [1, 2]
+
+            changed = sample_user(2)
+            changed["cycle_length"] += 1
+            persistence.write_rows({2: cb.SQLitePersistence.row_from_chat_data(changed)})
+            assert sorted(persistence.staging.fresh([1, 2], today)) == [1]
+
+            stats = await cb.broadcast_daily(app, today, chat_ids=[1, 2], limiter=cb.TokenBucket(1e9))
+            await stop_application(app)
+            return staged, stats
+
+    staged, stats = asyncio.run(scenario())
+    assert stats.sent == 2
+    assert rendered == [[1, 2], [2]]  # pri slanju se renderuje samo izmenjen chat
+    assert sent[1] == json.loads(staged[1])["text"]
+
+def test_prune_removes_old_days(tmp_path):
+    persistence = persistence_with_users(tmp_path / "bot.sqlite3", [1])
+    version = persistence.chat_versions([1])[1]
+    for offset in range(3):
+        persistence.staging.store(DAY - timedelta(days=offset), [(1, version, f"p{offset}")])
+
+    assert persistence.staging.prune(DAY - timedelta(days=1)) == 1
+    assert persistence.staging.fresh([1], DAY - timedelta(days=2)) == {}
+    assert persistence.staging.fresh([1], DAY - timedelta(days=1)) == {1: "p1"}
+    assert persistence.staging.fresh([1], DAY) == {1: "p0"}
@@ -0,0 +1,110 @@
+import copy
+import os
+import pickle
+from datetime import date
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+
+# UserProfile zamenjuje dict u chat_data: mora da se ponasa isto kao stari dict (citanje,
+# upis, brisanje, kopije, jednakost) i da prodje kroz pickle, bazu i JSONL izvoz/uvoz.
+
+def old_dict(**values) -> dict:
+    data = {
+        "cycle_length": 28, "period_length": 5, "last_start": None, "star_sign": None,
+        "seen_start": False, "bad_mood_streak": 0, "last_mood_date": None, "city": None,
+        "cycle_history": None, "delivery_minute": cb.DEFAULT_DELIVERY_MINUTE, "timezone": cb.DEFAULT_TIMEZONE,
+    }
+    data.update(values)
+    return data
+
+def full_profile() -> cb.UserProfile:
+    history = cb.CycleHistory()
+    for length in (27, 29, 30):
+        history.add(length)
+    return cb.UserProfile({
+        "cycle_length": 30, "period_length": 6, "last_start": date(2026, 10, 1), "star_sign": "Lav",
+        "seen_start": True, "bad_mood_streak": 2, "last_mood_date": date(2026, 10, 16), "city": "Novi Sad",
+        "cycle_history": history, "delivery_minute": 21 * 60, "timezone": "Europe/London",
+    })
+
+def test_known_and_unknown_keys():
+    profile = cb.UserProfile()
+    assert profile == old_dict()
+    assert len(profile) == len(cb.UserProfile.FIELDS)
+
+    profile["last_start"] = date(2026, 10, 1)
+    profile["star_sign"] = "Lav"
+    profile["seen_start"] = 1
+    profile["cycle_length"] = "30"
+    assert (profile["last_start"], profile["star_sign"], profile["seen_start"], profile["cycle_length"]) == (
+        date(2026, 10, 1), "Lav", True, 30
+    )
+    profile["star_sign"] = "Zmaj"  # nepoznat znak = nema znaka
+    assert profile["star_sign"] is None
+
+    assert profile.get("awaiting") is None and "awaiting" not in profile
+    profile["awaiting"] = {"step": 2}
+    assert profile["awaiting"] == {"step": 2} and len(profile) == len(cb.UserProfile.FIELDS) + 1
+    del profile["awaiting"]
+    assert "awaiting" not in profile
+    try:
+        del profile["awaiting"]
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("ocekivan KeyError")
+
+    del profile["last_start"]  # poznato polje se vraca na podrazumevanu vrednost
+    assert profile["last_start"] is None and "last_start" in profile
+    assert profile.setdefault("cycle_length", 28) == 30
+    assert profile.pop("period_length") == 5
+
+def test_clear_copy_and_deepcopy():
+    profile = full_profile()
+    profile["awaiting"] = {"step": 2}
+
+    for clone in (profile.copy(), copy.deepcopy(profile)):
+        assert clone == profile
+        clone["cycle_history"].add(31)
+        clone["city"] = "Nis"
+        assert profile["cycle_history"].n == 3 and profile["city"] == "Novi Sad"
+    deep = copy.deepcopy(profile)
+    deep["awaiting"]["step"] = 3
+    assert profile["awaiting"] == {"step": 2}
+
+    profile.clear()
+    assert profile == old_dict()
+
+def test_equal_to_old_dict_form():
+    profile = full_profile()
+    as_dict = dict(profile)
+    assert profile == as_dict and as_dict == profile
+    assert cb.UserProfile(as_dict) == profile
+    assert profile != old_dict()
+
+def test_pickle_round_trip_and_migration(tmp_path):
+    profile = full_profile()
+    restored = pickle.loads(pickle.dumps(profile))
+    assert isinstance(restored, cb.UserProfile) and restored == profile
+
+    pickle_path = tmp_path / "bot_data.pkl"
+    with open(pickle_path, "wb") as f:
+        pickle.dump({"chat_data": {1: profile, 2: dict(profile)}}, f)
+    persistence = cb.SQLitePersistence(str(tmp_path / "bot.sqlite3"))
+    assert cb.migrate_pickle(str(pickle_path), persistence) == 2
+    loaded = persistence.load_chats([1, 2])
+    assert cb.UserProfile(loaded[1]) == profile
+    assert loaded[1] == loaded[2]
+
+def test_json_round_trip_through_persistence(tmp_path):
+    profile = full_profile()
+    source = cb.SQLitePersistence(str(tmp_path / "izvor.sqlite3"))
+    source.write_rows({1: cb.SQLitePersistence.row_from_chat_data(profile)})
+    path = str(tmp_path / "korisnici.jsonl")
+    assert cb.export_users(source, path, "jsonl") == 1
+
+    target = cb.SQLitePersistence(str(tmp_path / "cilj.sqlite3"))
+    assert cb.import_users(target, path, "jsonl") == (1, 0)
+    assert cb.UserProfile(target.load_chats([1])[1]) == profile
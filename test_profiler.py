@@ -0,0 +1,83 @@
+import asyncio
+import inspect
+import os
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import ciklus_bot as cb
+from test_updates import fake_update
+
+# Profiler: uzorkuje stek event loop niti samo dok je ukljucen, spore tragove pamti sa
+# podelom po delovima (Span), a otkazan ili odbacen update zatvara i samu korutinu.
+
+def busy(seconds: float):
+    until = time.perf_counter() + seconds
+    while time.perf_counter() < until:
+        pass
+
+def test_sampling_only_while_enabled():
+    profiler = cb.Profiler(interval=0.001, threshold=10)
+    busy(0.05)
+    assert profiler.snapshot() == {}
+
+    profiler.start()
+    try:
+        busy(0.2)
+    finally:
+        profiler.stop()
+    samples = profiler.snapshot()
+    assert any("busy (test_profiler.py" in stack for stack in samples)
+    busy(0.05)
+    assert profiler.snapshot() == samples
+    profiler.reset()
+    assert profiler.snapshot() == {}
+
+def test_slow_trace_is_reported_with_spans():
+    profiler = cb.Profiler(threshold=0.05)
+
+    async def handler(seconds):
+        with cb.Span("db"):
+            await asyncio.sleep(seconds)
+        return seconds
+
+    async def scenario():
+        assert await profiler.run_traced("update", "brz", handler(0.001)) == 0.001
+        await profiler.run_traced("update", "komanda:/statistika", handler(0.06))
+        assert cb.current_trace.get() is None
+        with cb.Span("db"):  # van traga ne radi nista
+            pass
+
+    asyncio.run(scenario())
+    assert [trace.name for trace in profiler.slow] == ["komanda:/statistika"]
+    trace = profiler.slow[0]
+    assert trace.elapsed >= 0.06 and trace.spans["db"] >= 0.06
+    assert set(trace.breakdown()) == {"db", "ostalo"}
+    assert trace.summary().startswith("update komanda:/statistika: ")
+    assert profiler.active == {}
+
+def test_cancelled_and_dropped_updates_close_their_coroutine(monkeypatch):
+    monkeypatch.setattr(cb.profiler, "enabled", True)  # bez niti za uzorkovanje
+    gate = asyncio.Event()
+
+    async def handler():
+        await gate.wait()
+
+    async def scenario():
+        processor = cb.PerChatUpdateProcessor(max_concurrent_updates=4, max_queued=16, max_per_chat=2)
+        update = fake_update(7)
+        running, queued, dropped = handler(), handler(), handler()
+        first = asyncio.create_task(processor.process_update(update, running))
+        second = asyncio.create_task(processor.process_update(update, queued))
+        third = asyncio.create_task(processor.process_update(update, dropped))
+        await asyncio.sleep(0.01)
+        assert third.done()
+        second.cancel()  # pozivalac otkazan dok update jos ceka u redu
+        await asyncio.sleep(0)
+        gate.set()
+        await first
+        await processor.shutdown()
+        return running, queued, dropped
+
+    running, queued, dropped = asyncio.run(scenario())
+    assert [inspect.getcoroutinestate(c) for c in (running, queued, dropped)] == [inspect.CORO_CLOSED] * 3
@@ -0,0 +1,74 @@
+import asyncio
+import os
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+from telegram import Update
+
+import ciklus_bot as cb
+from bench import message_update
+from fake_botapi import FakeBotAPI
+
+# PerChatUpdateProcessor: update-i istog chata idu redom, a Application.stop() ceka i
+# one koji su jos u redu chata, pa odgovor ne ode kroz vec zatvoren HTTP klijent.
+
+def test_per_chat_order_and_nothing_lost_on_stop(tmp_path):
+    replies = []
+
+    def on_call(method, params, status):
+        if method == "sendMessage":
+            replies.append((int(params["chat_id"]), params["text"]))
+
+    async def scenario():
+        with FakeBotAPI(latency=0.01, on_call=on_call) as api:
+            app = cb.build_application(cb.SQLitePersistence(str(tmp_path / "bot.sqlite3")), bot_api_url=api.url)
+            assert isinstance(app.update_processor, cb.PerChatUpdateProcessor)
+            await app.initialize()
+            await app.start()
+            update_id = 0
+            for minute in range(10):
+                for chat_id in (1, 2, 3):
+                    update_id += 1
+                    payload = message_update(update_id, chat_id, f"/vreme 21:{minute:02d}")
+                    await app.update_queue.put(Update.de_json(payload, app.bot))
+            # bez cekanja: stop mora sam da isprazni redove chatova
+            await app.stop()
+            await app.shutdown()
+
+    asyncio.run(scenario())
+    assert len(replies) == 30
+    for chat_id in (1, 2, 3):
+        texts = [text for chat, text in replies if chat == chat_id]
+        assert texts == [f"✅ Dnevna poruka će stizati u 21:{minute:02d}." for minute in range(10)]
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+def fake_update(chat_id):
+    update = Update(update_id=chat_id)
+    update._effective_chat = FakeChat(chat_id)
+    return update
+
+def test_per_chat_queue_is_bounded():
+    async def scenario():
+        processor = cb.PerChatUpdateProcessor(max_concurrent_updates=4, max_queued=16, max_per_chat=2)
+        gate = asyncio.Event()
+        done = []
+
+        async def handler(n):
+            await gate.wait()
+            done.append(n)
+
+        update = fake_update(7)
+        # prvi se obradjuje, drugi ceka u redu, ostali se odbacuju
+        tasks = [asyncio.create_task(processor.process_update(update, handler(n))) for n in range(4)]
+        await asyncio.sleep(0.01)
+        assert [t.done() for t in tasks] == [False, False, True, True]
+        assert processor.pending == 1
+        gate.set()
+        await asyncio.gather(*tasks)
+        await processor.shutdown()
+        return done
+
+    assert asyncio.run(scenario()) == [0, 1]
@@ -0,0 +1,267 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import httpx
+from telegram import Update
+
+import ciklus_bot as cb
+from bench import callback_update, message_update
+from fake_botapi import FakeBotAPI
+
+# WeatherClient: jedan upit po gradu (single-flight), breaker posle uzastopnih gresaka,
+# nepostojeci grad ne otvara breaker; podesavanje grada ne ceka OpenWeatherMap.
+
+def not_found(city: str) -> httpx.HTTPStatusError:
+    request = httpx.Request("GET", cb.WEATHER_URL)
+    return httpx.HTTPStatusError(city, request=request, response=httpx.Response(404, request=request))
+
+class FakeWeather(cb.WeatherClient):
+    def __init__(self, delay: float = 0.0, fail: bool = False, unknown: frozenset = frozenset()):
+        super().__init__("key", breaker=cb.CircuitBreaker(failure_threshold=3, reset_after=60))
+        self.delay = delay
+        self.fail = fail
+        self.unknown_cities = unknown
+        self.calls = []
+
+    async def _fetch(self, city: str):
+        self.calls.append(city)
+        await asyncio.sleep(self.delay)
+        if city in self.unknown_cities:
+            raise not_found(city)
+        if self.fail:
+            raise httpx.ConnectError("nema mreze")
+        return "suncano", "vedro"
+
+def test_single_flight_per_city():
+    client = FakeWeather(delay=0.05)
+
+    async def scenario():
+        return await asyncio.gather(*(client.fetch(city) for city in ["Nis", "Nis", "Nis", "Bec", "Bec"]))
+
+    assert asyncio.run(scenario()) == [("suncano", "vedro")] * 5
+    assert sorted(client.calls) == ["Bec", "Nis"]
+    assert client.get("Nis") == ("suncano", "vedro")  # svez kes, bez novog upita
+    assert len(client.calls) == 2
+
+def test_breaker_opens_and_serves_cache():
+    client = FakeWeather()
+
+    async def scenario():
+        await client.fetch("Nis")
+        client.fail = True
+        client._cache["Nis"] = (0.0, "suncano", "vedro")  # zastarelo
+        for _ in range(3):
+            assert await client.fetch("Nis") == ("suncano", "vedro")
+        assert client.breaker.state == "open"
+        calls = len(client.calls)
+        assert await client.fetch("Nis") == ("suncano", "vedro")
+        assert len(client.calls) == calls  # breaker otvoren: nema upita
+
+    asyncio.run(scenario())
+
+def test_unknown_city_does_not_open_breaker():
+    client = FakeWeather(unknown=frozenset({"Atlantida"}))
+
+    async def scenario():
+        for _ in range(5):
+            assert await client.fetch("Atlantida") == (None, None)
+
+    asyncio.run(scenario())
+    assert client.breaker.state == "closed"
+    assert client.calls == ["Atlantida"]  # posle 404 se grad preskace
+    assert client.is_unknown("Atlantida")
+
+def test_set_city_does_not_wait_for_weather(tmp_path, monkeypatch):
+    client = FakeWeather(delay=0.5, unknown=frozenset({"Atlantida"}))
+    monkeypatch.setattr(cb, "weather", client)
+    monkeypatch.setattr(cb, "WEATHER_API_KEY", "key")
+    replies = []
+
+    def on_call(method, params, status):
+        if method == "sendMessage":
+            replies.append(params["text"])
+
+    last_start = (datetime.now(cb.TZ).date() - timedelta(days=3)).strftime("%d.%m.%Y")
+    steps = [
+        (message_update, "/start"), (callback_update, "setup"), (message_update, "28"),
+        (message_update, "5"), (message_update, last_start), (callback_update, "sign_Lav"),
+    ]
+
+    async def scenario():
+        with FakeBotAPI(on_call=on_call) as api:
+            app = cb.build_application(cb.SQLitePersistence(str(tmp_path / "bot.sqlite3")), bot_api_url=api.url)
+            await app.initialize()
+            await app.start()
+            for update_id, (make, payload) in enumerate(steps, start=1):
+                await app.process_update(Update.de_json(make(update_id, 5, payload), app.bot))
+            started = time.perf_counter()
+            await app.process_update(Update.de_json(message_update(99, 5, "Atlantida"), app.bot))
+            elapsed = time.perf_counter() - started
+            await app.stop()  # ceka i proveru grada iz pozadine
+            await app.shutdown()
+            return elapsed, app.chat_data[5]["city"]
+
+    elapsed, city = asyncio.run(scenario())
+    assert elapsed < client.delay
+    assert city == "Atlantida"
+    assert replies[-2].startswith("✅ Podešavanje završeno!")
+    assert replies[-1].startswith("Ne pronalazim grad „Atlantida“")
+
+# Isto, ali preko pravog HTTP-a: lokalni stub OpenWeatherMap-a (kao fake_botapi.py), da se
+# provere i httpx timeout, mapiranje HTTP gresaka i ponovna upotreba konekcije.
+
+class StubWeatherAPI:
+    def __init__(self):
+        self.delay = 0.0
+        self.main = "Clear"
+        self.status: dict = {}  # grad -> HTTP status umesto 200
+        self.calls: dict = {}  # grad -> broj upita
+        self.connections = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with stub.lock:
+                    stub.connections += 1
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                city = query["q"][0]
+                with stub.lock:
+                    stub.calls[city] = stub.calls.get(city, 0) + 1
+                time.sleep(stub.delay)
+                status = stub.status.get(city, 200)
+                if query.get("appid") != ["key"]:
+                    status = 401
+                body = {"weather": [{"main": stub.main, "description": stub.main.lower()}]} if status == 200 else {}
+                data = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except OSError:
+                    pass  # klijent je vec odustao (timeout)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/data/2.5/weather"
+
+    def __enter__(self) -> "StubWeatherAPI":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def http_client(stub: StubWeatherAPI, **breaker) -> cb.WeatherClient:
+    return cb.WeatherClient("key", url=stub.url, timeout=0.1, breaker=cb.CircuitBreaker(**breaker))
+
+def test_http_timeout_opens_breaker_then_half_opens():
+    async def scenario(stub):
+        client = http_client(stub, failure_threshold=2, reset_after=0.3)
+        try:
+            stub.delay = 0.5
+            assert await client.fetch("Nis") == (None, None)
+            assert await client.fetch("Nis") == (None, None)
+            assert client.breaker.state == "open"
+            assert await client.fetch("Nis") == (None, None)
+            assert stub.calls["Nis"] == 2  # otvoren breaker: bez upita
+
+            stub.delay, stub.status["Nis"] = 0.0, 500
+            await asyncio.sleep(0.3)
+            assert client.breaker.state == "half-open"
+            assert await client.fetch("Nis") == (None, None)
+            assert client.breaker.state == "open"  # jedna greska u half-open ga ponovo otvara
+
+            del stub.status["Nis"]
+            await asyncio.sleep(0.3)
+            assert await client.fetch("Nis") == ("suncano", "clear")
+            assert client.breaker.state == "closed"
+            assert stub.calls["Nis"] == 4
+        finally:
+            await client.close()
+
+    with StubWeatherAPI() as stub:
+        asyncio.run(scenario(stub))
+
+def test_http_404_marks_city_unknown():
+    async def scenario(stub):
+        client = http_client(stub, failure_threshold=1)
+        try:
+            stub.status["Atlantida"] = 404
+            assert await client.fetch("Atlantida") == (None, None)
+            assert await client.fetch("Atlantida") == (None, None)
+            assert client.breaker.state == "closed"
+            assert client.is_unknown("Atlantida")
+            assert await client.fetch("Nis") == ("suncano", "clear")
+        finally:
+            await client.close()
+
+    with StubWeatherAPI() as stub:
+        asyncio.run(scenario(stub))
+        assert stub.calls == {"Atlantida": 1, "Nis": 1}
+
+def test_http_single_flight_and_connection_reuse():
+    async def scenario(stub):
+        client = http_client(stub)
+        try:
+            stub.delay = 0.05
+            results = await asyncio.gather(*(client.fetch(city) for city in ["Nis"] * 5 + ["Bec"] * 3))
+            assert results == [("suncano", "clear")] * 8
+            assert stub.calls == {"Nis": 1, "Bec": 1}
+            connections = stub.connections
+            for _ in range(5):
+                client._cache.clear()
+                await client.fetch("Nis")
+            assert stub.connections == connections  # keep-alive, bez novih konekcija
+        finally:
+            await client.close()
+
+    with StubWeatherAPI() as stub:
+        asyncio.run(scenario(stub))
+
+def test_http_stale_while_revalidate():
+    async def scenario(stub):
+        client = http_client(stub)
+        try:
+            assert client.get("Nis") == (None, None)  # promasaj: upit ide u pozadini
+            await asyncio.gather(*client._refreshing.values())
+            assert client.get("Nis") == ("suncano", "clear")
+
+            fetched_at, category, desc = client._cache["Nis"]
+            client._cache["Nis"] = (fetched_at - client.ttl, category, desc)
+            stub.main, stub.delay = "Rain", 0.05
+            started = time.perf_counter()
+            assert client.get("Nis") == ("suncano", "clear")  # zastarelo, ali odmah
+            assert time.perf_counter() - started < stub.delay
+            assert client.get("Nis") == ("suncano", "clear")
+            await asyncio.gather(*client._refreshing.values())
+            assert client.get("Nis") == ("kisovito", "rain")
+            assert stub.calls["Nis"] == 2
+        finally:
+            await client.close()
+
+    with StubWeatherAPI() as stub:
+        asyncio.run(scenario(stub))